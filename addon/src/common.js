@@ -1,5 +1,5 @@
 import Database from './database.js';
-import { loadLocal, saveLocal, clearLocal, saveToServer, hasPending, clearPendingChanges } from './team-db-sync.js';
+import { loadLocal, saveLocal, clearLocal, saveToServer, hasPending, clearPendingChanges, setServerRevision } from './team-db-sync.js';
 import { storageManager } from './storage-manager.js';
 
 let config = null;
@@ -60,6 +60,7 @@ export async function loadDatabase() {
                 
                 const resp = await fetch(url, { method: 'GET', headers });
                 if (resp.ok) {
+                    await setServerRevision(resp.headers.get('X-TeamDB-Revision'));
                     // Expect JSON { database: <object>, last_modified: <timestamp> }
                     const j = await resp.json().catch(() => null);
                     if (j) {
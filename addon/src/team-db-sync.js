@@ -3,6 +3,7 @@ import { storageManager } from './storage-manager.js';
 
 const LS_KEY = 'teamdb_local_entry';
 const CHANGES_KEY = 'teamdb_local_changes';
+const REVISION_KEY = 'teamdb_server_revision';
 
 export async function loadLocal() {
     try {
@@ -18,10 +19,25 @@ export async function hasPending() {
     return e && e.pending === true;
 }
 
+// Remember the server revision the local copy is based on (X-TeamDB-Revision)
+export async function setServerRevision(revision) {
+    if (revision === null || revision === undefined) return;
+    try {
+        await storageManager.set(REVISION_KEY, String(revision));
+    } catch (e) {
+        console.error('setServerRevision failed:', e);
+    }
+}
+
 export async function saveLocal(data) {
+    // Keep the revision of the first pending edit so later edits don't move the base forward
+    const current = await loadLocal();
+    const baseRevision = (current && current.pending && current.base_revision)
+        || await storageManager.get(REVISION_KEY, null);
     const entry = {
         data,
         modified_at: new Date().toISOString().replace(/\.\d+Z$/, 'Z'),
+        base_revision: baseRevision,
         pending: true
     };
     try {
@@ -72,16 +88,71 @@ export async function clearPendingChanges() {
     }
 }
 
+// Short-lived session token from /api/session; lets the server skip the slow token hash check
+let sessionCache = null;
+
+async function getSession(serverUrl, email, token) {
+    const base = serverUrl.replace(/\/$/, '');
+    const key = base + '|' + email + '|' + token;
+    // Renew a minute before expiry
+    if (sessionCache && sessionCache.key === key && sessionCache.expiresAt - 60000 > Date.now()) {
+        return sessionCache.session;
+    }
+    sessionCache = null;
+    try {
+        const resp = await fetch(base + '/api/session', {
+            method: 'POST',
+            headers: { 'X-TeamDB-Email': email, 'X-TeamDB-Token': token }
+        });
+        if (!resp.ok) return null;
+        const j = await resp.json();
+        sessionCache = { key, session: j.session, expiresAt: Date.parse(j.expires_at) };
+        return j.session;
+    } catch (e) {
+        console.warn('getSession failed, using token only:', e);
+        return null;
+    }
+}
+
+// Bodies smaller than this are sent uncompressed; gzip would barely shrink them
+const GZIP_MIN_BYTES = 1024;
+
+// gzip a request body with CompressionStream when the browser has it, else null
+async function gzipBody(text) {
+    if (typeof CompressionStream === 'undefined' || text.length < GZIP_MIN_BYTES) return null;
+    try {
+        const stream = new Blob([text]).stream().pipeThrough(new CompressionStream('gzip'));
+        return await new Response(stream).arrayBuffer();
+    } catch (e) {
+        console.warn('gzip failed, sending uncompressed:', e);
+        return null;
+    }
+}
+
 export async function saveToServer(localEntry, serverUrl, email, token, force=false) {
     const url = serverUrl.replace(/\/$/, '') + '/api/teamdb';
     const headers = { 'Content-Type': 'application/json' };
     if (email) headers['X-TeamDB-Email'] = email;
     if (token) headers['X-TeamDB-Token'] = token;
+    if (email && token) {
+        // The token stays in the request as a fallback if the session is rejected
+        const session = await getSession(serverUrl, email, token);
+        if (session) headers['X-TeamDB-Session'] = session;
+    }
     if (localEntry && localEntry.modified_at && !force) {
         headers['X-Client-Modified-At'] = localEntry.modified_at;
     }
+    if (localEntry && localEntry.base_revision && !force) {
+        headers['X-TeamDB-Base-Revision'] = localEntry.base_revision;
+    }
 
-    const resp = await fetch(url, { method: 'PUT', headers, body: JSON.stringify(localEntry.data) });
+    let body = JSON.stringify(localEntry.data);
+    const gzipped = await gzipBody(body);
+    if (gzipped) {
+        headers['Content-Encoding'] = 'gzip';
+        body = gzipped;
+    }
+    const resp = await fetch(url, { method: 'PUT', headers, body });
     if (resp.status === 412) {
         const err = new Error('Conflict');
         err.type = 'conflict';
@@ -94,6 +165,7 @@ export async function saveToServer(localEntry, serverUrl, email, token, force=fa
         throw err;
     }
     // success
+    await setServerRevision(resp.headers.get('X-TeamDB-Revision'));
     await clearLocal();
     // also clear the per-row pending changes list
     await clearPendingChanges();
@@ -0,0 +1,127 @@
+"""Token verification for write requests.
+
+Long-lived tokens are stored as salted PBKDF2 hashes, which are deliberately
+slow to check. `TokenIndex` keeps the token map in memory (reloaded only when
+the backing file changes) and `SessionSigner` issues short-lived HMAC-signed
+session tokens after one PBKDF2 check, so later writes can be verified in
+microseconds.
+
+Session token format: ``base64url(email) "." expiry "." fingerprint "." base64url(hmac)``
+where the fingerprint ties the session to the long-lived token it was
+exchanged for; re-issuing or removing that token invalidates its sessions.
+"""
+from __future__ import annotations
+import base64
+import binascii
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def hash_token(token: str, iterations: int = 100_000) -> Dict[str, Any]:
+    """Return the stored form (salt/hash/iterations) of a new long-lived token."""
+    salt = secrets.token_bytes(16)
+    dk = hashlib.pbkdf2_hmac('sha256', token.encode('utf-8'), salt, iterations)
+    return {
+        'salt': binascii.hexlify(salt).decode('ascii'),
+        'hash': binascii.hexlify(dk).decode('ascii'),
+        'iterations': iterations,
+    }
+
+
+def check_token(entry: Any, token: str) -> bool:
+    """Verify `token` against a stored salt/hash/iterations entry (PBKDF2, slow)."""
+    if not isinstance(entry, dict):
+        return False
+    try:
+        salt = binascii.unhexlify(entry['salt'])
+        expected_hash = binascii.unhexlify(entry['hash'])
+        iterations = int(entry.get('iterations', 100_000))
+    except Exception:
+        return False
+    derived = hashlib.pbkdf2_hmac('sha256', token.encode('utf-8'), salt, iterations)
+    return secrets.compare_digest(derived, expected_hash)
+
+
+def token_fingerprint(entry: Any) -> str:
+    if not isinstance(entry, dict):
+        return ''
+    return str(entry.get('hash', ''))[:16]
+
+
+class TokenIndex:
+    """In-memory copy of the token map, refreshed when the stored file changes."""
+
+    def __init__(self, storage, namespace: str, key: str) -> None:
+        self._storage = storage
+        self._namespace = namespace
+        self._key = key
+        self._lock = threading.Lock()
+        self._version: Optional[Tuple[int, int, int]] = None
+        self._tokens: Dict[str, Any] = {}
+
+    def _current_version(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            st = self._storage.stat(self._namespace, self._key)
+        except KeyError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def tokens(self) -> Dict[str, Any]:
+        version = self._current_version()
+        if version == self._version:
+            return self._tokens
+        with self._lock:
+            if version != self._version:
+                try:
+                    tokens = self._storage.load(self._namespace, self._key)
+                except KeyError:
+                    tokens = {}
+                self._tokens = tokens if isinstance(tokens, dict) else {}
+                self._version = version
+            return self._tokens
+
+    def get(self, email: str) -> Any:
+        return self.tokens().get(email)
+
+
+class SessionSigner:
+    def __init__(self, secret: bytes, ttl: float = 3600) -> None:
+        self._secret = secret
+        self.ttl = ttl
+
+    def _sign(self, message: str) -> str:
+        return _b64encode(hmac.new(self._secret, message.encode('utf-8'), hashlib.sha256).digest())
+
+    def issue(self, email: str, fingerprint: str, now: Optional[float] = None) -> Tuple[str, int]:
+        """Return (session token, expiry as unix time) for `email`."""
+        expires = int((now if now is not None else time.time()) + self.ttl)
+        message = '%s.%d.%s' % (_b64encode(email.encode('utf-8')), expires, fingerprint)
+        return '%s.%s' % (message, self._sign(message)), expires
+
+    def verify(self, session: str, now: Optional[float] = None) -> Optional[Tuple[str, str]]:
+        """Return (email, fingerprint) for a valid unexpired session, else None."""
+        try:
+            message, signature = session.rsplit('.', 1)
+            email_b64, expires, fingerprint = message.split('.')
+            if not hmac.compare_digest(self._sign(message), signature):
+                return None
+            if int(expires) < (now if now is not None else time.time()):
+                return None
+            return _b64decode(email_b64).decode('utf-8'), fingerprint
+        except (ValueError, binascii.Error, UnicodeDecodeError):
+            return None
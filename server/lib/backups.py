@@ -0,0 +1,517 @@
+"""Deduplicated, compressed history of database versions.
+
+Instead of a full YAML copy per save, every version is split into its
+people/teams/projects entries. Each entry is stored once, gzip-compressed,
+under its content hash (`objects/ab/abcdef....json.gz`); a version is a
+gzip manifest listing `[name, hash]` pairs per kind plus the rest of the
+document. Most manifests are deltas (`NNNNNNNN.delta.json.gz`): the runs of
+pairs that changed since the previous version. A full manifest is written
+every `FULL_MANIFEST_EVERY` versions and whenever a delta would not be much
+smaller, so a save that changes a few entries writes a few objects and a
+manifest of a few lines, and reading a version replays a bounded number of
+deltas.
+
+`versions.jsonl` holds one metadata line per version and is loaded into
+memory at startup, so listing versions never touches the manifests. It is
+reloaded when another process changed it; writers in different processes
+must hold a common lock (the service's commit lock). The store tracks the
+last version using each object and deletes the object when that version
+is pruned; a pruned version's manifest is kept while a retained delta is
+based on it.
+"""
+from __future__ import annotations
+import gzip
+import hashlib
+import json
+import os
+import threading
+from collections import Counter
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import logging
+
+from server.lib.dbmodel import ENTITY_KINDS, entity_revision
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAME = 'versions.jsonl'
+# Entries of a kind that may differ at their position before entries are matched by name
+NAME_LOOKUP_MISSES = 16
+# A full manifest is written at least every this many versions; reading a
+# version replays at most this many deltas
+FULL_MANIFEST_EVERY = 50
+# A delta listing more pairs than this share of the version is written in full
+DELTA_MAX_SHARE = 0.5
+# Changed runs up to this long are not searched for unchanged entries
+SHORT_RUN = 8
+
+
+@dataclass(frozen=True)
+class BackupVersion:
+    version: int
+    id: str
+    time: str
+    revision: Optional[int]
+    counts: Dict[str, int]
+
+    def to_json(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+def _dumps(value: Any) -> bytes:
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8')
+
+
+def _content_id(manifest: Dict[str, Any]) -> str:
+    """Identity of a version's content: its skeleton and the entry hashes in order."""
+    h = hashlib.sha256(json.dumps(manifest['skeleton'], sort_keys=True, ensure_ascii=False, separators=(',', ':'),
+                                  default=str).encode('utf-8'))
+    for kind in sorted(manifest['entities']):
+        h.update(('\n%s:' % kind).encode('utf-8'))
+        h.update(','.join([item[1] for item in manifest['entities'][kind]]).encode('ascii'))
+    return h.hexdigest()[:16]
+
+
+def _splices(old: List[List[Any]], new: List[List[Any]]) -> List[list]:
+    """`[start, stop, items]` runs that turn `old` into `new`, in order.
+
+    Each replaces `old[start:stop]` by `items`. Linear: after the common head
+    and tail, entries are matched to their first position in `old`, which is
+    minimal for edits, inserts and deletes but not for reordered lists.
+    """
+    size = min(len(old), len(new))
+    head = 0
+    while head < size and old[head] == new[head]:
+        head += 1
+    tail = 0
+    while tail < size - head and old[-1 - tail] == new[-1 - tail]:
+        tail += 1
+    old_end, new_end = len(old) - tail, len(new) - tail
+    if old_end - head <= SHORT_RUN or new_end - head <= SHORT_RUN:
+        return [[head, old_end, new[head:new_end]]] if (old_end, new_end) != (head, head) else []
+    first: Dict[str, int] = {}
+    for q in range(old_end - 1, head - 1, -1):
+        first[old[q][1]] = q
+    runs: List[list] = []
+    run: Optional[list] = None
+    p = head
+    for item in new[head:new_end]:
+        if p < old_end and old[p] == item:
+            if run is not None:
+                runs.append(run)
+                run = None
+            p += 1
+            continue
+        q = first.get(item[1], -1)
+        if q > p and old[q] == item:
+            # old[p:q] was deleted
+            runs.append([p, q, run[2] if run is not None else []])
+            run = None
+            p = q + 1
+            continue
+        if run is None:
+            run = [p, p, []]
+        run[2].append(item)
+    if p < old_end:
+        run = run or [p, p, []]
+        run[1] = old_end
+    if run is not None:
+        runs.append(run)
+    return runs
+
+
+def _apply_splices(items: List[List[Any]], runs: List[list]) -> List[List[Any]]:
+    items = list(items)
+    for start, stop, new in reversed(runs):
+        items[start:stop] = new
+    return items
+
+
+def _write_atomic(path: Path, payload: bytes) -> None:
+    tmp = path.with_name(path.name + '.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(payload)
+    tmp.replace(path)
+
+
+class BackupStore:
+    def __init__(self, root: str | Path, max_versions: int = 200) -> None:
+        self.root = Path(root)
+        self.max_versions = max_versions
+        self._objects = self.root / 'objects'
+        self._manifests = self.root / 'versions'
+        self._index_path = self.root / INDEX_NAME
+        self._objects.mkdir(parents=True, exist_ok=True)
+        self._manifests.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._index_key = self._index_stat()
+        self._versions: List[BackupVersion] = self._load_index()
+        # Object hash -> uses in the newest version, and -> the last version that
+        # used it for objects the newest one does not; built on first prune
+        self._alive: Optional[Dict[str, int]] = None
+        self._dead_at: Dict[str, int] = {}
+        # (version, full manifest) of the newest version as written by add()
+        self._latest: Optional[Tuple[int, Dict[str, Any]]] = None
+        # (version, full manifest) last read or written, to resolve the next delta
+        self._resolved: Optional[Tuple[int, Dict[str, Any]]] = None
+        # Kind -> (entry list, [name, hash] items) of the last stored document.
+        # Copy-on-write updates share unchanged lists and entries, and a full
+        # upload mostly repeats them by name, so only new content gets hashed.
+        self._last_entities: Dict[str, Tuple[list, List[List[Any]]]] = {}
+        # Kind -> {name: (entry, hash)} over `_last_entities`, built when needed
+        self._last_by_name: Dict[str, Dict[Any, Tuple[Any, str]]] = {}
+        self._last_doc: Any = None
+
+    # -- index --
+
+    def _load_index(self) -> List[BackupVersion]:
+        versions: List[BackupVersion] = []
+        try:
+            with open(self._index_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        versions.append(BackupVersion(**json.loads(line)))
+                    except (ValueError, TypeError):
+                        logger.warning('Skipping unreadable backup index line in %s', self._index_path)
+        except FileNotFoundError:
+            pass
+        # Drop entries whose manifest was pruned (crash before the index rewrite)
+        return [v for v in versions
+                if self._manifest_path(v.version).exists() or self._delta_path(v.version).exists()]
+
+    def _index_stat(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            st = os.stat(self._index_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _refresh(self) -> None:
+        """Reload the index if another process changed it."""
+        key = self._index_stat()
+        if key == self._index_key:
+            return
+        self._index_key = key
+        self._versions = self._load_index()
+        self._alive = None
+        self._latest = self._resolved = None
+
+    def _rewrite_index(self) -> None:
+        _write_atomic(self._index_path, b''.join(_dumps(v.to_json()) + b'\n' for v in self._versions))
+        self._index_key = self._index_stat()
+
+    def versions(self) -> List[BackupVersion]:
+        """Retained versions, newest first."""
+        with self._lock:
+            self._refresh()
+            return list(reversed(self._versions))
+
+    def is_latest(self, doc: Any) -> bool:
+        """True if `doc` is the very object last passed to `add()`."""
+        return doc is not None and doc is self._last_doc
+
+    def get_version(self, version: int) -> Optional[BackupVersion]:
+        with self._lock:
+            self._refresh()
+            for v in self._versions:
+                if v.version == version:
+                    return v
+        return None
+
+    # -- paths --
+
+    def _manifest_path(self, version: int) -> Path:
+        return self._manifests / f'{version:08d}.json.gz'
+
+    def _delta_path(self, version: int) -> Path:
+        return self._manifests / f'{version:08d}.delta.json.gz'
+
+    def _object_path(self, digest: str) -> Path:
+        return self._objects / digest[:2] / f'{digest}.json.gz'
+
+    # -- writing --
+
+    def _previous_hash(self, kind: str, idx: int, name: Any, entry: Any, by_name: bool) -> Optional[str]:
+        """Hash of `entry` if the last stored document had the same content, else None.
+
+        Looks at the same position first; `by_name` also looks the name up,
+        for lists whose entries moved.
+        """
+        last = self._last_entities.get(kind)
+        if last is None:
+            return None
+        entries, items = last
+        if idx < len(entries):
+            old = entries[idx]
+            if old is entry or (items[idx][0] == name and old == entry):
+                return items[idx][1]
+        if not by_name:
+            return None
+        by_name = self._last_by_name.get(kind)
+        if by_name is None:
+            by_name = self._last_by_name[kind] = {
+                item[0]: (old, item[1]) for old, item in zip(entries, items)}
+        hit = by_name.get(name)
+        if hit is not None and (hit[0] is entry or hit[0] == entry):
+            return hit[1]
+        return None
+
+    def _entry_hash(self, entry: Any, write: bool) -> str:
+        digest = entity_revision(entry)
+        path = self._object_path(digest)
+        if write and not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            _write_atomic(path, gzip.compress(_dumps(entry), compresslevel=6, mtime=0))
+        return digest
+
+    def _entity_items(self, kind: str, entries: list, write: bool) -> List[List[Any]]:
+        last = self._last_entities.get(kind)
+        if last is not None and last[0] is entries:
+            return last[1]
+        old_entries, old_items = last if last is not None else ((), ())
+        shared = min(len(entries), len(old_entries))
+        items = []
+        misses = 0
+        for idx, entry in enumerate(entries):
+            if idx < shared and old_entries[idx] is entry:
+                # Unchanged at its position (copy-on-write updates): reuse the pair
+                items.append(old_items[idx])
+                continue
+            name = entry.get('name') if isinstance(entry, dict) else None
+            # A few edited entries are cheaper to hash than indexing the old list by name
+            digest = self._previous_hash(kind, idx, name, entry, misses >= NAME_LOOKUP_MISSES)
+            if digest is None:
+                misses += 1
+                digest = self._entry_hash(entry, write)
+            # Hashes of the last stored document have their objects written already
+            items.append([name, digest])
+        return items
+
+    def manifest_for(self, doc: Any, write_objects: bool = False) -> Dict[str, Any]:
+        """Split `doc` into its skeleton and `[name, hash]` lists per entity kind."""
+        skeleton = dict(doc) if isinstance(doc, dict) else {}
+        inner = skeleton.get('database')
+        entities: Dict[str, List[List[Any]]] = {}
+        lists: Dict[str, Tuple[list, List[List[Any]]]] = {}
+        if isinstance(inner, dict):
+            inner = dict(inner)
+            for kind in ENTITY_KINDS:
+                entries = inner.get(kind)
+                if not isinstance(entries, list):
+                    continue
+                entities[kind] = self._entity_items(kind, entries, write_objects)
+                lists[kind] = (entries, entities[kind])
+                inner[kind] = None
+            skeleton['database'] = inner
+        if write_objects:
+            self._last_by_name = {kind: by_name for kind, by_name in self._last_by_name.items()
+                                  if kind in lists and lists[kind][0] is self._last_entities[kind][0]}
+            self._last_entities = lists
+        return {'skeleton': skeleton, 'entities': entities}
+
+    def add(self, doc: Any, revision: Optional[int] = None) -> Optional[BackupVersion]:
+        """Store `doc` as a new version unless it equals the newest one."""
+        with self._lock:
+            self._refresh()
+            manifest = self.manifest_for(doc, write_objects=True)
+            self._last_doc = doc
+            content_id = _content_id(manifest)
+            newest = self._versions[-1].version if self._versions else None
+            latest = self._latest if self._latest is not None and self._latest[0] == newest else None
+            if self._versions and self._versions[-1].id == content_id:
+                self._latest = (newest, manifest)
+                return None
+            number = newest + 1 if newest is not None else 1
+            changes = self._changes(latest[1], manifest) if latest is not None else None
+            payload = self._delta_payload(number, latest, manifest, changes)
+            info = BackupVersion(
+                version=number,
+                id=content_id,
+                time=datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                revision=revision,
+                counts={kind: len(items) for kind, items in manifest['entities'].items()},
+            )
+            path, other = self._manifest_path(number), self._delta_path(number)
+            if payload is None:
+                payload = _dumps(manifest)
+            else:
+                path, other = other, path
+            _write_atomic(path, gzip.compress(payload, compresslevel=6, mtime=0))
+            # Left over from a version number that never made it into the index
+            other.unlink(missing_ok=True)
+            with open(self._index_path, 'ab') as f:
+                f.write(_dumps(info.to_json()) + b'\n')
+            self._index_key = self._index_stat()
+            self._versions.append(info)
+            self._track(latest, changes)
+            self._latest = self._resolved = (number, manifest)
+            self._prune()
+            return info
+
+    @staticmethod
+    def _changes(old: Dict[str, Any], new: Dict[str, Any]) -> Optional[Dict[str, List[list]]]:
+        """Kind -> splices from manifest `old` to `new`; None if the kinds differ."""
+        if old['entities'].keys() != new['entities'].keys():
+            return None
+        changes = {}
+        for kind, items in new['entities'].items():
+            before = old['entities'][kind]
+            if items is not before:
+                runs = _splices(before, items)
+                if runs:
+                    changes[kind] = runs
+        return changes
+
+    @staticmethod
+    def _delta_payload(number: int, latest: Optional[Tuple[int, Dict[str, Any]]], manifest: Dict[str, Any],
+                       changes: Optional[Dict[str, List[list]]]) -> Optional[bytes]:
+        """The delta manifest of version `number`, or None if it is written in full."""
+        if changes is None or number % FULL_MANIFEST_EVERY == 0:
+            return None
+        listed = sum(len(run[2]) + 1 for runs in changes.values() for run in runs)
+        if listed > DELTA_MAX_SHARE * sum(len(items) for items in manifest['entities'].values()):
+            return None
+        return _dumps({'base': latest[0], 'skeleton': manifest['skeleton'], 'splices': changes})
+
+    # -- pruning --
+
+    def _track(self, latest: Optional[Tuple[int, Dict[str, Any]]], changes: Optional[Dict[str, List[list]]]) -> None:
+        """Update the object lifetimes for the version just added on top of `latest`."""
+        if self._alive is None:
+            return
+        if changes is None:
+            # Not derived from the previous version; rebuilt on the next prune
+            self._alive = None
+            return
+        for kind, runs in changes.items():
+            before = latest[1]['entities'][kind]
+            for start, stop, _ in runs:
+                for _, digest in before[start:stop]:
+                    count = self._alive[digest] - 1
+                    if count:
+                        self._alive[digest] = count
+                    else:
+                        del self._alive[digest]
+                        self._dead_at[digest] = latest[0]
+        for runs in changes.values():
+            for _, _, items in runs:
+                for _, digest in items:
+                    self._alive[digest] = self._alive.get(digest, 0) + 1
+                    self._dead_at.pop(digest, None)
+
+    def _build_lifetimes(self) -> None:
+        alive: Dict[str, int] = {}
+        dead_at: Dict[str, int] = {}
+        previous = None
+        for v in self._versions:
+            entities = self.read_manifest(v.version)['entities']
+            counts = Counter(digest for items in entities.values() for _, digest in items)
+            for digest in alive:
+                if digest not in counts:
+                    dead_at[digest] = previous
+            for digest in counts:
+                dead_at.pop(digest, None)
+            alive, previous = counts, v.version
+        self._alive, self._dead_at = dict(alive), dead_at
+
+    def _prune(self) -> None:
+        if len(self._versions) <= self.max_versions:
+            return
+        if self._alive is None:
+            self._build_lifetimes()
+        self._versions = self._versions[-self.max_versions:]
+        self._rewrite_index()
+        oldest = self._versions[0].version
+        for digest in [d for d, last in self._dead_at.items() if last < oldest]:
+            del self._dead_at[digest]
+            self._object_path(digest).unlink(missing_ok=True)
+        # Keep the full manifest the oldest retained version is resolved from, and the deltas after it
+        anchor = oldest
+        while anchor > 1 and self._delta_path(anchor).exists():
+            anchor -= 1
+        for entry in os.scandir(self._manifests):
+            number = entry.name.split('.', 1)[0]
+            if number.isdigit() and int(number) < anchor:
+                os.unlink(entry.path)
+
+    # -- reading --
+
+    def _read_json(self, path: Path) -> Any:
+        with open(path, 'rb') as f:
+            return json.loads(gzip.decompress(f.read()))
+
+    def read_manifest(self, version: int) -> Dict[str, Any]:
+        """The full manifest of `version`, with its deltas applied. Raises KeyError if unknown.
+
+        The result may be shared; callers must not modify it.
+        """
+        resolved = self._resolved
+        deltas = []
+        current = version
+        while resolved is None or resolved[0] != current:
+            try:
+                manifest = self._read_json(self._manifest_path(current))
+                break
+            except FileNotFoundError:
+                pass
+            try:
+                delta = self._read_json(self._delta_path(current))
+            except FileNotFoundError:
+                raise KeyError(version)
+            deltas.append(delta)
+            current = delta['base']
+        else:
+            manifest = resolved[1]
+        for delta in reversed(deltas):
+            entities = dict(manifest['entities'])
+            for kind, runs in delta['splices'].items():
+                entities[kind] = _apply_splices(entities[kind], runs)
+            manifest = {'skeleton': delta['skeleton'], 'entities': entities}
+        self._resolved = (version, manifest)
+        return manifest
+
+    def read_object(self, digest: str) -> Any:
+        with open(self._object_path(digest), 'rb') as f:
+            return json.loads(gzip.decompress(f.read()))
+
+    def load(self, version: int) -> Any:
+        """Rebuild the full document of a retained version. Raises KeyError if unknown."""
+        manifest = self.read_manifest(version)
+        doc = dict(manifest['skeleton'])
+        inner = doc['database'] = dict(doc['database']) if manifest['entities'] else doc.get('database')
+        for kind, items in manifest['entities'].items():
+            inner[kind] = [self.read_object(digest) for _, digest in items]
+        return doc
+
+    def diff(self, old: Dict[str, Any], new: Dict[str, Any],
+             resolve: Optional[Callable[[str, str], Any]] = None) -> List[Dict[str, Any]]:
+        """Per-entity changes from manifest `old` to manifest `new`.
+
+        Works on the hashes, so only entries that actually changed are read.
+        `resolve(kind, name)` supplies entries of `new` that may not be stored
+        as objects (the live database).
+        """
+        changes: List[Dict[str, Any]] = []
+        for kind in ENTITY_KINDS:
+            before = {name: digest for name, digest in old['entities'].get(kind, [])}
+            after = {name: digest for name, digest in new['entities'].get(kind, [])}
+            for name, digest in after.items():
+                if before.get(name) != digest:
+                    entry = resolve(kind, name) if resolve else self.read_object(digest)
+                    changes.append({'kind': kind, 'name': name, 'op': 'upsert', 'entry': entry})
+            for name in before:
+                if name not in after:
+                    changes.append({'kind': kind, 'name': name, 'op': 'delete'})
+        return changes
+
+    def disk_usage(self) -> int:
+        total = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                try:
+                    total += os.stat(os.path.join(dirpath, name)).st_size
+                except FileNotFoundError:
+                    pass
+        return total
@@ -0,0 +1,60 @@
+"""Fan-out notification of database revision bumps to streaming clients.
+
+Subscribers do not get their own queues. They all wait on one shared future
+that is resolved whenever a new revision is committed, then read whatever
+they missed from the change log. Publishing is therefore O(1) no matter how
+many idle connections are open, and a slow client can never make the
+server buffer more than the bounded change log already holds.
+"""
+from __future__ import annotations
+import asyncio
+import threading
+from typing import Optional
+
+
+class RevisionBroadcaster:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._future: Optional[asyncio.Future] = None
+        self.subscribers = 0
+
+    def next_event(self) -> asyncio.Future:
+        """Return a future resolved by the next `notify()`.
+
+        Take it *before* checking the change log so a commit that lands in
+        between is not missed.
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._loop is not loop or self._future is None or self._future.done():
+                self._loop = loop
+                self._future = loop.create_future()
+            return self._future
+
+    def _wake(self, future: asyncio.Future) -> None:
+        if not future.done():
+            future.set_result(None)
+
+    def notify(self) -> None:
+        """Wake every waiting subscriber. Safe to call from any thread."""
+        with self._lock:
+            loop, future = self._loop, self._future
+            self._future = None
+        if loop is None or future is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._wake(future)
+        elif not loop.is_closed():
+            loop.call_soon_threadsafe(self._wake, future)
+
+    @staticmethod
+    async def wait(future: asyncio.Future, timeout: float) -> bool:
+        """Wait for `future` from `next_event()`; returns False on timeout."""
+        # asyncio.wait (unlike wait_for) leaves the shared future intact on timeout
+        done, _ = await asyncio.wait({future}, timeout=timeout)
+        return bool(done)
@@ -0,0 +1,119 @@
+"""Monotonic database revision counter and bounded per-entity change log.
+
+Every committed write bumps the revision by one and records which people,
+teams and projects it upserted or deleted. Clients that remember the last
+revision they saw can ask for everything newer (`changes_since`) instead of
+downloading the whole database. Only the most recent `max_entries` changes
+are kept in memory; a client that fell further behind is told to reload.
+"""
+from __future__ import annotations
+import threading
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+import logging
+
+from server.lib.dbmodel import ENTITY_KINDS, EntityIndex
+
+logger = logging.getLogger(__name__)
+
+
+def _entity_list(doc: Any, kind: str) -> Any:
+    inner = doc.get('database') if isinstance(doc, dict) else None
+    return inner.get(kind) if isinstance(inner, dict) else None
+
+
+def diff_entities(old_doc: Any, new_doc: Any, old_index: Optional[EntityIndex] = None,
+                  new_index: Optional[EntityIndex] = None) -> List[Dict[str, Any]]:
+    """Return upsert/delete records for every entity that differs between two documents.
+
+    Lists that copy-on-write updates left shared between the two documents are
+    skipped without looking at their entries.
+    """
+    old_index = old_index or EntityIndex(old_doc if isinstance(old_doc, dict) else {})
+    new_index = new_index or EntityIndex(new_doc if isinstance(new_doc, dict) else {})
+    changes: List[Dict[str, Any]] = []
+    for kind in ENTITY_KINDS:
+        old_list = _entity_list(old_doc, kind)
+        if old_list is not None and old_list is _entity_list(new_doc, kind):
+            continue
+        old_names = old_index.positions.get(kind, {})
+        new_names = new_index.positions.get(kind, {})
+        for name in new_names:
+            entry = new_index.get(kind, name)
+            prev = old_index.get(kind, name) if name in old_names else None
+            # Entries shared by copy-on-write updates compare by identity first
+            if prev is entry or (prev is not None and prev == entry):
+                continue
+            changes.append({'kind': kind, 'name': name, 'op': 'upsert', 'entry': entry})
+        for name in old_names:
+            if name not in new_names:
+                changes.append({'kind': kind, 'name': name, 'op': 'delete'})
+    return changes
+
+
+def delta_changes(delta: Dict[str, Any], old_index: EntityIndex) -> List[Dict[str, Any]]:
+    """Return the records of an applied entity delta without comparing whole documents.
+
+    Produces what `diff_entities` would for the same write: upserts that leave
+    an entry as it was are dropped, and a name both deleted and upserted is an
+    upsert.
+    """
+    changes: List[Dict[str, Any]] = []
+    for kind in ENTITY_KINDS:
+        spec = delta.get(kind)
+        if not spec:
+            continue
+        # The last upsert of a name wins, as when the delta was applied
+        upserts = {entry['name']: entry for entry in spec.get('upsert', [])}
+        for name, entry in upserts.items():
+            prev = old_index.get(kind, name)
+            if prev is entry or (prev is not None and prev == entry):
+                continue
+            changes.append({'kind': kind, 'name': name, 'op': 'upsert', 'entry': entry})
+        for name in spec.get('delete', []):
+            if name not in upserts:
+                changes.append({'kind': kind, 'name': name, 'op': 'delete'})
+    return changes
+
+
+class ChangeLog:
+    def __init__(self, revision: int = 0, max_entries: int = 1000) -> None:
+        self._lock = threading.Lock()
+        self.revision = revision
+        # Oldest revision whose changes are still fully retained
+        self.floor = revision
+        self._entries: deque[Tuple[int, Dict[str, Any]]] = deque(maxlen=max_entries)
+
+    def record(self, changes: List[Dict[str, Any]]) -> int:
+        """Bump the revision for one committed write and remember its changes."""
+        with self._lock:
+            self.revision += 1
+            for change in changes:
+                if len(self._entries) == self._entries.maxlen:
+                    self.floor = self._entries[0][0]
+                self._entries.append((self.revision, change))
+            return self.revision
+
+    def reset(self) -> int:
+        """Bump the revision for a change that cannot be described per entity."""
+        with self._lock:
+            self.revision += 1
+            self._entries.clear()
+            self.floor = self.revision
+            return self.revision
+
+    def advance(self, revision: int) -> int:
+        """Jump to `revision`, committed elsewhere, whose changes are not known here."""
+        with self._lock:
+            if revision > self.revision:
+                self.revision = revision
+                self._entries.clear()
+                self.floor = revision
+            return self.revision
+
+    def changes_since(self, since: int) -> Optional[List[Dict[str, Any]]]:
+        """Return changes committed after revision `since`, or None if they are no longer retained."""
+        with self._lock:
+            if since > self.revision or since < self.floor:
+                return None
+            return [dict(change, revision=rev) for rev, change in self._entries if rev > since]
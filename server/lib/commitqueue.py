@@ -0,0 +1,108 @@
+"""Single-consumer queue that applies writes in order and in batches.
+
+Request handlers `submit()` a write and wait for its outcome. One worker
+task takes everything queued so far (up to `max_batch` items) and hands it
+to `apply_batch`, which returns one outcome per item: its result, or an
+exception to raise in the submitting handler. Writes that arrive while a
+batch is being persisted form the next batch, so a burst of concurrent
+writes costs one persist per batch instead of one per write, and a lone
+write is never delayed waiting for company.
+
+The queue and its worker belong to the event loop of the first `submit()`;
+if it is later used from another loop (test clients that run each request
+on a fresh loop), a new worker is started there.
+"""
+from __future__ import annotations
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, List, Optional, Sequence
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class _Pending:
+    __slots__ = ('item', 'future', 'enqueued')
+
+    def __init__(self, item: Any, future: asyncio.Future) -> None:
+        self.item = item
+        self.future = future
+        self.enqueued = time.perf_counter()
+
+
+class CommitQueue:
+    def __init__(self, apply_batch: Callable[[Sequence[Any]], Awaitable[List[Any]]], max_batch: int = 64,
+                 latency=None, batch_size=None) -> None:
+        self._apply_batch = apply_batch
+        self.max_batch = max(1, max_batch)
+        # Optional metrics: seconds from submit to outcome per write, writes per batch
+        self._latency = latency
+        self._batch_size = batch_size
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _ensure_worker(self) -> asyncio.Queue:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._task is None or self._task.done():
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._task = loop.create_task(self._run(self._queue))
+        return self._queue
+
+    async def submit(self, item: Any) -> Any:
+        """Queue `item` and return its result once its batch was applied."""
+        queue = self._ensure_worker()
+        pending = _Pending(item, asyncio.get_running_loop().create_future())
+        queue.put_nowait(pending)
+        return await pending.future
+
+    async def _run(self, queue: asyncio.Queue) -> None:
+        while True:
+            first = await queue.get()
+            if first is None:
+                return
+            batch: List[_Pending] = [first]
+            stop = False
+            while len(batch) < self.max_batch and not queue.empty():
+                nxt = queue.get_nowait()
+                if nxt is None:
+                    stop = True
+                    break
+                batch.append(nxt)
+            # Handlers that went away before their turn are not applied
+            batch = [p for p in batch if not p.future.done()]
+            if batch:
+                await self._apply(batch)
+            if stop:
+                return
+
+    async def _apply(self, batch: List[_Pending]) -> None:
+        try:
+            outcomes = await self._apply_batch([p.item for p in batch])
+        except Exception as e:
+            logger.exception('Failed to apply a batch of %d writes', len(batch))
+            outcomes = [e] * len(batch)
+        if self._batch_size is not None:
+            self._batch_size.observe(len(batch))
+        now = time.perf_counter()
+        for pending, outcome in zip(batch, outcomes):
+            if self._latency is not None:
+                self._latency.observe(now - pending.enqueued)
+            if pending.future.done():
+                continue
+            if isinstance(outcome, BaseException):
+                pending.future.set_exception(outcome)
+            else:
+                pending.future.set_result(outcome)
+
+    async def close(self) -> None:
+        """Apply what is queued, then stop the worker."""
+        if self._task is None or self._task.done() or self._loop is not asyncio.get_running_loop():
+            return
+        self._queue.put_nowait(None)
+        await self._task
@@ -1,5 +1,12 @@
 from __future__ import annotations
-from typing import Any, Dict, List, Tuple
+import re
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple
+
+# A field check returns None if the value is fine, else (message, sub-path below the field)
+FieldError = Tuple[str, Tuple[str, ...]]
+FieldCheck = Callable[[Any], Optional[FieldError]]
+# An entry check returns None if the entry is fine, else (message, path below the entry)
+EntryCheck = Callable[[Any], Optional[FieldError]]
 
 
 class ValidationError(Exception):
@@ -8,11 +15,23 @@ class ValidationError(Exception):
         self.path = path or ()
 
 
+class ValidationErrors(ValidationError):
+    """All problems found by `validate_database(..., collect=True)`, in document order."""
+
+    def __init__(self, errors: List[ValidationError]):
+        super().__init__('%d validation error%s' % (len(errors), '' if len(errors) == 1 else 's'),
+                         path=errors[0].path if errors else None)
+        self.errors = errors
+
+
 def _is_mapping(obj: Any) -> bool:
     return isinstance(obj, dict)
 
 
-def validate_database(db: Any) -> None:
+def validate_database(db: Any, baseline: Optional['ValidationBaseline'] = None,
+                      changed: Optional[Mapping[str, Iterable[str]]] = None,
+                      references: bool = True, collect: bool = False,
+                      previous: Any = None, previous_positions: Optional[Mapping[str, Mapping[str, int]]] = None) -> None:
     """Strict schema validation for the YAML database.
 
     Expected layout:
@@ -22,8 +41,61 @@ def validate_database(db: Any) -> None:
       teams: [ {name, product_owner, functional_manager}, ... ]
       projects: [ {name, project_lead}, ... ]
 
-    Raises ValidationError on failure.
+    With `baseline`, entries equal to the baseline's entry of the same name
+    are known to be valid and skipped. With `changed` ({kind: names}), only
+    the named entries are checked; the caller vouches for the rest. Unless
+    `references` is false, the whole document is then checked for dangling
+    references, duplicate names and team hierarchy cycles (see
+    `iter_integrity_errors`). With `previous`, the stored document `db`
+    replaces, only the problems `db` adds to it are reported (see
+    `iter_new_integrity_errors`); `previous_positions` is its name index.
+
+    Raises ValidationError on the first failure, or with `collect` a
+    ValidationErrors listing every failure.
     """
+    errors = _iter_errors(db, baseline, changed, references, previous, previous_positions)
+    if collect:
+        found = list(errors)
+        if found:
+            raise ValidationErrors(found)
+        return
+    for error in errors:
+        raise error
+
+
+def _iter_errors(db: Any, baseline: Optional['ValidationBaseline'],
+                 changed: Optional[Mapping[str, Iterable[str]]], references: bool, previous: Any = None,
+                 previous_positions: Optional[Mapping[str, Mapping[str, int]]] = None) -> Iterator[ValidationError]:
+    try:
+        validate_header(db)
+    except ValidationError as e:
+        yield e
+        return
+
+    inner = db['database']
+    for kind, check in _ENTRY_CHECKS:
+        entries = inner.get(kind, [])
+        if changed is not None:
+            names = set(changed.get(kind, ()))
+            if not names:
+                continue
+        for idx, entry in enumerate(entries):
+            if changed is not None and not (_is_mapping(entry) and entry.get('name') in names):
+                continue
+            if baseline is not None and baseline.validated(kind, entry):
+                continue
+            error = check(entry)
+            if error is not None:
+                yield ValidationError(error[0], path=('database', kind, str(idx)) + error[1])
+    if references:
+        if previous is not None:
+            yield from iter_new_integrity_errors(previous, db, previous_positions)
+        else:
+            yield from iter_integrity_errors(db)
+
+
+def validate_header(db: Any) -> None:
+    """Validate the document layout (version and entity lists) but not the entries."""
     if not _is_mapping(db):
         raise ValidationError('Document must be a mapping/dictionary', path=())
 
@@ -49,98 +121,438 @@ def validate_database(db: Any) -> None:
     if not isinstance(projects, list):
         raise ValidationError("'projects' must be a list", path=('database','projects'))
 
-    # Validation helpers
-    from datetime import datetime
-    def _check_str(val, path):
-        if not isinstance(val, str):
-            raise ValidationError('must be a string', path=path)
-
-    def _check_bool(val, path):
-        if not isinstance(val, bool):
-            raise ValidationError('must be a boolean', path=path)
-
-    def _check_int(val, path):
-        if not isinstance(val, int):
-            raise ValidationError('must be an integer', path=path)
-
-    def _check_date_or_empty(val, path):
-        if val == '' or val is None:
-            return
-        if not isinstance(val, str):
-            raise ValidationError('birthday must be an ISO date string or empty', path=path)
-        try:
-            datetime.strptime(val, '%Y-%m-%d')
-        except Exception:
-            raise ValidationError('birthday must be ISO date yyyy-mm-dd or empty', path=path)
-
-    def _check_list_of_str(val, path):
-        if not isinstance(val, list):
-            raise ValidationError('must be a list', path=path)
-        for i, item in enumerate(val):
-            if not isinstance(item, str):
-                raise ValidationError('list items must be strings', path=path + (str(i),))
-
-    # Validate people entries
+
+# Field checks
+def _check_str(val) -> Optional[FieldError]:
+    if not isinstance(val, str):
+        return 'must be a string', ()
+    return None
+
+
+def _check_bool(val) -> Optional[FieldError]:
+    if not isinstance(val, bool):
+        return 'must be a boolean', ()
+    return None
+
+
+def _check_int(val) -> Optional[FieldError]:
+    if not isinstance(val, int):
+        return 'must be an integer', ()
+    return None
+
+
+# The dates `datetime.strptime(val, '%Y-%m-%d')` accepts (ASCII digits only), without its per-call overhead
+_DATE_RE = re.compile(r'([0-9]{4})-([0-9]{1,2})-([0-9]{1,2})\Z')
+_MONTH_DAYS = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+
+def is_iso_date(val: str) -> bool:
+    m = _DATE_RE.match(val)
+    if m is None:
+        return False
+    year, month, day = int(m.group(1)), int(m.group(2)), int(m.group(3))
+    if year < 1 or not 1 <= month <= 12 or day < 1:
+        return False
+    if month == 2 and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0):
+        return day <= 29
+    return day <= _MONTH_DAYS[month - 1]
+
+
+def _check_date_or_empty(val) -> Optional[FieldError]:
+    if val == '' or val is None:
+        return None
+    if not isinstance(val, str):
+        return 'birthday must be an ISO date string or empty', ()
+    if not is_iso_date(val):
+        return 'birthday must be ISO date yyyy-mm-dd or empty', ()
+    return None
+
+
+def _check_list_of_str(val) -> Optional[FieldError]:
+    if not isinstance(val, list):
+        return 'must be a list', ()
+    for i, item in enumerate(val):
+        if not isinstance(item, str):
+            return 'list items must be strings', (str(i),)
+    return None
+
+
+# Schema: checked fields per entity kind, in reporting order. `name` is
+# required for every kind; the other fields are optional.
+PERSON_FIELDS: Tuple[Tuple[str, FieldCheck], ...] = (
+    ('name', _check_str),
+    ('birthday', _check_date_or_empty),
+    ('title', _check_str),
+    ('external', _check_bool),
+    ('team_name', _check_str),
+    ('virtual_team', _check_list_of_str),
+    ('legal_manager', _check_str),
+    ('functional_manager', _check_str),
+    ('carry_over_holidays', _check_int),
+    ('site', _check_str),
+)
+TEAM_FIELDS: Tuple[Tuple[str, FieldCheck], ...] = (
+    ('name', _check_str),
+    ('short_name', _check_str),
+    ('product_owner', _check_str),
+    ('functional_manager', _check_str),
+    # Optional parent_team field for nested team relationships
+    ('parent_team', _check_str),
+)
+PROJECT_FIELDS: Tuple[Tuple[str, FieldCheck], ...] = (
+    ('name', _check_str),
+    ('project_lead', _check_str),
+)
+
+
+def _compile_entry_check(label: str, fields: Tuple[Tuple[str, FieldCheck], ...]) -> EntryCheck:
+    """Build the check for one entity kind; done once at import time."""
+    not_mapping = ('%s entry must be a mapping' % label, ())
+    no_name = ('%s.name is required' % label, ('name',))
+
+    def check(entry: Any) -> Optional[FieldError]:
+        if not isinstance(entry, dict):
+            return not_mapping
+        if 'name' not in entry:
+            return no_name
+        for field, field_check in fields:
+            if field in entry:
+                error = field_check(entry[field])
+                if error is not None:
+                    return error[0], (field,) + error[1]
+        return None
+
+    return check
+
+
+check_person = _compile_entry_check('person', PERSON_FIELDS)
+check_team = _compile_entry_check('team', TEAM_FIELDS)
+check_project = _compile_entry_check('project', PROJECT_FIELDS)
+
+_ENTRY_CHECKS: Tuple[Tuple[str, EntryCheck], ...] = (
+    ('people', check_person),
+    ('teams', check_team),
+    ('projects', check_project),
+)
+
+
+# Fields where an equal value can still have the wrong type (True == 1 == 1.0)
+_EXACT_TYPE_FIELDS: Dict[str, Tuple[str, ...]] = {
+    kind: tuple(field for field, field_check in fields if field_check in (_check_bool, _check_int))
+    for kind, fields in (('people', PERSON_FIELDS), ('teams', TEAM_FIELDS), ('projects', PROJECT_FIELDS))
+}
+
+
+def _raise_at(error: Optional[FieldError], path: Tuple[str, ...]) -> None:
+    if error is not None:
+        raise ValidationError(error[0], path=path + error[1])
+
+
+def validate_person(person: Any, ppath: Tuple[str, ...]) -> None:
+    """Validate a single entry of `database.people` located at `ppath`."""
+    _raise_at(check_person(person), ppath)
+
+
+def validate_team(team: Any, tpath: Tuple[str, ...]) -> None:
+    """Validate a single entry of `database.teams` located at `tpath`."""
+    _raise_at(check_team(team), tpath)
+
+
+def validate_project(proj: Any, ppath: Tuple[str, ...]) -> None:
+    """Validate a single entry of `database.projects` located at `ppath`."""
+    _raise_at(check_project(proj), ppath)
+
+
+ENTITY_VALIDATORS = {
+    'people': validate_person,
+    'teams': validate_team,
+    'projects': validate_project,
+}
+
+
+def validate_entity(kind: str, entry: Any, path: Tuple[str, ...]) -> None:
+    """Validate one people/teams/projects entry without touching the rest of the document."""
+    try:
+        validator = ENTITY_VALIDATORS[kind]
+    except KeyError:
+        raise ValidationError('unknown entity kind: %s' % kind, path=('database', kind))
+    validator(entry, path)
+
+
+class ValidationBaseline:
+    """The entries of a document that passed `validate_database`, by kind and name.
+
+    Passing it to a later `validate_database` call skips every entry that is
+    the same object as, or equal to, the baseline entry of the same name, so
+    re-validating a full upload costs a dict comparison per unchanged entry.
+    """
+
+    def __init__(self, db: Any) -> None:
+        inner = db['database']
+        self._entries: Dict[str, Dict[Any, Any]] = {
+            kind: {e.get('name'): e for e in inner.get(kind) or () if _is_mapping(e)}
+            for kind, _ in _ENTRY_CHECKS
+        }
+
+    def validated(self, kind: str, entry: Any) -> bool:
+        if not _is_mapping(entry):
+            return False
+        known = self._entries[kind].get(entry.get('name'))
+        if known is None:
+            return False
+        if known is entry:
+            return True
+        if known != entry:
+            return False
+        for field in _EXACT_TYPE_FIELDS[kind]:
+            if field in entry and type(entry[field]) is not type(known[field]):
+                return False
+        return True
+
+
+# Referential integrity: (person field, kind of entity it names)
+PERSON_REFERENCES: Tuple[Tuple[str, str], ...] = (
+    ('team_name', 'teams'),
+    ('legal_manager', 'people'),
+    ('functional_manager', 'people'),
+)
+
+
+def _name_index(kind: str, label: str, entries: List[Any], errors: List[ValidationError]) -> Dict[str, int]:
+    """Map each name of `entries` to its first position, reporting duplicates."""
+    index: Dict[str, int] = {}
+    for idx, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            continue
+        name = entry.get('name')
+        if not isinstance(name, str):
+            continue
+        first = index.setdefault(name, idx)
+        if first != idx:
+            errors.append(ValidationError("duplicate %s name '%s' (first at %s/%d)" % (label, name, kind, first),
+                                          path=('database', kind, str(idx), 'name')))
+    return index
+
+
+def iter_integrity_errors(db: Any) -> Iterator[ValidationError]:
+    """Yield every broken cross-reference of a document whose layout is valid.
+
+    Checks that names are unique per kind, that a person's `team_name` and
+    `virtual_team` entries name existing teams and their `legal_manager` and
+    `functional_manager` existing people, and that every `parent_team`
+    exists and the team hierarchy has no cycles. Empty references are
+    allowed. One pass per list over name -> position hash indexes.
+    """
+    inner = db['database']
+    people = inner.get('people') or []
+    teams = inner.get('teams') or []
+    errors: List[ValidationError] = []
+    indexes = {
+        'people': _name_index('people', 'person', people, errors),
+        'teams': _name_index('teams', 'team', teams, errors),
+    }
+    _name_index('projects', 'project', inner.get('projects') or [], errors)
+    yield from errors
+
+    team_index = indexes['teams']
     for idx, person in enumerate(people):
-        ppath = ('database','people',str(idx))
-        if not _is_mapping(person):
-            raise ValidationError('person entry must be a mapping', path=ppath)
-        # name
-        if 'name' not in person:
-            raise ValidationError('person.name is required', path=ppath+('name',))
-        _check_str(person.get('name'), ppath+('name',))
-        # birthday
-        _check_date_or_empty(person.get('birthday',''), ppath+('birthday',))
-        # title
-        if 'title' in person:
-            _check_str(person.get('title'), ppath+('title',))
-        # external
-        if 'external' in person:
-            _check_bool(person.get('external'), ppath+('external',))
-        # team_name
-        if 'team_name' in person:
-            _check_str(person.get('team_name'), ppath+('team_name',))
-        # virtual_team
-        if 'virtual_team' in person:
-            _check_list_of_str(person.get('virtual_team'), ppath+('virtual_team',))
-        # legal_manager
-        if 'legal_manager' in person:
-            _check_str(person.get('legal_manager'), ppath+('legal_manager',))
-        # functional_manager
-        if 'functional_manager' in person:
-            _check_str(person.get('functional_manager'), ppath+('functional_manager',))
-        # carry_over_holidays
-        if 'carry_over_holidays' in person:
-            _check_int(person.get('carry_over_holidays'), ppath+('carry_over_holidays',))
-        # site
-        if 'site' in person:
-            _check_str(person.get('site'), ppath+('site',))
-
-    # Validate teams
+        for kind, ref, sub in _dangling_references(person, indexes):
+            yield _unknown_reference(kind, ref, idx, sub)
+
+    # parent_team links, by team position; unknown parents are reported and dropped
+    parents: Dict[int, int] = {}
     for idx, team in enumerate(teams):
-        tpath = ('database','teams',str(idx))
-        if not _is_mapping(team):
-            raise ValidationError('team entry must be a mapping', path=tpath)
-        if 'name' not in team:
-            raise ValidationError('team.name is required', path=tpath+('name',))
-        _check_str(team.get('name'), tpath+('name',))
-        if 'short_name' in team:
-            _check_str(team.get('short_name'), tpath+('short_name',))
-        if 'product_owner' in team:
-            _check_str(team.get('product_owner'), tpath+('product_owner',))
-        if 'functional_manager' in team:
-            _check_str(team.get('functional_manager'), tpath+('functional_manager',))
-        # Optional parent_team field for nested team relationships
-        if 'parent_team' in team:
-            _check_str(team.get('parent_team'), tpath+('parent_team',))
-
-    # Validate projects
-    for idx, proj in enumerate(projects):
-        ppath = ('database','projects',str(idx))
-        if not _is_mapping(proj):
-            raise ValidationError('project entry must be a mapping', path=ppath)
-        if 'name' not in proj:
-            raise ValidationError('project.name is required', path=ppath+('name',))
-        _check_str(proj.get('name'), ppath+('name',))
-        if 'project_lead' in proj:
-            _check_str(proj.get('project_lead'), ppath+('project_lead',))
+        if not isinstance(team, dict):
+            continue
+        ref = team.get('parent_team')
+        if not ref or not isinstance(ref, str):
+            continue
+        parent = team_index.get(ref)
+        if parent is None:
+            yield _unknown_parent(ref, idx)
+        else:
+            parents[idx] = parent
+
+    # Walk up from every team; each team is visited once overall, so this is linear
+    state: Dict[int, int] = {}  # 1 = on the current walk, 2 = known to reach a root
+    for start in parents:
+        walk = []
+        node: Optional[int] = start
+        while node is not None and node not in state:
+            state[node] = 1
+            walk.append(node)
+            node = parents.get(node)
+        if node is not None and state[node] == 1:
+            cycle = walk[walk.index(node):]
+            names = [str(teams[i].get('name')) for i in cycle + [node]]
+            yield ValidationError('team hierarchy cycle: %s' % ' -> '.join(names),
+                                  path=('database', 'teams', str(min(cycle)), 'parent_team'))
+        for visited in walk:
+            state[visited] = 2
+
+
+_LABELS = {'people': 'person', 'teams': 'team', 'projects': 'project'}
+
+
+def _dangling_references(person: Any, indexes: Mapping[str, Mapping[str, int]]) -> Iterator[Tuple[str, str, Tuple[str, ...]]]:
+    """(target kind, name, path below the person) of every reference `indexes` cannot resolve."""
+    if not isinstance(person, dict):
+        return
+    for field, kind in PERSON_REFERENCES:
+        ref = person.get(field)
+        # Hashable (str) refs only; non-strings were reported by the schema check
+        if ref and isinstance(ref, str) and ref not in indexes[kind]:
+            yield kind, ref, (field,)
+    virtual = person.get('virtual_team')
+    if virtual and isinstance(virtual, list):
+        for i, ref in enumerate(virtual):
+            if ref and isinstance(ref, str) and ref not in indexes['teams']:
+                yield 'teams', ref, ('virtual_team', str(i))
+
+
+def _unknown_reference(kind: str, ref: str, idx: int, sub: Tuple[str, ...]) -> ValidationError:
+    return ValidationError("unknown %s '%s'" % (_LABELS[kind], ref), path=('database', 'people', str(idx)) + sub)
+
+
+def _unknown_parent(ref: str, idx: int) -> ValidationError:
+    return ValidationError("unknown team '%s'" % ref, path=('database', 'teams', str(idx), 'parent_team'))
+
+
+def _duplicate_names(kind: str, entries: List[Any], cache: Dict[str, set]) -> set:
+    """Names occurring more than once in `entries`, computed once per kind (only when needed)."""
+    if kind not in cache:
+        seen: set = set()
+        duplicates = cache[kind] = set()
+        for entry in entries:
+            name = entry.get('name') if isinstance(entry, dict) else None
+            if isinstance(name, str):
+                if name in seen:
+                    duplicates.add(name)
+                seen.add(name)
+    return cache[kind]
+
+
+def _positions(entries: List[Any]) -> Dict[str, int]:
+    return {e['name']: i for i, e in enumerate(entries) if isinstance(e, dict) and isinstance(e.get('name'), str)}
+
+
+def iter_new_integrity_errors(before: Any, after: Any, positions: Optional[Mapping[str, Mapping[str, int]]] = None,
+                              tracked: Optional[Mapping[str, Tuple[Mapping[str, int], Mapping[int, Any], Any]]] = None
+                              ) -> Iterator[ValidationError]:
+    """Yield the integrity problems `after` has and `before` did not.
+
+    Stored data may already contain dangling references (e.g. managers
+    exported from another system who are not in `people`); a write is only
+    rejected for the ones it introduces. Only entries that differ from the
+    entry of the same name in `before` are checked, plus entries still
+    naming a person or team that `after` removed, and the team hierarchy
+    above changed teams. Lists `after` shares with `before` are not scanned
+    at all. `positions` ({kind: {name: position}}, e.g. `EntityIndex.positions`
+    of `before`) saves rebuilding the name index of `before`. `tracked` gives,
+    for kinds whose changes the caller already knows (an entity delta), the
+    name index of `after`, {position: entry in `before` or None} of the
+    upserted entries and the removed names; those lists are not scanned either.
+    """
+    inner_after = after['database']
+    inner_before = before.get('database') if isinstance(before, dict) else None
+    if not isinstance(inner_before, dict):
+        yield from iter_integrity_errors(after)
+        return
+    if positions is None:
+        positions = {kind: _positions(inner_before.get(kind) or []) for kind, _ in _ENTRY_CHECKS}
+
+    indexes: Dict[str, Mapping[str, int]] = {}
+    # Per kind: (position, entry in `before` or None) of every added or changed entry
+    changed: Dict[str, List[Tuple[int, Any]]] = {}
+    removed: Dict[str, Any] = {}
+    duplicates: List[ValidationError] = []
+    for kind, _ in _ENTRY_CHECKS:
+        entries = inner_after.get(kind) or []
+        old_entries = inner_before.get(kind) or []
+        old_positions = positions.get(kind, {})
+        if entries is old_entries:
+            indexes[kind], changed[kind], removed[kind] = old_positions, [], ()
+            continue
+        if tracked is not None and kind in tracked:
+            # Upserts by name replace entries, so they add no duplicates
+            indexes[kind], upserted, removed[kind] = tracked[kind]
+            changed[kind] = sorted(upserted.items())
+            continue
+        index: Dict[str, int] = {}
+        fresh: List[Tuple[int, Any]] = []
+        old_dups: Dict[str, set] = {}
+        for idx, entry in enumerate(entries):
+            if not isinstance(entry, dict):
+                continue
+            name = entry.get('name')
+            pos = old_positions.get(name) if isinstance(name, str) else None
+            old = old_entries[pos] if pos is not None and pos < len(old_entries) else None
+            if old is not entry and old != entry:
+                fresh.append((idx, old))
+            if not isinstance(name, str):
+                continue
+            first = index.setdefault(name, idx)
+            if first != idx and name not in _duplicate_names(kind, old_entries, old_dups):
+                duplicates.append(ValidationError(
+                    "duplicate %s name '%s' (first at %s/%d)" % (_LABELS[kind], name, kind, first),
+                    path=('database', kind, str(idx), 'name')))
+        indexes[kind], changed[kind] = index, fresh
+        removed[kind] = {name for name in old_positions if name not in index}
+    yield from duplicates
+
+    people = inner_after.get('people') or []
+    for idx, old in changed['people']:
+        # References the previous version had and that did not resolve then either are not new
+        known = {(kind, ref) for kind, ref, _ in _dangling_references(old, positions)} if old is not None else ()
+        for kind, ref, sub in _dangling_references(people[idx], indexes):
+            if (kind, ref) not in known:
+                yield _unknown_reference(kind, ref, idx, sub)
+    if removed['people'] or removed['teams']:
+        # Unchanged people are only affected by names that went away
+        fresh_people = {idx for idx, _ in changed['people']}
+        for idx, person in enumerate(people):
+            if idx in fresh_people:
+                continue
+            for kind, ref, sub in _dangling_references(person, indexes):
+                if ref in removed[kind]:
+                    yield _unknown_reference(kind, ref, idx, sub)
+
+    teams = inner_after.get('teams') or []
+    team_index = indexes['teams']
+    old_teams = dict(changed['teams'])
+    # Likewise, unchanged teams are only affected by parents that went away
+    for idx in range(len(teams)) if removed['teams'] else old_teams:
+        team = teams[idx]
+        ref = team.get('parent_team') if isinstance(team, dict) else None
+        if not ref or not isinstance(ref, str) or ref in team_index:
+            continue
+        old = old_teams.get(idx)
+        if idx not in old_teams or (old is not None and old.get('parent_team') == ref):
+            # Only new if the parent was there before
+            if ref in removed['teams']:
+                yield _unknown_parent(ref, idx)
+        else:
+            yield _unknown_parent(ref, idx)
+
+    # A new cycle runs through a team whose parent_team was set or changed.
+    # As in iter_integrity_errors each team is walked once overall; a walk
+    # that meets an earlier one stops there, so a cycle is found (and
+    # reported) by the first walk that reaches it.
+    state: Dict[int, int] = {}  # 1 = on the current walk, 2 = walked before
+    for start in old_teams:
+        walk: List[int] = []
+        node: Optional[int] = start
+        while node is not None and node not in state:
+            state[node] = 1
+            walk.append(node)
+            team = teams[node]
+            ref = team.get('parent_team') if isinstance(team, dict) else None
+            node = team_index.get(ref) if ref and isinstance(ref, str) else None
+        if node is not None and state[node] == 1:
+            cycle = walk[walk.index(node):]
+            if any(i in old_teams for i in cycle):
+                names = [str(teams[i].get('name')) for i in cycle + [node]]
+                yield ValidationError('team hierarchy cycle: %s' % ' -> '.join(names),
+                                      path=('database', 'teams', str(min(cycle)), 'parent_team'))
+        for visited in walk:
+            state[visited] = 2
@@ -0,0 +1,318 @@
+"""Process-wide cache of the parsed team database.
+
+The cache keeps the parsed YAML document together with the pre-serialized
+JSON body returned by `GET /api/teamdb`. Entries are keyed on the
+(inode, size, mtime_ns) of the database file, so serving a cached read only
+costs a single `stat()`. Writers call `update()` after committing so the
+next read does not have to re-parse what was just written. Files the
+document also depends on (the write-ahead journal) can be passed as
+`extra_paths`; their identities are appended to the key. A document kept
+outside the file system supplies its own identity through `key_func`.
+
+Each snapshot also carries a strong ETag derived from the body hash and
+gzip/brotli encodings prepared once per snapshot, so conditional and
+compressed GETs never redo that work per request. None of these are built
+when a commit creates the snapshot: the body and ETag are rendered on first
+use, and each encoding is compressed on demand (the service does so in the
+background on the first request that asks for it and serves the identity
+body until it is ready), so writers never wait for them.
+"""
+from __future__ import annotations
+import gzip
+import hashlib
+import json
+import os
+import threading
+from dataclasses import dataclass, field
+from functools import cached_property
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+import logging
+
+from server.lib.dbmodel import EntityIndex
+from server.lib.lazy import available, optional
+
+logger = logging.getLogger(__name__)
+
+
+StatKey = Tuple[int, ...]
+
+# Content-codings offered for the body, most preferred first. brotli is
+# optional (only gzip is offered without it) and imported on first use.
+CODINGS: Tuple[str, ...] = ('br', 'gzip') if available('brotli') else ('gzip',)
+# Most of the size reduction of the maximum levels at a fraction of the CPU time
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def stat_key(path: str | Path) -> Optional[StatKey]:
+    """Return the (inode, size, mtime_ns) identity of `path`, or None if missing."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def format_mtime(mtime_ns: int) -> str:
+    return datetime.utcfromtimestamp(mtime_ns / 1e9).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def render_body(data: Any, last_modified: Optional[str]) -> bytes:
+    """Serialize the GET response document exactly like `JSONResponse` would."""
+    # If the on-disk YAML already contains a top-level 'database' key,
+    # return that document as-is (with last_modified) to avoid double-wrapping
+    if isinstance(data, dict) and 'database' in data:
+        content = dict(data)
+        content['last_modified'] = last_modified
+    else:
+        content = {'database': data, 'last_modified': last_modified}
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(',', ':')).encode('utf-8')
+
+
+def compute_etag(body: bytes) -> str:
+    return '"%s"' % hashlib.sha256(body).hexdigest()[:32]
+
+
+def encode_body(body: bytes, coding: str) -> bytes:
+    """Return `body` in the content-coding `coding` ('gzip' or 'br')."""
+    if coding == 'gzip':
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    brotli = optional('brotli') if coding == 'br' else None
+    if brotli is not None:
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    raise ValueError(f'Unsupported content-coding {coding!r}')
+
+
+def parse_accept_encoding(header: Optional[str]) -> Dict[str, float]:
+    """Parse an Accept-Encoding header into a {coding: qvalue} mapping."""
+    result: Dict[str, float] = {}
+    if not header:
+        return result
+    for part in header.split(','):
+        item = part.strip()
+        if not item:
+            continue
+        coding, _, params = item.partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        result[coding.strip().lower()] = q
+    return result
+
+
+def etag_matches(header: Optional[str], etags: Iterable[str], weak: bool = True) -> bool:
+    """Return True if any entity tag in an If-None-Match/If-Match header matches `etags`.
+
+    If-None-Match uses weak comparison; pass `weak=False` for If-Match.
+    """
+    if not header:
+        return False
+    candidates = set(etags)
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag == '*':
+            return True
+        if tag.startswith('W/'):
+            if not weak:
+                continue
+            tag = tag[2:]
+        if tag in candidates:
+            return True
+    return False
+
+
+def _best_coding(accepted: Dict[str, float], codings: Iterable[str]) -> Optional[str]:
+    best = None
+    best_q = 0.0
+    # Prefer brotli over gzip when the client weighs them equally
+    for coding in codings:
+        q = accepted.get(coding, accepted.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    key: StatKey
+    data: Any
+    last_modified: str
+    # Content-coded variants of the body built so far, see encode()
+    encodings: Dict[str, bytes] = field(default_factory=dict, compare=False)
+    _claimed: set = field(default_factory=set, repr=False, compare=False)
+    _claim_lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+    _encode_lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+    # Index handed over by the write that produced `data`, if it had one
+    _index: Optional[EntityIndex] = field(default=None, repr=False, compare=False)
+
+    @cached_property
+    def index(self) -> EntityIndex:
+        """Name-keyed lookup over the entities of this snapshot, built on first use."""
+        return self._index if self._index is not None else EntityIndex(self.data)
+
+    @cached_property
+    def body(self) -> bytes:
+        return render_body(self.data, self.last_modified)
+
+    @cached_property
+    def etag(self) -> str:
+        return compute_etag(self.body)
+
+    @property
+    def rendered(self) -> bool:
+        """Whether `body` and `etag` are built, i.e. using them is cheap."""
+        return 'etag' in self.__dict__
+
+    def render(self) -> 'Snapshot':
+        """Build `body` and `etag` now; call this off the event loop."""
+        self.etag
+        return self
+
+    def encode(self, coding: str) -> bytes:
+        """Return the body in `coding`, compressing it on the first call."""
+        encoded = self.encodings.get(coding)
+        if encoded is None:
+            with self._encode_lock:
+                encoded = self.encodings.get(coding)
+                if encoded is None:
+                    encoded = self.encodings[coding] = encode_body(self.body, coding)
+        return encoded
+
+    def claim(self, coding: str) -> bool:
+        """True for the first caller asking for `coding`, which should then encode() it."""
+        with self._claim_lock:
+            if coding in self.encodings or coding in self._claimed:
+                return False
+            self._claimed.add(coding)
+            return True
+
+    def etag_for(self, coding: Optional[str]) -> str:
+        # Each content-coding is a different representation, so it gets its own strong tag
+        if not coding:
+            return self.etag
+        return '"%s-%s"' % (self.etag.strip('"'), coding)
+
+    def all_etags(self) -> List[str]:
+        return [self.etag] + [self.etag_for(c) for c in CODINGS]
+
+    def preferred(self, accept_encoding: Optional[str]) -> Optional[str]:
+        """The coding the client's Accept-Encoding asks for, whether it is prepared or not."""
+        return _best_coding(parse_accept_encoding(accept_encoding), CODINGS)
+
+    def negotiate(self, accept_encoding: Optional[str]) -> Tuple[Optional[str], bytes]:
+        """Pick the best prepared encoding for the client's Accept-Encoding."""
+        encodings = self.encodings
+        best = _best_coding(parse_accept_encoding(accept_encoding), [c for c in CODINGS if c in encodings])
+        if best is None:
+            return None, self.body
+        return best, encodings[best]
+
+
+class DatabaseCache:
+    def __init__(self, path: str | Path, loader: Callable[[Path], Any], extra_paths: Iterable[str | Path] = (),
+                 key_func: Optional[Callable[[], Optional[StatKey]]] = None) -> None:
+        self.path = Path(path)
+        self.extra_paths = [Path(p) for p in extra_paths]
+        # Overrides the file identity for documents that do not live in `path`
+        self._key_func = key_func
+        self._loader = loader
+        self._lock = threading.Lock()
+        self._snapshot: Optional[Snapshot] = None
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self) -> Optional[StatKey]:
+        if self._key_func is not None:
+            return self._key_func()
+        key = stat_key(self.path)
+        if key is None or not self.extra_paths:
+            return key
+        for path in self.extra_paths:
+            # A missing dependency (e.g. no journal yet) is part of the identity too
+            key += stat_key(path) or (0, 0, 0)
+        return key
+
+    def _build(self, key: StatKey, data: Any, index: Optional[EntityIndex] = None) -> Snapshot:
+        return Snapshot(key=key, data=data, last_modified=format_mtime(max(key[2::3])), _index=index)
+
+    def key(self) -> Optional[StatKey]:
+        """Identity of the stored document right now (None if it does not exist)."""
+        return self._key()
+
+    def current(self) -> Optional[Snapshot]:
+        """Return the last built snapshot without checking that it is still current."""
+        return self._snapshot
+
+    def cached(self) -> Optional[Snapshot]:
+        """Return the snapshot if it is still current, without ever parsing the file."""
+        snap = self._snapshot
+        if snap is not None and self._key() == snap.key:
+            self.hits += 1
+            return snap
+        return None
+
+    def get(self) -> Snapshot:
+        """Return the current snapshot, re-parsing the file only if it changed.
+
+        Raises FileNotFoundError if the database file does not exist.
+        """
+        key = self._key()
+        if key is None:
+            raise FileNotFoundError(str(self.path))
+        snap = self._snapshot
+        if snap is not None and snap.key == key:
+            self.hits += 1
+            return snap
+        with self._lock:
+            # Another thread may have refreshed the entry while we waited
+            snap = self._snapshot
+            if snap is not None and snap.key == key:
+                self.hits += 1
+                return snap
+            self.misses += 1
+            data = self._loader(self.path)
+            snap = self._build(key, data)
+            # Only keep the entry if the file did not change while parsing it
+            if self._key() == key:
+                self._snapshot = snap
+            else:
+                logger.debug('Database changed while loading %s; not caching', self.path)
+            return snap
+
+    def update(self, data: Any, index: Optional[EntityIndex] = None) -> Snapshot | None:
+        """Replace the cached snapshot with `data` that was just written to disk.
+
+        `index` is the `EntityIndex` of `data` when the caller already has it.
+        """
+        with self._lock:
+            key = self._key()
+            if key is None:
+                self._snapshot = None
+                return None
+            self._snapshot = self._build(key, data, index)
+            return self._snapshot
+
+    def rekey(self) -> Snapshot | None:
+        """Keep the cached document but re-read the file identities.
+
+        Used after rewriting the files without changing the content they
+        describe (journal compaction).
+        """
+        with self._lock:
+            snap = self._snapshot
+            key = self._key()
+            if snap is None or key is None:
+                self._snapshot = None
+                return None
+            self._snapshot = self._build(key, snap.data)
+            return self._snapshot
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._snapshot = None
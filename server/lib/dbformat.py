@@ -0,0 +1,141 @@
+"""On-disk formats of the team database.
+
+`database.yaml` is what people edit and what the tools read, but parsing and
+emitting YAML is by far the slowest part of loading and saving the database.
+The service can instead keep its canonical copy as `database.json`:
+
+    # teamdb-revision: 12 sha256: 6b86b273ff34fce19d6b804eff5a3f57...
+    {"version":"20260107","database":{"people":[...],...}}
+
+The first line is the same header comment as a journal-mode YAML snapshot
+(`server.lib.journal.read_snapshot_revision` reads it unchanged) plus the
+SHA-256 of the JSON line, so a truncated or hand-edited file is detected on
+load instead of being served. The JSON line is compact, written and parsed
+with `orjson` when it is installed (the standard `json` module otherwise).
+A file without the header (e.g. converted by hand) is accepted as is.
+
+YAML goes through libyaml's `CSafeLoader`/`CSafeDumper` when PyYAML was
+built with it, which is several times faster than the pure-Python classes
+and produces the same documents. PyYAML and orjson are imported on first
+use, so a service keeping its database as JSON never loads PyYAML for it.
+"""
+from __future__ import annotations
+import functools
+import hashlib
+import json
+import re
+from pathlib import Path
+from typing import Any, IO, Optional, Tuple
+import logging
+
+from server.lib.lazy import optional
+
+logger = logging.getLogger(__name__)
+
+_UNSET: Any = object()
+# orjson (optional: several times faster than json), looked up on first use
+# by _orjson(); None means use json. The benchmarks swap it.
+orjson: Any = _UNSET
+
+FORMATS = ('yaml', 'json')
+SUFFIXES = {'yaml': '.yaml', 'json': '.json'}
+
+JSON_HEADER = '# teamdb-revision: %d sha256: %s\n'
+_JSON_HEADER_RE = re.compile(rb'#\s*teamdb-revision:\s*(\d+)\s+sha256:\s*([0-9a-f]{64})\s*$')
+
+
+class DatabaseFormatError(ValueError):
+    """The stored database could not be decoded (bad header, hash mismatch, invalid JSON)."""
+
+
+def format_of(path: str | Path) -> str:
+    """'json' for a .json file, 'yaml' for anything else."""
+    return 'json' if Path(path).suffix == '.json' else 'yaml'
+
+
+@functools.lru_cache(maxsize=None)
+def _yaml() -> Tuple[Any, Any, Any]:
+    """PyYAML and its fastest safe loader and dumper, imported on first use."""
+    import yaml
+    try:
+        from yaml import CSafeDumper as SafeDumper, CSafeLoader as SafeLoader
+    except ImportError:  # PyYAML without libyaml
+        from yaml import SafeDumper, SafeLoader
+    return yaml, SafeLoader, SafeDumper
+
+
+def _orjson() -> Any:
+    global orjson
+    if orjson is _UNSET:
+        orjson = optional('orjson')
+    return orjson
+
+
+def yaml_load(stream: str | bytes | IO) -> Any:
+    yaml, loader, _ = _yaml()
+    return yaml.load(stream, Loader=loader)
+
+
+def yaml_dump(data: Any, stream: IO[bytes]) -> None:
+    """Write `data` as UTF-8 YAML to a binary stream."""
+    yaml, _, dumper = _yaml()
+    yaml.dump(data, stream, Dumper=dumper, sort_keys=False, allow_unicode=True, encoding='utf-8')
+
+
+def dumps_json(data: Any) -> bytes:
+    """Compact UTF-8 JSON, the body of a database.json file."""
+    fast = _orjson()
+    if fast is not None:
+        return fast.dumps(data, option=fast.OPT_NON_STR_KEYS)
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def loads_json(raw: bytes) -> Any:
+    fast = _orjson()
+    if fast is not None:
+        return fast.loads(raw)
+    return json.loads(raw)
+
+
+def content_hash(body: bytes) -> str:
+    return hashlib.sha256(body).hexdigest()
+
+
+def encode_json(data: Any, revision: Optional[int] = None) -> Tuple[bytes, str]:
+    """Return the database.json file contents for `data` and the content hash."""
+    body = dumps_json(data)
+    digest = content_hash(body)
+    return (JSON_HEADER % (revision or 0, digest)).encode('ascii') + body + b'\n', digest
+
+
+def split_json(raw: bytes) -> Tuple[bytes, Optional[str]]:
+    """Split database.json contents into the JSON body and the recorded hash (None without header)."""
+    if not raw.startswith(b'#'):
+        return raw, None
+    first, _, body = raw.partition(b'\n')
+    match = _JSON_HEADER_RE.match(first)
+    if match is None:
+        raise DatabaseFormatError(f'Unrecognized database.json header: {first[:80]!r}')
+    return body, match.group(2).decode('ascii')
+
+
+def decode_json(raw: bytes, path: str | Path = 'database.json') -> Any:
+    """Parse database.json contents, checking the content hash if the header records one."""
+    body, digest = split_json(raw)
+    if digest is not None and content_hash(body.rstrip(b'\n')) != digest:
+        raise DatabaseFormatError(f'{path}: content hash mismatch (truncated or edited by hand?)')
+    try:
+        return loads_json(body)
+    except ValueError as e:
+        raise DatabaseFormatError(f'{path}: invalid JSON: {e}') from e
+
+
+def read_content_hash(path: str | Path) -> Optional[str]:
+    """The hash recorded in a database.json header, without reading the body."""
+    try:
+        with open(path, 'rb') as f:
+            first = f.readline()
+    except FileNotFoundError:
+        return None
+    match = _JSON_HEADER_RE.match(first.rstrip(b'\n'))
+    return match.group(2).decode('ascii') if match else None
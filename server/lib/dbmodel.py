@@ -0,0 +1,50 @@
+"""Name-keyed view of the team database document.
+
+The YAML document stores people, teams and projects as plain lists. The
+`EntityIndex` maps each entry's `name` to its list position so single
+entities can be found in O(1) instead of scanning the list.
+
+Every entity also has a revision derived from its content. Clients use it
+with `If-Match` to update one entry without conflicting with edits to other
+entries of the database.
+"""
+from __future__ import annotations
+import hashlib
+import json
+from typing import Any, Dict, Optional
+
+ENTITY_KINDS = ('people', 'teams', 'projects')
+
+
+def entity_revision(entry: Any) -> str:
+    """Return a stable revision string for a single entity."""
+    canonical = json.dumps(entry, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:16]
+
+
+class EntityIndex:
+    def __init__(self, doc: Any, positions: Optional[Dict[str, Dict[str, int]]] = None) -> None:
+        self._doc = doc
+        if positions is not None:
+            # Already known, e.g. carried over from the document a patch was applied to
+            self.positions = positions
+            return
+        self.positions = {}
+        inner = doc.get('database') if isinstance(doc, dict) else None
+        for kind in ENTITY_KINDS:
+            entries = inner.get(kind) if isinstance(inner, dict) else None
+            names: Dict[str, int] = {}
+            if isinstance(entries, list):
+                for idx, entry in enumerate(entries):
+                    if isinstance(entry, dict) and isinstance(entry.get('name'), str):
+                        names[entry['name']] = idx
+            self.positions[kind] = names
+
+    def get(self, kind: str, name: str) -> Optional[dict]:
+        idx = self.positions.get(kind, {}).get(name)
+        if idx is None:
+            return None
+        return self._doc['database'][kind][idx]
+
+    def count(self, kind: str) -> int:
+        return len(self.positions.get(kind, {}))
@@ -0,0 +1,331 @@
+"""Partial updates of the team database document.
+
+`PATCH /api/teamdb` accepts two payload formats:
+
+* RFC 6902 JSON Patch (`application/json-patch+json`): a list of operations
+  such as ``{"op": "replace", "path": "/database/people/3/title", "value": "x"}``.
+* Entity deltas (`application/json`): changed rows grouped by kind, matching
+  the people/teams/projects names the extension tracks with
+  `addPendingChange`::
+
+    {"people": {"upsert": [{"name": "A", ...}], "delete": ["B"]}, "teams": {...}}
+
+Updates are applied copy-on-write: only the containers along a modified path
+are copied, so unchanged entries stay shared with the current document and
+the cost of a patch scales with the size of the edit. Only the entries a
+patch touched are re-validated, and only the reference problems a patch
+introduces are rejected (see `iter_new_integrity_errors`).
+"""
+from __future__ import annotations
+import copy
+from typing import Any, Dict, List, Optional, Tuple
+
+from server.lib.db_validator import (ValidationError, iter_new_integrity_errors, validate_database, validate_entity,
+                                     validate_header)
+from server.lib.dbmodel import ENTITY_KINDS, EntityIndex
+
+
+class PatchError(Exception):
+    """The patch document is malformed or cannot be applied."""
+
+
+class PatchConflict(PatchError):
+    """A JSON Patch `test` operation did not match the current document."""
+
+
+def parse_pointer(pointer: Any) -> List[str]:
+    """Split an RFC 6901 JSON Pointer into unescaped reference tokens."""
+    if not isinstance(pointer, str):
+        raise PatchError('path must be a string')
+    if pointer == '':
+        return []
+    if not pointer.startswith('/'):
+        raise PatchError('path must start with "/": %s' % pointer)
+    return [tok.replace('~1', '/').replace('~0', '~') for tok in pointer[1:].split('/')]
+
+
+def _list_index(container: list, token: str, allow_end: bool = False) -> int:
+    if allow_end and token == '-':
+        return len(container)
+    if not token.isdigit() or (len(token) > 1 and token[0] == '0'):
+        raise PatchError('invalid list index: %s' % token)
+    idx = int(token)
+    limit = len(container) + (1 if allow_end else 0)
+    if idx >= limit:
+        raise PatchError('list index out of range: %s' % token)
+    return idx
+
+
+def _get_child(node: Any, token: str) -> Any:
+    if isinstance(node, dict):
+        if token not in node:
+            raise PatchError('path not found: %s' % token)
+        return node[token]
+    if isinstance(node, list):
+        return node[_list_index(node, token)]
+    raise PatchError('cannot traverse into a scalar at: %s' % token)
+
+
+class _CowDocument:
+    """Copy-on-write view of a document being patched."""
+
+    def __init__(self, doc: Any, references: bool = True, index: Optional[EntityIndex] = None) -> None:
+        if not isinstance(doc, dict):
+            raise PatchError('current database is not a mapping')
+        self.base = doc
+        self.index = index
+        # Keep references to every owned container so their ids stay unique
+        self._owned: List[Any] = []
+        self._fresh: set[int] = set()
+        self.root = self._own(doc)
+        self.full_validation = False
+        self.touched: set[str] = set()
+        # Per kind an entity delta changed: (name -> position after the delta,
+        # {position: previous entry or None} of upserted entries, removed names)
+        self.tracked: Dict[str, Tuple[Dict[str, int], Dict[int, Any], set]] = {}
+        self.references = references
+
+    def _own(self, node: Any) -> Any:
+        if id(node) in self._fresh:
+            return node
+        owned = list(node) if isinstance(node, list) else dict(node)
+        self._owned.append(owned)
+        self._fresh.add(id(owned))
+        return owned
+
+    def _adopt(self, value: Any) -> Any:
+        """Mark a value inserted by the patch as owned so it gets validated."""
+        if isinstance(value, (dict, list)):
+            self._owned.append(value)
+            self._fresh.add(id(value))
+        return value
+
+    def _note(self, tokens: List[str]) -> None:
+        if len(tokens) >= 3 and tokens[0] == 'database' and tokens[1] in ENTITY_KINDS:
+            self.touched.add(tokens[1])
+        elif tokens != ['version']:
+            # Replacing a whole list (or the document) needs a full check
+            self.full_validation = True
+
+    def get(self, tokens: List[str]) -> Any:
+        node = self.root
+        for tok in tokens:
+            node = _get_child(node, tok)
+        return node
+
+    def container(self, tokens: List[str]) -> Any:
+        """Return the owned container at `tokens`, copying along the way."""
+        node = self.root
+        for tok in tokens:
+            child = _get_child(node, tok)
+            if not isinstance(child, (dict, list)):
+                raise PatchError('cannot traverse into a scalar at: %s' % tok)
+            owned = self._own(child)
+            if isinstance(node, list):
+                node[_list_index(node, tok)] = owned
+            else:
+                node[tok] = owned
+            node = owned
+        return node
+
+    def parent(self, tokens: List[str]) -> Any:
+        if not tokens:
+            raise PatchError('operation on the document root is not supported')
+        return self.container(tokens[:-1])
+
+    def add(self, tokens: List[str], value: Any) -> None:
+        self._note(tokens)
+        parent = self.parent(tokens)
+        value = self._adopt(value)
+        if isinstance(parent, list):
+            parent.insert(_list_index(parent, tokens[-1], allow_end=True), value)
+        else:
+            parent[tokens[-1]] = value
+
+    def remove(self, tokens: List[str]) -> Any:
+        self._note(tokens)
+        parent = self.parent(tokens)
+        if isinstance(parent, list):
+            return parent.pop(_list_index(parent, tokens[-1]))
+        if tokens[-1] not in parent:
+            raise PatchError('path not found: %s' % tokens[-1])
+        return parent.pop(tokens[-1])
+
+    def replace(self, tokens: List[str], value: Any) -> None:
+        self._note(tokens)
+        parent = self.parent(tokens)
+        value = self._adopt(value)
+        if isinstance(parent, list):
+            parent[_list_index(parent, tokens[-1])] = value
+        else:
+            if tokens[-1] not in parent:
+                raise PatchError('path not found: %s' % tokens[-1])
+            parent[tokens[-1]] = value
+
+    def validate(self) -> Any:
+        """Validate the patched document and return it."""
+        positions = self.index.positions if self.index is not None else None
+        if self.full_validation:
+            validate_database(self.root, references=self.references, previous=self.base, previous_positions=positions)
+            return self.root
+        validate_header(self.root)
+        inner = self.root['database']
+        for kind in sorted(self.touched):
+            entries = inner.get(kind) or []
+            if kind in self.tracked:
+                for idx in sorted(self.tracked[kind][1]):
+                    validate_entity(kind, entries[idx], ('database', kind, str(idx)))
+                continue
+            for idx, entry in enumerate(entries):
+                # Entries still shared with the previous document were validated before
+                if id(entry) in self._fresh:
+                    validate_entity(kind, entry, ('database', kind, str(idx)))
+        if self.references and self.touched:
+            # Problems the stored document already had do not block the patch
+            for error in iter_new_integrity_errors(self.base, self.root, positions, self.tracked):
+                raise error
+        return self.root
+
+    def index_after(self) -> EntityIndex:
+        """`EntityIndex` of the result of an entity delta, reusing the positions of unchanged kinds."""
+        base = self.index if self.index is not None else EntityIndex(self.base)
+        positions = dict(base.positions)
+        for kind, (names, _, _) in self.tracked.items():
+            positions[kind] = names
+        return EntityIndex(self.root, positions)
+
+
+def apply_json_patch(doc: Any, ops: Any, references: bool = True, index: Optional[EntityIndex] = None) -> Any:
+    """Apply RFC 6902 operations to `doc` and return the validated result.
+
+    `doc` itself is never modified. Pass the `EntityIndex` of `doc` to avoid
+    rebuilding the name lookup. `references=False` skips the referential
+    integrity check.
+    """
+    if not isinstance(ops, list):
+        raise PatchError('JSON Patch document must be a list of operations')
+    cow = _CowDocument(doc, references, index)
+    for i, op in enumerate(ops):
+        if not isinstance(op, dict) or 'op' not in op:
+            raise PatchError('operation %d must be an object with an "op" member' % i)
+        name = op['op']
+        tokens = parse_pointer(op.get('path'))
+        if name in ('add', 'replace', 'test') and 'value' not in op:
+            raise PatchError('operation %d (%s) requires "value"' % (i, name))
+        if name == 'add':
+            cow.add(tokens, op['value'])
+        elif name == 'remove':
+            cow.remove(tokens)
+        elif name == 'replace':
+            cow.replace(tokens, op['value'])
+        elif name == 'move':
+            src = parse_pointer(op.get('from'))
+            if tokens[:len(src)] == src and tokens != src:
+                raise PatchError('operation %d: cannot move a value into itself' % i)
+            cow.add(tokens, cow.remove(src))
+        elif name == 'copy':
+            src = parse_pointer(op.get('from'))
+            cow.add(tokens, copy.deepcopy(cow.get(src)))
+        elif name == 'test':
+            if cow.get(tokens) != op['value']:
+                raise PatchConflict('test failed at %s' % op.get('path'))
+        else:
+            raise PatchError('operation %d: unsupported op %r' % (i, name))
+    return cow.validate()
+
+
+def apply_entity_delta(doc: Any, delta: Any, index: Optional[EntityIndex] = None, references: bool = True) -> Any:
+    """Apply per-kind upserts/deletes keyed by entity name and return the validated result.
+
+    Deletes are applied before upserts, so a rename is expressed as a delete of
+    the old name plus an upsert of the new entry. `doc` itself is never modified.
+    Pass the `EntityIndex` of `doc` to avoid rebuilding the name lookup.
+    `references=False` skips the referential integrity check.
+    """
+    return _entity_delta(doc, delta, index, references).validate()
+
+
+def apply_entity_delta_indexed(doc: Any, delta: Any, index: Optional[EntityIndex] = None,
+                               references: bool = True) -> Tuple[Any, EntityIndex]:
+    """Like `apply_entity_delta`, but also return the `EntityIndex` of the result.
+
+    The index is derived from `index` and the delta, so writes that follow do
+    not have to rebuild it from the whole document.
+    """
+    cow = _entity_delta(doc, delta, index, references)
+    return cow.validate(), cow.index_after()
+
+
+def _entity_delta(doc: Any, delta: Any, index: Optional[EntityIndex], references: bool) -> _CowDocument:
+    if not isinstance(delta, dict) or not delta:
+        raise PatchError('delta must be a non-empty object keyed by entity kind')
+    cow = _CowDocument(doc, references, index)
+    for kind, spec in delta.items():
+        if kind not in ENTITY_KINDS:
+            raise PatchError('unknown entity kind: %s' % kind)
+        if not isinstance(spec, dict):
+            raise PatchError('%s delta must be an object with "upsert" and/or "delete"' % kind)
+        upserts = spec.get('upsert', [])
+        deletes = spec.get('delete', [])
+        if not isinstance(upserts, list) or not isinstance(deletes, list):
+            raise PatchError('%s.upsert and %s.delete must be lists' % (kind, kind))
+        # Names are looked up in dicts below: anything but a string is the client's error
+        for i, name in enumerate(deletes):
+            if not isinstance(name, str):
+                raise PatchError('%s.delete[%d] must be a string name' % (kind, i))
+        for i, entry in enumerate(upserts):
+            if not isinstance(entry, dict) or not isinstance(entry.get('name'), str):
+                raise PatchError('%s.upsert[%d] must be an object with a string name' % (kind, i))
+
+        if not isinstance(cow.root.get('database'), dict):
+            raise PatchError("current database has no 'database' mapping")
+        inner = cow.container(['database'])
+        if kind not in inner:
+            inner[kind] = cow._adopt([])
+        entries = cow.container(['database', kind])
+        cow.touched.add(kind)
+
+        positions: Dict[str, int]
+        if index is not None:
+            positions = index.positions.get(kind, {})
+        else:
+            positions = _names(entries)
+        # The stored list, still intact after deletes shift `entries`
+        previous = cow.base['database'].get(kind) or []
+        previous_positions = positions
+        # Names appended by this delta; keeps the shared index untouched
+        added: Dict[str, int] = {}
+        # Position -> entry it replaced (None if appended), for validation
+        changed: Dict[int, Any] = {}
+
+        if deletes:
+            drop = set()
+            for name in deletes:
+                if name not in positions or positions[name] in drop:
+                    raise PatchError('%s entry not found: %s' % (kind, name))
+                drop.add(positions[name])
+            entries[:] = [e for i, e in enumerate(entries) if i not in drop]
+            positions = _names(entries)
+
+        for entry in upserts:
+            cow._adopt(entry)
+            name = entry['name']
+            pos = added.get(name, positions.get(name))
+            if pos is None:
+                pos = added[name] = len(entries)
+                entries.append(entry)
+            else:
+                entries[pos] = entry
+            old = previous_positions.get(name)
+            changed[pos] = previous[old] if old is not None else None
+        if added:
+            if positions is previous_positions:
+                positions = dict(positions)
+            positions.update(added)
+        upserted = {entry['name'] for entry in upserts}
+        cow.tracked[kind] = (positions, changed, {n for n in deletes if n not in upserted})
+    return cow
+
+
+def _names(entries: list) -> Dict[str, int]:
+    return {e['name']: i for i, e in enumerate(entries) if isinstance(e, dict) and isinstance(e.get('name'), str)}
@@ -0,0 +1,106 @@
+"""Commit lock shared by all worker processes of the service.
+
+`ProcessLock` holds an exclusive `fcntl.flock` on a lock file while any
+thread of this process holds it. Threads of one process share the lock:
+acquiring it while another thread of the process holds it succeeds at once,
+and the flock is dropped by the last release, so it may be acquired on one
+thread and released on another (e.g. around several awaits on an I/O pool).
+Mutual exclusion between threads stays with the service's own locks; this
+one only keeps other processes out.
+
+Without `fcntl` (Windows) the lock is process-local, which is still correct
+for a single worker.
+"""
+from __future__ import annotations
+import os
+import threading
+import time
+from pathlib import Path
+import logging
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class ProcessLock:
+    def __init__(self, path: str | Path) -> None:
+        self.path = Path(path)
+        self._cond = threading.Condition()
+        self._count = 0
+        # A thread is waiting for the flock; others queue behind it
+        self._acquiring = False
+        self._fd = None
+        # Time spent waiting for other processes, for metrics
+        self.waits = 0
+        self.wait_seconds = 0.0
+
+    @property
+    def held(self) -> bool:
+        return self._count > 0
+
+    def acquire(self, blocking: bool = True) -> bool:
+        with self._cond:
+            while True:
+                if self._count:
+                    self._count += 1
+                    return True
+                if not self._acquiring:
+                    break
+                if not blocking:
+                    return False
+                self._cond.wait()
+            self._acquiring = True
+        ok = False
+        try:
+            ok = self._lock_file(blocking)
+        finally:
+            with self._cond:
+                self._acquiring = False
+                if ok:
+                    self._count = 1
+                self._cond.notify_all()
+        return ok
+
+    def release(self) -> None:
+        with self._cond:
+            if not self._count:
+                raise RuntimeError('release of an unheld ProcessLock')
+            self._count -= 1
+            if not self._count and self._fd is not None and fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _lock_file(self, blocking: bool) -> bool:
+        if fcntl is None:
+            return True
+        if self._fd is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            if not blocking:
+                return False
+        start = time.perf_counter()
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        self.waits += 1
+        self.wait_seconds += time.perf_counter() - start
+        return True
+
+    def close(self) -> None:
+        with self._cond:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            self._count = 0
+
+    def __enter__(self) -> 'ProcessLock':
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
@@ -0,0 +1,201 @@
+"""Append-only write-ahead journal of database mutations.
+
+In journaled storage mode a commit does not rewrite `database.yaml`.
+Instead the mutation itself (a full replacement, an RFC 6902 JSON Patch or
+an entity delta) is appended to the journal as one JSON line and fsynced,
+which costs I/O proportional to the change rather than to the database.
+
+Every record carries the revision it produced. A compaction step
+periodically writes a fresh YAML snapshot whose first line is a
+``# teamdb-revision: N`` comment and then drops the records up to N, so the
+current document is always "snapshot + records newer than its revision".
+A crash between writing the snapshot and truncating the journal therefore
+never replays a record twice.
+"""
+from __future__ import annotations
+import json
+import os
+import re
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+import logging
+
+from server.lib.dbpatch import apply_entity_delta, apply_json_patch
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_HEADER = '# teamdb-revision: %d\n'
+_SNAPSHOT_HEADER_RE = re.compile(r'#\s*teamdb-revision:\s*(\d+)')
+
+RECORD_OPS = ('replace', 'patch', 'delta')
+
+
+def read_snapshot_revision(path: str | Path) -> int:
+    """Return the revision recorded in a snapshot's header comment (0 if none)."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            first = f.readline()
+    except FileNotFoundError:
+        return 0
+    match = _SNAPSHOT_HEADER_RE.match(first)
+    return int(match.group(1)) if match else 0
+
+
+def fsync_dir(path: str | Path) -> None:
+    """Flush a directory entry change (rename/create) to disk where supported."""
+    try:
+        fd = os.open(str(path), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def apply_record(doc: Any, record: Dict[str, Any]) -> Any:
+    """Return the document that results from replaying one journal record on `doc`."""
+    op = record.get('op')
+    # Records were validated when committed; don't let later rules stop the replay
+    if op == 'replace':
+        return record['value']
+    if op == 'patch':
+        return apply_json_patch(doc, record['value'], references=False)
+    if op == 'delta':
+        return apply_entity_delta(doc, record['value'], references=False)
+    raise ValueError(f'Unknown journal record op: {op!r}')
+
+
+class Journal:
+    def __init__(self, path: str | Path) -> None:
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._fh = None
+
+    def _open(self):
+        if self._fh is not None and not self._is_current(self._fh):
+            # Another process compacted (replaced) the journal since we opened it
+            self._fh.close()
+            self._fh = None
+        if self._fh is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._drop_torn_tail()
+            self._fh = open(self.path, 'ab')
+            fsync_dir(self.path.parent)
+        return self._fh
+
+    def _is_current(self, fh) -> bool:
+        try:
+            return os.fstat(fh.fileno()).st_ino == self.path.stat().st_ino
+        except FileNotFoundError:
+            return False
+
+    def _drop_torn_tail(self) -> None:
+        # A crash mid-append can leave a partial last line; it was never
+        # acknowledged, so cut it off before appending after it.
+        try:
+            with open(self.path, 'rb+') as f:
+                data = f.read()
+                end = data.rfind(b'\n') + 1
+                if end != len(data):
+                    logger.warning('Dropping %d bytes of torn journal tail in %s', len(data) - end, self.path)
+                    f.truncate(end)
+        except FileNotFoundError:
+            pass
+
+    def append(self, revision: int, op: str, value: Any) -> None:
+        """Durably append one mutation; returns only after it reached the disk."""
+        self.append_many([(revision, op, value)])
+
+    def append_many(self, records: Iterable[Tuple[int, str, Any]]) -> None:
+        """Durably append `(revision, op, value)` mutations with a single write and fsync."""
+        now = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        lines = []
+        for revision, op, value in records:
+            if op not in RECORD_OPS:
+                raise ValueError(f'Unknown journal record op: {op!r}')
+            record = {'revision': revision, 'time': now, 'op': op, 'value': value}
+            lines.append(json.dumps(record, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8') + b'\n')
+        with self._lock:
+            fh = self._open()
+            fh.write(b''.join(lines))
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    def records(self, after: int = 0) -> Iterator[Dict[str, Any]]:
+        """Yield the records with a revision greater than `after`, oldest first."""
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            for lineno, line in enumerate(f, 1):
+                if not line.endswith(b'\n'):
+                    # Torn tail from a crash: never acknowledged, ignore it
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.error('Skipping unreadable journal record %s:%d', self.path, lineno)
+                    continue
+                if int(record.get('revision', 0)) > after:
+                    yield record
+
+    def last_revision(self) -> int:
+        last = 0
+        for record in self.records():
+            last = max(last, int(record.get('revision', 0)))
+        return last
+
+    def size(self) -> int:
+        try:
+            return self.path.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def truncate(self, through: int) -> None:
+        """Drop the records up to and including revision `through` (already in the snapshot)."""
+        with self._lock:
+            keep = list(self.records(after=through))
+            tmp = self.path.with_suffix(self.path.suffix + '.tmp')
+            with open(tmp, 'wb') as f:
+                for record in keep:
+                    f.write(json.dumps(record, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8') + b'\n')
+                f.flush()
+                os.fsync(f.fileno())
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+            tmp.replace(self.path)
+            fsync_dir(self.path.parent)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+
+def replay(doc: Any, journal: Journal, after: int) -> Tuple[Any, int, Optional[int]]:
+    """Replay the journal records newer than `after` onto `doc`.
+
+    Returns (document, records applied, revision of the last applied record).
+    Replay stops at the first record that no longer applies cleanly (for
+    example after a hand edit of the snapshot) so later records are never
+    applied to a document they were not recorded against.
+    """
+    applied = 0
+    last = None
+    for record in journal.records(after=after):
+        try:
+            doc = apply_record(doc, record)
+        except Exception:
+            logger.exception('Journal record for revision %s no longer applies; stopping replay', record.get('revision'))
+            break
+        applied += 1
+        last = int(record['revision'])
+    return doc, applied, last
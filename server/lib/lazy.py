@@ -0,0 +1,37 @@
+"""Optional dependencies, imported on first use.
+
+Importing `server.teamdb` should not pay for libraries that the configured
+storage and formats never use (SQLite, PyYAML for a JSON database, the
+compression and fast-JSON packages). Modules look them up here when they
+need them instead of importing them at module load:
+
+    orjson = optional('orjson')   # the module, or None if not installed
+    available('brotli')           # installed? (without importing it)
+"""
+from __future__ import annotations
+import functools
+import importlib
+import importlib.util
+from types import ModuleType
+from typing import Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def optional(name: str) -> Optional[ModuleType]:
+    """Import `name` on first use; None if it is not installed."""
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def available(name: str) -> bool:
+    """Whether `name` can be imported, without importing it."""
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
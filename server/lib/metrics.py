@@ -0,0 +1,226 @@
+"""Minimal Prometheus metrics: counters, histograms and scrape-time gauges.
+
+Only what `GET /api/metrics` needs, without a client library: recording a
+sample is a bisect and two additions under a lock, so instrumentation is
+cheap enough to stay on. `Registry.render()` produces the text exposition
+format (version 0.0.4).
+
+`MetricsMiddleware` is a plain ASGI middleware (no per-request task or body
+buffering, so streaming responses are unaffected). It labels samples with
+the matched route template rather than the raw path to keep the number of
+series bounded.
+"""
+from __future__ import annotations
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds; spans cached GETs (sub-millisecond) to full rewrites of a large database
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    parts = ['%s="%s"' % (n, _escape(str(v))) for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{%s}' % ','.join(parts) if parts else ''
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def header(self) -> List[str]:
+        return ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [
+            '%s%s %s' % (self.name, _format_labels(self.labelnames, labels), _format_value(v))
+            for labels, v in items
+        ]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts (last one is +Inf), sum]
+        self._series: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][i] += 1
+            series[1][0] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        """Observe the duration of the `with` block, also when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def count(self, *labels: str) -> int:
+        series = self._series.get(labels)
+        return sum(series[0]) if series else 0
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted((labels, (list(counts), total[0])) for labels, (counts, total) in self._series.items())
+        lines = []
+        for labels, (counts, total) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (math.inf,), counts):
+                cumulative += n
+                lines.append('%s_bucket%s %d' % (
+                    self.name, _format_labels(self.labelnames, labels, 'le="%s"' % _format_value(bound)), cumulative))
+            lines.append('%s_sum%s %s' % (self.name, _format_labels(self.labelnames, labels), repr(total)))
+            lines.append('%s_count%s %d' % (self.name, _format_labels(self.labelnames, labels), cumulative))
+        return lines
+
+
+class Gauge(_Metric):
+    """A value computed at scrape time by `fn`: a number, or {label values: number}.
+
+    Pass `kind='counter'` to expose a total kept elsewhere (e.g. cache hits).
+    """
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, fn: Callable[[], Any], labelnames: Sequence[str] = (),
+                 kind: str = 'gauge') -> None:
+        super().__init__(name, help, labelnames)
+        self._fn = fn
+        self.kind = kind
+
+    def render(self) -> List[str]:
+        try:
+            value = self._fn()
+        except Exception:
+            logger.exception('Failed to collect metric %s', self.name)
+            return []
+        if value is None:
+            return []
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [
+            '%s%s %s' % (self.name, _format_labels(self.labelnames, labels), _format_value(v))
+            for labels, v in sorted(value.items()) if v is not None
+        ]
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labelnames))  # type: ignore[return-value]
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))  # type: ignore[return-value]
+
+    def gauge(self, name: str, help: str, fn: Callable[[], Any], labelnames: Sequence[str] = (),
+              kind: str = 'gauge') -> Gauge:
+        return self.register(Gauge(name, help, fn, labelnames, kind))  # type: ignore[return-value]
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.header())
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsMiddleware:
+    """Record latency per (method, route) and count responses by status."""
+
+    def __init__(self, app, latency: Histogram, responses: Counter,
+                 conflicts: Optional[Counter] = None, exclude: Iterable[str] = ()) -> None:
+        self.app = app
+        self.latency = latency
+        self.responses = responses
+        self.conflicts = conflicts
+        self.exclude = frozenset(exclude)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        status = [500]
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get('route')
+            template = getattr(route, 'path', None) or 'unmatched'
+            if template not in self.exclude:
+                method = scope.get('method', '')
+                self.latency.observe(time.perf_counter() - start, method, template)
+                self.responses.inc(method, template, str(status[0]))
+                if status[0] == 412 and self.conflicts is not None:
+                    self.conflicts.inc(method, template)
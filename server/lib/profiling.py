@@ -0,0 +1,309 @@
+"""Opt-in request profiling.
+
+`ProfilingMiddleware` profiles a request in one of two ways:
+
+- *Full* profiles (a `sample_rate` fraction of requests, or, with
+  `allow_header`, a request from localhost carrying ``X-TeamDB-Profile: 1``)
+  run cProfile on the event loop thread and write a `.prof` file readable by
+  `pstats`, snakeviz, etc. Behind a reverse proxy every client connects from
+  localhost, so requests with proxy headers never count as local.
+- *Stack samples* come from one background thread that records the stacks of
+  the event loop and I/O pool threads every `interval_ms` while profiled
+  requests are in flight. Blocking work handed to the I/O pool (YAML
+  dumps, PBKDF2) therefore shows up too, which cProfile on the loop thread
+  misses. Samples are written in collapsed-stack format (`.collapsed`, one
+  ``frame;frame;frame count`` line per stack, as consumed by flamegraph.pl
+  or speedscope). With `slow_ms` set, every request is sampled and the
+  samples are kept only if the request took at least that long.
+
+Both profilers see everything running at the same time, so with
+concurrent requests a profile includes their work too.
+
+Files go to `output_dir` as ``<time>-<method>-<route>-<ms>ms.<ext>``; the
+oldest are deleted beyond `max_files`. Summarize them with
+
+    python3 -m server.lib.profiling data/profiles [--top 25]
+"""
+from __future__ import annotations
+import argparse
+import collections
+import cProfile
+import io
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Counter, Dict, Iterable, List, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = b'x-teamdb-profile'
+LOCAL_HOSTS = ('127.0.0.1', '::1', 'localhost')
+# Set by reverse proxies (nginx); their requests come from the proxy's loopback address
+PROXY_HEADERS = frozenset((b'x-forwarded-for', b'x-real-ip', b'forwarded'))
+
+# Leaf frames of threads that are just waiting for work
+_IDLE_LEAVES = {
+    ('selectors.py', 'select'),
+    ('threading.py', 'wait'),
+    ('thread.py', '_worker'),
+}
+
+
+def _frame_label(code) -> str:
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class StackSampler:
+    """Background thread sampling all other threads' stacks while anyone is listening."""
+
+    def __init__(self, interval: float = 0.005) -> None:
+        self.interval = interval
+        self._cond = threading.Condition()
+        self._listeners: List[Counter[str]] = []
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> Counter[str]:
+        """Begin collecting samples into a new counter (collapsed stack -> samples)."""
+        samples: Counter[str] = collections.Counter()
+        with self._cond:
+            self._listeners.append(samples)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='teamdb-profiler', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return samples
+
+    def stop(self, samples: Counter[str]) -> None:
+        with self._cond:
+            self._listeners.remove(samples)
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        names: Dict[int, str] = {}
+        while True:
+            with self._cond:
+                while not self._listeners:
+                    self._cond.wait()
+                    names = {}
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in _IDLE_LEAVES:
+                    continue
+                if ident not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                parts = []
+                while frame is not None:
+                    parts.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                parts.append(names.get(ident, 'thread-%d' % ident))
+                stacks.append(';'.join(reversed(parts)))
+            with self._cond:
+                for listener in self._listeners:
+                    listener.update(stacks)
+            time.sleep(self.interval)
+
+
+def _slug(route: str) -> str:
+    return re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_')[:60] or 'root'
+
+
+def prune(directory: Path, max_files: int) -> None:
+    """Delete the oldest profile files beyond `max_files`."""
+    try:
+        entries = [e for e in os.scandir(directory) if e.is_file() and e.name.endswith(('.prof', '.collapsed'))]
+    except FileNotFoundError:
+        return
+    if len(entries) <= max_files:
+        return
+    entries.sort(key=lambda e: e.name)
+    for entry in entries[:len(entries) - max_files]:
+        try:
+            os.unlink(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+class ProfilingMiddleware:
+    """ASGI middleware writing profiles of sampled, requested or slow requests."""
+
+    def __init__(self, app, output_dir: str | Path, sample_rate: float = 0.0, slow_ms: float = 0.0,
+                 interval_ms: float = 5.0, max_files: int = 100, allow_header: bool = False,
+                 exclude: Iterable[str] = ()) -> None:
+        self.app = app
+        self.output_dir = Path(output_dir)
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.max_files = max_files
+        self.allow_header = allow_header
+        self.exclude = frozenset(exclude)
+        self.sampler = StackSampler(interval_ms / 1000.0)
+        # cProfile hooks one thread; only one full profile can run at a time
+        self._full_busy = False
+        self._write_lock = threading.Lock()
+
+    def _requested(self, scope) -> bool:
+        if not self.allow_header:
+            return False
+        client = scope.get('client')
+        if not client or client[0] not in LOCAL_HOSTS:
+            return False
+        headers = scope.get('headers', ())
+        if any(k in PROXY_HEADERS for k, _ in headers):
+            return False
+        return any(k == PROFILE_HEADER and v not in (b'', b'0') for k, v in headers)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope.get('path') in self.exclude:
+            await self.app(scope, receive, send)
+            return
+        full = self._requested(scope) or (self.sample_rate > 0 and random.random() < self.sample_rate)
+        if not full and not self.slow_ms:
+            await self.app(scope, receive, send)
+            return
+
+        profiler = None
+        if full and not self._full_busy:
+            self._full_busy = True
+            profiler = cProfile.Profile()
+        samples = self.sampler.start()
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self._full_busy = False
+            self.sampler.stop(samples)
+            elapsed_ms = (time.perf_counter() - start) * 1000.0
+            if full or elapsed_ms >= self.slow_ms:
+                route = getattr(scope.get('route'), 'path', None) or scope.get('path', '')
+                # Writing the files is blocking work: keep it off the event loop
+                threading.Thread(target=self._write, args=(scope.get('method', ''), route, elapsed_ms,
+                                                           profiler, samples), daemon=True).start()
+
+    def _write(self, method: str, route: str, elapsed_ms: float,
+               profiler: Optional[cProfile.Profile], samples: Counter[str]) -> None:
+        stem = '%s-%s-%s-%dms' % (datetime.utcnow().strftime('%Y%m%dT%H%M%S%fZ'), method, _slug(route), elapsed_ms)
+        try:
+            with self._write_lock:
+                self.output_dir.mkdir(parents=True, exist_ok=True)
+                if profiler is not None:
+                    profiler.dump_stats(str(self.output_dir / (stem + '.prof')))
+                if samples:
+                    with open(self.output_dir / (stem + '.collapsed'), 'w', encoding='utf-8') as f:
+                        for stack, count in sorted(samples.items()):
+                            f.write('%s %d\n' % (stack, count))
+                prune(self.output_dir, self.max_files)
+            logger.info('Profiled %s %s (%.0f ms) to %s', method, route, elapsed_ms, self.output_dir / stem)
+        except Exception:
+            logger.exception('Failed to write profile %s', stem)
+
+
+# -- summary CLI --
+
+# Thread and event loop plumbing at the bottom of every stack; left out of the
+# inclusive table, where it would always top the list
+_PLUMBING_FILES = ('threading.py', 'thread.py', 'base_events.py', 'events.py', 'runners.py')
+
+def read_collapsed(path: Path) -> Counter[str]:
+    stacks: Counter[str] = collections.Counter()
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            if stack and count.isdigit():
+                stacks[stack] += int(count)
+    return stacks
+
+
+def summarize_collapsed(stacks: Counter[str], top: int) -> List[str]:
+    """Top frames by inclusive and by self samples."""
+    total = sum(stacks.values())
+    inclusive: Counter[str] = collections.Counter()
+    self_samples: Counter[str] = collections.Counter()
+    for stack, count in stacks.items():
+        # Frame 0 is the thread name
+        frames = stack.split(';')[1:]
+        if not frames:
+            continue
+        self_samples[frames[-1]] += count
+        for frame in set(frames):
+            if not frame.endswith(_PLUMBING_FILES, frame.rfind('(') + 1, frame.rfind(':')):
+                inclusive[frame] += count
+    lines = ['%d samples' % total, '', '%8s %6s  %s' % ('incl', '%', 'frame')]
+    for frame, count in inclusive.most_common(top):
+        lines.append('%8d %5.1f%%  %s' % (count, 100.0 * count / max(total, 1), frame))
+    lines += ['', '%8s %6s  %s' % ('self', '%', 'frame')]
+    for frame, count in self_samples.most_common(top):
+        lines.append('%8d %5.1f%%  %s' % (count, 100.0 * count / max(total, 1), frame))
+    return lines
+
+
+def _describe(paths: Iterable[Path]) -> List[Tuple[str, float]]:
+    found = []
+    for path in paths:
+        parts = path.stem.split('-')
+        try:
+            found.append(('%s %s' % (parts[1], parts[2]), float(parts[-1].rstrip('ms'))))
+        except (IndexError, ValueError):
+            continue
+    return found
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Summarize profiles written by ProfilingMiddleware.')
+    parser.add_argument('paths', nargs='+', help='profile directories or .prof/.collapsed files')
+    parser.add_argument('--top', type=int, default=25, help='rows per table')
+    parser.add_argument('--route', help='only files whose name contains this text (e.g. PUT-api_teamdb)')
+    parser.add_argument('--sort', default='cumulative', help='pstats sort key for .prof files')
+    args = parser.parse_args(argv)
+
+    files: List[Path] = []
+    for raw in args.paths:
+        path = Path(raw)
+        files.extend(sorted(path.iterdir()) if path.is_dir() else [path])
+    if args.route:
+        files = [f for f in files if args.route in f.name]
+    profs = [f for f in files if f.suffix == '.prof']
+    collapsed = [f for f in files if f.suffix == '.collapsed']
+    if not profs and not collapsed:
+        print('No profile files found')
+        return 1
+
+    requests: Dict[str, List[float]] = collections.defaultdict(list)
+    for name, ms in _describe(set(f.with_suffix('') for f in profs + collapsed)):
+        requests[name].append(ms)
+    print('Profiled requests')
+    for name, times in sorted(requests.items(), key=lambda item: -max(item[1])):
+        print('  %-45s %4d  max %8.0f ms  median %8.0f ms' % (
+            name, len(times), max(times), sorted(times)[len(times) // 2]))
+
+    if collapsed:
+        stacks: Counter[str] = collections.Counter()
+        for path in collapsed:
+            stacks.update(read_collapsed(path))
+        print('\nStack samples from %d file(s) (all threads)' % len(collapsed))
+        print('\n'.join('  ' + line for line in summarize_collapsed(stacks, args.top)))
+
+    if profs:
+        out = io.StringIO()
+        stats = pstats.Stats(*[str(p) for p in profs], stream=out)
+        stats.strip_dirs().sort_stats(args.sort).print_stats(args.top)
+        print('\ncProfile from %d file(s) (event loop thread)' % len(profs))
+        print(out.getvalue().rstrip())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
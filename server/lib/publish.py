@@ -0,0 +1,137 @@
+"""Publish the GET /api/teamdb response as static files for a web server.
+
+`SnapshotPublisher` writes each published version into its own directory
+and then points the `current` symlink at it:
+
+    publish_dir/
+        current -> 42-1f3a9c0e5b7d2a64
+        42-1f3a9c0e5b7d2a64/
+            snapshot.json        the exact body of GET /api/teamdb
+            snapshot.json.gz     for nginx `gzip_static`
+            snapshot.json.br     for `brotli_static` (needs the brotli package)
+            snapshot.json.etag   the strong ETag the service sends for snapshot.json
+
+Swapping the symlink is one rename, so a reader sees either the old or the
+new set of files, never a mix. The directory name starts with the revision,
+which lets nginx send `X-TeamDB-Revision` from `$realpath_root` (see
+server/install/nginx_server.md). The files get the snapshot's modification
+time, so `Last-Modified` matches the service's `last_modified`. The
+previous `keep` versions stay on disk for readers that resolved the link
+just before a swap; older ones are removed.
+
+The compressed copies may be added to a version after it went live (see
+`add_encodings()`); until then nginx `gzip_static` serves snapshot.json.
+
+The files are derived data and are not fsynced; the service publishes the
+current version again on every start.
+"""
+from __future__ import annotations
+import os
+import re
+import shutil
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_NAME = 'snapshot.json'
+CURRENT_LINK = 'current'
+# Suffix of the file holding each content-coding of the body
+CODING_SUFFIXES = {'gzip': '.gz', 'br': '.br'}
+
+_VERSION_RE = re.compile(r'^(\d+)-([0-9a-f]+)$')
+
+
+class SnapshotPublisher:
+    def __init__(self, directory: str | Path, keep: int = 2) -> None:
+        self.directory = Path(directory)
+        self.keep = max(1, keep)
+        self.published = 0
+
+    @staticmethod
+    def version_name(revision: int, etag: str) -> str:
+        return '%d-%s' % (revision, etag.strip('"')[:16])
+
+    def current(self) -> Optional[Tuple[int, str]]:
+        """(revision, directory name) of the published version, or None."""
+        try:
+            name = os.readlink(self.directory / CURRENT_LINK)
+        except OSError:
+            return None
+        match = _VERSION_RE.match(name)
+        return (int(match.group(1)), name) if match else None
+
+    def publish(self, revision: int, body: bytes, encodings: Dict[str, bytes], etag: str,
+                mtime: Optional[float] = None) -> bool:
+        """Publish one version unless it is already current.
+
+        Callers serialize calls and pass the current document only (the
+        service publishes under its commit lock).
+        """
+        name = self.version_name(revision, etag)
+        current = self.current()
+        if current is not None and current[1] == name:
+            return False
+        self.directory.mkdir(parents=True, exist_ok=True)
+        target = self.directory / name
+        tmp = self.directory / ('.%s.%d.tmp' % (name, os.getpid()))
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir()
+        files = {SNAPSHOT_NAME: body, SNAPSHOT_NAME + '.etag': (etag + '\n').encode('ascii')}
+        for coding, data in encodings.items():
+            if coding in CODING_SUFFIXES:
+                files[SNAPSHOT_NAME + CODING_SUFFIXES[coding]] = data
+        for filename, data in files.items():
+            path = tmp / filename
+            path.write_bytes(data)
+            if mtime is not None:
+                os.utime(path, (mtime, mtime))
+        if target.exists():
+            # Same revision and content published before a restart
+            shutil.rmtree(target)
+        tmp.rename(target)
+        link = self.directory / ('.%s.%d.tmp' % (CURRENT_LINK, os.getpid()))
+        try:
+            link.unlink()
+        except FileNotFoundError:
+            pass
+        os.symlink(name, link)
+        os.replace(link, self.directory / CURRENT_LINK)
+        self.published += 1
+        self._prune(name)
+        return True
+
+    def add_encodings(self, revision: int, etag: str, encodings: Dict[str, bytes],
+                      mtime: Optional[float] = None) -> bool:
+        """Add the compressed copies missing from a published version.
+
+        Each file is renamed into place, so the web server sees it complete or
+        not at all. Returns False if the version was pruned meanwhile.
+        """
+        target = self.directory / self.version_name(revision, etag)
+        for coding, data in encodings.items():
+            if coding not in CODING_SUFFIXES:
+                continue
+            path = target / (SNAPSHOT_NAME + CODING_SUFFIXES[coding])
+            if path.exists():
+                continue
+            tmp = target / ('.%s.%d.tmp' % (path.name, os.getpid()))
+            try:
+                tmp.write_bytes(data)
+                if mtime is not None:
+                    os.utime(tmp, (mtime, mtime))
+                tmp.rename(path)
+            except FileNotFoundError:
+                return False
+        return True
+
+    def _prune(self, current: str) -> None:
+        versions = []
+        for entry in os.scandir(self.directory):
+            match = _VERSION_RE.match(entry.name)
+            if match and entry.is_dir(follow_symlinks=False) and entry.name != current:
+                versions.append((entry.stat(follow_symlinks=False).st_mtime_ns, entry.name))
+        versions.sort(reverse=True)
+        for _, name in versions[self.keep - 1:]:
+            shutil.rmtree(self.directory / name, ignore_errors=True)
@@ -2,19 +2,141 @@
 
 This backend stores pickled Python objects under `./data/<namespace>/<key>.pkl`.
 It provides atomic writes by writing to a temporary file then renaming.
+An optional LRU read cache (`cache_size`) skips re-parsing files whose
+(inode, size, mtime) did not change.
+
+Besides 'pickle', 'json' (indented) and 'text', values can be stored in
+compact binary modes: 'json.gz' (gzip-compressed compact JSON), 'msgpack'
+and 'zstd' (zstd-compressed compact JSON); the latter two need the optional
+`msgpack` / `zstandard` packages. Loading is transparent: if a key is not
+stored in the current mode, copies written in another structured mode are
+found and decoded by their format, so switching modes keeps existing data
+readable. A save removes the copies in the other modes.
+
+`SqliteStorageBackend` offers the same API on top of a single SQLite
+database in WAL mode, with `transaction()` for atomic multi-key writes.
+
+`AsyncStorageBackend` wraps either backend for use on an asyncio event loop.
 """
 from __future__ import annotations
+import asyncio
+import functools
+import gzip
+import json
 import os
 import pickle
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, Iterable
+from concurrent.futures import Executor
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Tuple
 import logging
 
+from server.lib.lazy import optional
+
+if TYPE_CHECKING:
+    import sqlite3
+
 logger = logging.getLogger(__name__)
 
+try:
+    import msgpack  # type: ignore
+except ImportError:  # optional: enables the 'msgpack' mode
+    msgpack = None
+
+try:
+    import zstandard  # type: ignore
+except ImportError:  # optional: enables the 'zstd' mode
+    zstandard = None
+
+_GZIP_MAGIC = b"\x1f\x8b"
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def _compact_json(value: Any) -> bytes:
+    # orjson (optional) is faster; imported the first time a binary mode needs it
+    orjson = optional("orjson")
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _parse_json(raw: bytes) -> Any:
+    orjson = optional("orjson")
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _unpack_json(raw: bytes) -> Any:
+    """Decode compact JSON that may be gzip- or zstd-compressed (detected by magic bytes)."""
+    if raw[:2] == _GZIP_MAGIC:
+        raw = gzip.decompress(raw)
+    elif raw[:4] == _ZSTD_MAGIC:
+        if zstandard is None:
+            raise ValueError("zstd-compressed value but the zstandard package is not installed")
+        raw = zstandard.ZstdDecompressor().decompress(raw)
+    return _parse_json(raw)
+
+
+def _decode_text(raw: bytes) -> str:
+    # Same result as reading the file in text mode (universal newlines)
+    return raw.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
+
+
+class _Codec(NamedTuple):
+    suffix: str
+    encode: Callable[[Any], bytes]
+    decode: Callable[[bytes], Any]
+    # Name of the missing optional package, or None if the mode is usable
+    missing: Optional[str] = None
+
+
+_CODECS: Dict[str, _Codec] = {
+    "pickle": _Codec(".pkl", pickle.dumps, pickle.loads),
+    "json": _Codec(".json", lambda v: json.dumps(v, ensure_ascii=False, indent=2).encode("utf-8"), json.loads),
+    "text": _Codec("", lambda v: v.encode("utf-8"), _decode_text),
+    "json.gz": _Codec(".json.gz", lambda v: gzip.compress(_compact_json(v), compresslevel=6, mtime=0), _unpack_json),
+    "msgpack": _Codec(
+        ".msgpack",
+        lambda v: msgpack.packb(v, use_bin_type=True),
+        lambda raw: msgpack.unpackb(raw, raw=False, strict_map_key=False),
+        None if msgpack is not None else "msgpack",
+    ),
+    "zstd": _Codec(
+        ".zst",
+        lambda v: zstandard.ZstdCompressor(level=3).compress(_compact_json(v)),
+        _unpack_json,
+        None if zstandard is not None else "zstandard",
+    ),
+}
+
+# File name suffix per value mode
+_SUFFIXES = {mode: codec.suffix for mode, codec in _CODECS.items()}
+_ALL_SUFFIXES = tuple(sfx for sfx in _SUFFIXES.values() if sfx) + (".tmp",)
+# Modes holding arbitrary objects; loads fall back between these
+_STRUCTURED_MODES = ("pickle", "json", "json.gz", "msgpack", "zstd")
+
+
+def _check_mode(mode: str) -> None:
+    codec = _CODECS.get(mode)
+    if codec is None:
+        raise ValueError("unsupported mode: %s" % mode)
+    if codec.missing:
+        raise ValueError("mode %r requires the %s package" % (mode, codec.missing))
+
+
+def _lookup_modes(mode: str) -> List[str]:
+    """The current mode first, then the other readable structured modes."""
+    if mode not in _STRUCTURED_MODES:
+        return [mode]
+    return [mode] + [m for m in _STRUCTURED_MODES if m != mode and not _CODECS[m].missing]
+
 
 class FileStorageBackend:
-    def __init__(self, data_dir: str | Path = "./data") -> None:
+    def __init__(self, data_dir: str | Path = "./data", cache_size: int = 0) -> None:
         logger.debug("Initializing with data_dir=%s", data_dir)
         if not os.path.exists(data_dir):
             os.makedirs(data_dir, exist_ok=True)
@@ -22,82 +144,567 @@ class FileStorageBackend:
         self.data_dir.mkdir(parents=True, exist_ok=True)
         # storage mode: 'pickle' (binary pickled objects), 'text' (plaintext files), or 'json'
         self.mode = "pickle"
+        # Namespace directories known to exist, so saves don't mkdir every time
+        self._dirs: set[str] = set()
+        # Optional LRU of loaded values keyed by (namespace, key, mode); each
+        # entry remembers the file's (inode, size, mtime_ns) and is only
+        # served while the file still has that identity.
+        self._lock = threading.Lock()
+        self._cache: OrderedDict[Tuple[str, str, str], Tuple[Tuple[int, int, int], Any]] = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
 
-    def _ns_dir(self, namespace: str) -> Path:
+    def _ns_dir(self, namespace: str, create: bool = False) -> Path:
         ns = self.data_dir / namespace
-        ns.mkdir(parents=True, exist_ok=True)
+        if create and namespace not in self._dirs:
+            ns.mkdir(parents=True, exist_ok=True)
+            self._dirs.add(namespace)
         return ns
 
-    def _path_for(self, namespace: str, key: str) -> Path:
+    def _path_for(self, namespace: str, key: str, create: bool = False, mode: Optional[str] = None) -> Path:
         safe_key = key.replace("/", "_")
-        ns = self._ns_dir(namespace)
-        if self.mode == "text":
-            return ns / f"{safe_key}"
-        if self.mode == "json":
-            return ns / f"{safe_key}.json"
-        return ns / f"{safe_key}.pkl"
+        return self._ns_dir(namespace, create) / f"{safe_key}{_SUFFIXES[mode or self.mode]}"
 
-    def save(self, namespace: str, key: str, value: Any) -> None:
-        path = self._path_for(namespace, key)
+    def _resolve(self, namespace: str, key: str) -> Tuple[Path, str, os.stat_result]:
+        """Find the stored file for `key`: current mode first, then other modes."""
+        for mode in _lookup_modes(self.mode):
+            path = self._path_for(namespace, key, mode=mode)
+            try:
+                return path, mode, os.stat(path)
+            except FileNotFoundError:
+                continue
+        raise KeyError(key)
+
+    def _write(self, path: Path, value: Any, sync: bool = True) -> Path:
+        """Write `value` to a temporary file next to `path` and return it."""
+        # text mode expects `value` to be a str
+        payload = _CODECS[self.mode].encode(value)
         tmp = path.with_suffix(path.suffix + ".tmp")
-        if self.mode == "text":
-            # write plaintext (assume `value` is str)
-            with open(tmp, "w", encoding="utf-8") as f:
-                f.write(value)
-                f.flush()
-                os.fsync(f.fileno())
-        elif self.mode == "json":
-            import json
-            # write JSON atomically
-            with open(tmp, "w", encoding="utf-8") as f:
-                json.dump(value, f, ensure_ascii=False, indent=2)
-                f.flush()
-                os.fsync(f.fileno())
-        else:
-            with open(tmp, "wb") as f:
-                pickle.dump(value, f)
-                f.flush()
+        with open(tmp, "wb") as f:
+            f.write(payload)
+            f.flush()
+            if sync:
                 os.fsync(f.fileno())
+        return tmp
+
+    def _read(self, path: Path, mode: Optional[str] = None) -> Any:
+        with open(path, "rb") as f:
+            obj = _CODECS[mode or self.mode].decode(f.read())
+        logger.debug("Loaded %s: %s", path, type(obj))
+        return obj
+
+    def _forget(self, namespace: str, key: str) -> None:
+        if self.cache_size:
+            with self._lock:
+                self._cache.pop((namespace, key, self.mode), None)
+
+    def _drop_other_modes(self, namespace: str, key: str) -> None:
+        """Remove copies of `key` written in other modes; a later mode switch would load them instead."""
+        for mode in _lookup_modes(self.mode)[1:]:
+            try:
+                self._path_for(namespace, key, mode=mode).unlink()
+            except FileNotFoundError:
+                pass
+
+    def save(self, namespace: str, key: str, value: Any) -> None:
+        path = self._path_for(namespace, key, create=True)
+        try:
+            tmp = self._write(path, value)
+        except FileNotFoundError:
+            # Namespace directory was removed behind our back
+            self._dirs.discard(namespace)
+            path = self._path_for(namespace, key, create=True)
+            tmp = self._write(path, value)
         tmp.replace(path)
+        self._drop_other_modes(namespace, key)
+        self._forget(namespace, key)
+
+    def save_many(self, namespace: str, items: Mapping[str, Any]) -> None:
+        """Save several keys of one namespace, syncing them together.
+
+        All values are written first; the temporary files are then flushed to
+        disk back to back (so the file system can merge the journal commits),
+        renamed into place, and the directory is synced once.
+        """
+        pending = []
+        try:
+            for key, value in items.items():
+                path = self._path_for(namespace, key, create=True)
+                pending.append((self._write(path, value, sync=False), path, key))
+            for tmp, _, _ in pending:
+                fd = os.open(tmp, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+        except BaseException:
+            for tmp, _, _ in pending:
+                tmp.unlink(missing_ok=True)
+            raise
+        for tmp, path, key in pending:
+            tmp.replace(path)
+            self._drop_other_modes(namespace, key)
+            self._forget(namespace, key)
+        if pending:
+            fd = os.open(self._ns_dir(namespace), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
 
     def load(self, namespace: str, key: str) -> Any:
-        path = self._path_for(namespace, key)
-        if not path.exists():
+        if not self.cache_size:
+            try:
+                return self._read(self._path_for(namespace, key))
+            except FileNotFoundError:
+                path, mode, _ = self._resolve(namespace, key)
+                try:
+                    return self._read(path, mode)
+                except FileNotFoundError:
+                    raise KeyError(key)
+        path, mode, st = self._resolve(namespace, key)
+        ident = (st.st_ino, st.st_size, st.st_mtime_ns)
+        cache_key = (namespace, key, self.mode)
+        with self._lock:
+            hit = self._cache.get(cache_key)
+            if hit is not None and hit[0] == ident:
+                self._cache.move_to_end(cache_key)
+                self.cache_hits += 1
+                # Shared with other callers: treat cached values as read-only
+                return hit[1]
+            self.cache_misses += 1
+        try:
+            value = self._read(path, mode)
+        except FileNotFoundError:
+            raise KeyError(key)
+        with self._lock:
+            self._cache[cache_key] = (ident, value)
+            self._cache.move_to_end(cache_key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return value
+
+    def load_many(self, namespace: str, keys: Iterable[str]) -> Dict[str, Any]:
+        """Load several keys of one namespace; missing keys are left out."""
+        found: Dict[str, Any] = {}
+        for key in keys:
+            try:
+                found[key] = self.load(namespace, key)
+            except KeyError:
+                pass
+        return found
+
+    def delete(self, namespace: str, key: str) -> None:
+        # Remove copies in other modes too, or a load would fall back to them
+        removed = False
+        for mode in _lookup_modes(self.mode):
+            try:
+                self._path_for(namespace, key, mode=mode).unlink()
+                removed = True
+            except FileNotFoundError:
+                pass
+        if not removed:
             raise KeyError(key)
-        if self.mode == "text":
-            with open(path, "r", encoding="utf-8") as f:
-                data = f.read()
-                logger.debug("Loaded text %s", path)
-                return data
+        self._forget(namespace, key)
+
+    def list_keys(self, namespace: str) -> Iterable[str]:
+        """Yield the keys stored in `namespace` that `load` can read in the current mode."""
+        # Longest suffix first so "x.json.gz" is not taken for a ".json" key
+        suffixes = sorted((_SUFFIXES[m] for m in _lookup_modes(self.mode)), key=len, reverse=True)
+        try:
+            entries = os.scandir(self._ns_dir(namespace))
+        except FileNotFoundError:
+            return
+        seen = set()
+        with entries:
+            for entry in entries:
+                name = entry.name
+                if not entry.is_file():
+                    continue
+                for suffix in suffixes:
+                    if suffix:
+                        if not name.endswith(suffix):
+                            continue
+                        key = name[:-len(suffix)]
+                    elif name.endswith(_ALL_SUFFIXES):
+                        continue
+                    else:
+                        # text mode files have no extension
+                        key = name
+                    if key not in seen:
+                        seen.add(key)
+                        yield key
+                    break
+
+    def exists(self, namespace: str, key: str) -> bool:
+        try:
+            self._resolve(namespace, key)
+        except KeyError:
+            return False
+        return True
+
+    def stat(self, namespace: str, key: str) -> os.stat_result:
+        """Return the file status of a stored key (e.g. to detect changes cheaply)."""
+        return self._resolve(namespace, key)[2]
+
+    def configure(self, **options) -> None:
+        mode = options.get("mode")
+        if mode:
+            _check_mode(mode)
+            self.mode = mode
+        if "cache_size" in options:
+            with self._lock:
+                self.cache_size = int(options["cache_size"] or 0)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+
+class StorageStat(NamedTuple):
+    """Change-detection subset of `os.stat_result` for non-file backends."""
+    st_ino: int
+    st_size: int
+    st_mtime_ns: int
+
+    @property
+    def st_mtime(self) -> float:
+        return self.st_mtime_ns / 1e9
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    value BLOB NOT NULL,
+    version INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    PRIMARY KEY (namespace, key, mode)
+) WITHOUT ROWID
+"""
+
+
+class SqliteStorageBackend:
+    """Drop-in replacement for `FileStorageBackend` backed by one SQLite file.
+
+    Values are stored per (namespace, key, mode), mirroring the `.pkl`,
+    `.json` and extension-less files of the file backend, so switching
+    modes never reinterprets a value written in another mode. Every thread
+    gets its own connection; writers are serialized by SQLite itself.
+    """
+
+    def __init__(self, path: str | Path = "./data/storage.sqlite3", synchronous: str = "FULL") -> None:
+        logger.debug("Initializing with path=%s", path)
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if synchronous.upper() not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+            raise ValueError("unsupported synchronous setting: %s" % synchronous)
+        self.synchronous = synchronous.upper()
+        # storage mode: 'pickle' (binary pickled objects), 'text' (plaintext), or 'json'
+        self.mode = "pickle"
+        self._local = threading.local()
+        self._conn().execute(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Imported here so file storage never loads the sqlite3 module
+            import sqlite3
+            # isolation_level=None: autocommit unless inside transaction()
+            conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=%s" % self.synchronous)
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    @staticmethod
+    def _key(key: str) -> str:
+        return key.replace("/", "_")
+
+    def _encode(self, value: Any) -> bytes:
         if self.mode == "json":
-            import json
-            with open(path, "r", encoding="utf-8") as f:
-                obj = json.load(f)
-                logger.debug("Loaded json %s: %s", path, type(obj))
-                return obj
-        with open(path, "rb") as f:
-            obj = pickle.load(f)
-            logger.debug("Loaded %s: %s", path, type(obj))
-            return obj
+            # No one reads these by hand, so skip the file backend's indentation
+            return _compact_json(value)
+        return _CODECS[self.mode].encode(value)
+
+    def _decode(self, raw: bytes, mode: Optional[str] = None) -> Any:
+        return _CODECS[mode or self.mode].decode(bytes(raw))
+
+    def _find(self, namespace: str, key: str, columns: str) -> Optional[tuple]:
+        """Return (mode, *columns) of the row for `key`, preferring the current mode."""
+        modes = _lookup_modes(self.mode)
+        rows = self._conn().execute(
+            "SELECT mode, %s FROM kv WHERE namespace = ? AND key = ? AND mode IN (%s)" % (columns, ",".join("?" * len(modes))),
+            (namespace, self._key(key), *modes),
+        ).fetchall()
+        if not rows:
+            return None
+        return min(rows, key=lambda row: modes.index(row[0]))
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Group the saves/deletes made in this thread into one atomic commit (nestable)."""
+        conn = self._conn()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield
+            finally:
+                self._local.depth -= 1
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        self._local.depth = 1
+        try:
+            yield
+        except BaseException:
+            self._local.depth = 0
+            conn.execute("ROLLBACK")
+            raise
+        self._local.depth = 0
+        conn.execute("COMMIT")
+
+    def save(self, namespace: str, key: str, value: Any) -> None:
+        payload = self._encode(value)
+        others = _lookup_modes(self.mode)[1:]
+        with self.transaction():
+            conn = self._conn()
+            conn.execute(
+                "INSERT INTO kv (namespace, key, mode, value, version, mtime_ns) VALUES (?, ?, ?, ?, 1, ?) "
+                "ON CONFLICT (namespace, key, mode) DO UPDATE SET "
+                "value = excluded.value, version = kv.version + 1, mtime_ns = excluded.mtime_ns",
+                (namespace, self._key(key), self.mode, payload, time.time_ns()),
+            )
+            if others:
+                # Rows written in other modes would be loaded again after a mode switch
+                conn.execute(
+                    "DELETE FROM kv WHERE namespace = ? AND key = ? AND mode IN (%s)" % ",".join("?" * len(others)),
+                    (namespace, self._key(key), *others),
+                )
+
+    def save_many(self, namespace: str, items: Mapping[str, Any]) -> None:
+        """Save several keys of one namespace atomically."""
+        with self.transaction():
+            for key, value in items.items():
+                self.save(namespace, key, value)
+
+    def load(self, namespace: str, key: str) -> Any:
+        row = self._find(namespace, key, "value")
+        if row is None:
+            raise KeyError(key)
+        return self._decode(row[1], row[0])
+
+    def load_many(self, namespace: str, keys: Iterable[str]) -> Dict[str, Any]:
+        """Load several keys of one namespace in one query; missing keys are left out."""
+        wanted = {self._key(key): key for key in keys}
+        modes = _lookup_modes(self.mode)
+        rank = {mode: i for i, mode in enumerate(modes)}
+        best: Dict[str, Tuple[int, bytes, str]] = {}
+        names = list(wanted)
+        # Stay below SQLite's bound-parameter limit
+        for start in range(0, len(names), 500):
+            chunk = names[start:start + 500]
+            rows = self._conn().execute(
+                "SELECT key, mode, value FROM kv WHERE namespace = ? AND mode IN (%s) AND key IN (%s)"
+                % (",".join("?" * len(modes)), ",".join("?" * len(chunk))),
+                (namespace, *modes, *chunk),
+            ).fetchall()
+            for stored, mode, raw in rows:
+                if stored not in best or rank[mode] < best[stored][0]:
+                    best[stored] = (rank[mode], raw, mode)
+        return {wanted[stored]: self._decode(raw, mode) for stored, (_, raw, mode) in best.items()}
 
     def delete(self, namespace: str, key: str) -> None:
-        path = self._path_for(namespace, key)
-        if not path.exists():
+        modes = _lookup_modes(self.mode)
+        cur = self._conn().execute(
+            "DELETE FROM kv WHERE namespace = ? AND key = ? AND mode IN (%s)" % ",".join("?" * len(modes)),
+            (namespace, self._key(key), *modes),
+        )
+        if cur.rowcount == 0:
             raise KeyError(key)
-        path.unlink()
 
     def list_keys(self, namespace: str) -> Iterable[str]:
-        ns = self._ns_dir(namespace)
-        for p in ns.iterdir():
-            if p.is_file() and p.suffix == ".pkl":
-                yield p.stem
+        modes = _lookup_modes(self.mode)
+        rows = self._conn().execute(
+            "SELECT DISTINCT key FROM kv WHERE namespace = ? AND mode IN (%s) ORDER BY key" % ",".join("?" * len(modes)),
+            (namespace, *modes),
+        ).fetchall()
+        for (key,) in rows:
+            yield key
 
     def exists(self, namespace: str, key: str) -> bool:
-        return self._path_for(namespace, key).exists()
+        return self._find(namespace, key, "1") is not None
+
+    def stat(self, namespace: str, key: str) -> StorageStat:
+        """Return (version, size, mtime_ns) of a stored key; changes on every save."""
+        row = self._find(namespace, key, "version, length(value), mtime_ns")
+        if row is None:
+            raise KeyError(key)
+        return StorageStat(*row[1:])
 
     def configure(self, **options) -> None:
         mode = options.get("mode")
         if mode:
-            if mode not in ("pickle", "text", "json"):
-                raise ValueError("unsupported mode: %s" % mode)
+            _check_mode(mode)
             self.mode = mode
+
+    def close(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class _PendingSave:
+    __slots__ = ("value", "future")
+
+    def __init__(self, value: Any, future: asyncio.Future) -> None:
+        self.value = value
+        self.future = future
+
+
+# Result of a queued save whose owner was cancelled before writing; its waiters take over
+_ABANDONED = object()
+
+
+async def _wait_uncancelled(fut: asyncio.Future) -> bool:
+    """Wait until `fut` is done even if the calling task is cancelled; return whether it was."""
+    cancelled = False
+    while not fut.done():
+        try:
+            await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            cancelled = cancelled or not fut.cancelled()
+        except BaseException:
+            # The caller reads the outcome from `fut`
+            pass
+    return cancelled
+
+
+class AsyncStorageBackend:
+    """Awaitable wrapper around a storage backend.
+
+    Blocking calls (file I/O, fsync, SQLite) run on `executor` (the loop's
+    default executor if None). Writes are serialized per key by an
+    `asyncio.Lock`. A save issued while an earlier save of the same key is
+    still being written is queued; further saves of that key arriving in the
+    meantime replace the queued value, so a burst of saves costs at most two
+    writes and every caller returns once a value at least as new as its own
+    is on disk.
+
+    A write that has started is always finished under the key lock, even if
+    the saving task is cancelled meanwhile (the cancellation is re-raised
+    afterwards). A save cancelled while still waiting for the lock hands its
+    queued value over to the saves that joined it.
+    """
+
+    def __init__(self, backend: Any, executor: Optional[Executor] = None) -> None:
+        self.backend = backend
+        self._executor = executor
+        self._locks: Dict[Tuple[str, str], asyncio.Lock] = {}
+        self._users: Dict[Tuple[str, str], int] = {}
+        self._pending: Dict[Tuple[str, str], _PendingSave] = {}
+        self.saves = 0
+        self.writes = 0
+
+    @property
+    def coalesced(self) -> int:
+        """Saves that were absorbed by a later save of the same key."""
+        return self.saves - self.writes
+
+    async def _run(self, fn: Callable, *args: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args))
+
+    @contextmanager
+    def _key_lock(self, k: Tuple[str, str]) -> Iterator[asyncio.Lock]:
+        # Locks are dropped once no coroutine uses them, so the map stays small
+        lock = self._locks.get(k)
+        if lock is None:
+            lock = self._locks[k] = asyncio.Lock()
+        self._users[k] = self._users.get(k, 0) + 1
+        try:
+            yield lock
+        finally:
+            self._users[k] -= 1
+            if not self._users[k]:
+                del self._users[k]
+                del self._locks[k]
+
+    async def _write(self, fn: Callable, *args: Any) -> Tuple[asyncio.Future, bool]:
+        """Run a blocking write to completion, even if the calling task is cancelled meanwhile.
+
+        Returns the finished future and whether the task was cancelled; the
+        caller holds the key lock until the write is really done.
+        """
+        fut = asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(fn, *args))
+        return fut, await _wait_uncancelled(fut)
+
+    async def save(self, namespace: str, key: str, value: Any) -> None:
+        self.saves += 1
+        await self._save(namespace, key, value)
+
+    async def _save(self, namespace: str, key: str, value: Any) -> None:
+        k = (namespace, key)
+        queued = self._pending.get(k)
+        if queued is not None:
+            # Not started yet: the queued write will store our value instead
+            queued.value = value
+            if await asyncio.shield(queued.future) is _ABANDONED:
+                # Its owner was cancelled before writing; the first waiter queues the value again
+                await self._save(namespace, key, queued.value)
+            return
+        queued = self._pending[k] = _PendingSave(value, asyncio.get_running_loop().create_future())
+        started = False
+        try:
+            with self._key_lock(k) as lock:
+                async with lock:
+                    if self._pending.get(k) is queued:
+                        del self._pending[k]
+                    started = True
+                    self.writes += 1
+                    fut, cancelled = await self._write(self.backend.save, namespace, key, queued.value)
+        finally:
+            if not started:
+                # Cancelled while waiting for the key lock. If a delete took the
+                # entry meanwhile, it supersedes the queued value.
+                still_ours = self._pending.get(k) is queued
+                if still_ours:
+                    del self._pending[k]
+                queued.future.set_result(_ABANDONED if still_ours else None)
+        if fut.cancelled():
+            queued.future.cancel()
+        elif fut.exception() is not None:
+            queued.future.set_exception(fut.exception())
+            # Retrieved by the coalesced callers, if any
+            queued.future.exception()
+        else:
+            queued.future.set_result(None)
+        if cancelled:
+            raise asyncio.CancelledError
+        fut.result()
+
+    async def delete(self, namespace: str, key: str) -> None:
+        k = (namespace, key)
+        # A save queued before the delete is still written first (the lock is
+        # FIFO), but saves issued from now on must not join it
+        if k in self._pending:
+            del self._pending[k]
+        with self._key_lock(k) as lock:
+            async with lock:
+                fut, cancelled = await self._write(self.backend.delete, namespace, key)
+        if cancelled:
+            raise asyncio.CancelledError
+        fut.result()
+
+    async def load(self, namespace: str, key: str) -> Any:
+        return await self._run(self.backend.load, namespace, key)
+
+    async def load_many(self, namespace: str, keys: Iterable[str]) -> Dict[str, Any]:
+        return await self._run(self.backend.load_many, namespace, list(keys))
+
+    async def exists(self, namespace: str, key: str) -> bool:
+        return await self._run(self.backend.exists, namespace, key)
+
+    async def list_keys(self, namespace: str) -> List[str]:
+        return await self._run(lambda: list(self.backend.list_keys(namespace)))
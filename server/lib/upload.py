@@ -0,0 +1,132 @@
+"""Reading and parsing write request bodies.
+
+Bodies are read from the request stream chunk by chunk, so the size limit
+(`max_body_bytes`) is enforced before anything is buffered beyond it or
+parsed. `Content-Encoding: gzip` bodies are decompressed while they stream
+in, and the limit applies to the decompressed size as well, so a small
+compressed body cannot expand into an arbitrarily large one.
+
+`PUT /api/teamdb` picks its parser from `Content-Type` (`UPLOAD_TYPES`)
+instead of trying JSON and then YAML on the same bytes. Only a body sent
+without a Content-Type, as older scripts do, is still tried both ways.
+"""
+from __future__ import annotations
+import zlib
+from typing import Any, AsyncIterable, Optional
+import logging
+
+from server.lib.dbformat import loads_json, yaml_load
+
+logger = logging.getLogger(__name__)
+
+# Content-Encoding values accepted on uploads ('' and 'identity' = not encoded)
+GZIP_CODINGS = ('gzip', 'x-gzip')
+
+# Media type -> parser for PUT /api/teamdb. A missing Content-Type is read
+# as JSON, or as YAML when it is not valid JSON ('auto').
+UPLOAD_TYPES = {
+    'application/json': 'json',
+    'application/yaml': 'yaml',
+    'application/x-yaml': 'yaml',
+    'text/yaml': 'yaml',
+    'text/x-yaml': 'yaml',
+    # Documented for raw YAML bodies before Content-Type was checked
+    'text/plain': 'yaml',
+}
+
+
+class UploadError(Exception):
+    """The request body was rejected; `status` is the HTTP status to answer with."""
+
+    def __init__(self, status: int, detail: str) -> None:
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+
+
+def media_type(content_type: Optional[str]) -> str:
+    """'application/json' for 'Application/JSON; charset=utf-8'; '' when missing."""
+    return (content_type or '').split(';', 1)[0].strip().lower()
+
+
+def upload_parser(content_type: Optional[str]) -> str:
+    """'json', 'yaml' or 'auto' for a PUT body of this Content-Type; UploadError(415) otherwise."""
+    mtype = media_type(content_type)
+    if not mtype:
+        return 'auto'
+    if mtype in UPLOAD_TYPES:
+        return UPLOAD_TYPES[mtype]
+    if mtype.endswith('+json'):
+        return 'json'
+    if mtype.endswith('+yaml'):
+        return 'yaml'
+    raise UploadError(415, 'Unsupported Content-Type %r (expected application/json or application/yaml)' % mtype)
+
+
+def _too_large(limit: int) -> UploadError:
+    return UploadError(413, 'Request body larger than %d bytes' % limit)
+
+
+async def read_body(chunks: AsyncIterable[bytes], limit: int, content_encoding: Optional[str] = None,
+                    content_length: Optional[str] = None) -> bytes:
+    """Read a request body of at most `limit` bytes, decoding gzip on the fly.
+
+    `limit` applies to the bytes received and, for gzip, to the decompressed
+    body; 0 disables it. Raises UploadError with 413 when it is exceeded,
+    415 for an unsupported Content-Encoding and 400 for a corrupt gzip stream.
+    """
+    coding = (content_encoding or '').strip().lower()
+    if coding in ('', 'identity'):
+        decoder = None
+    elif coding in GZIP_CODINGS:
+        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    else:
+        raise UploadError(415, 'Unsupported Content-Encoding %r (expected gzip)' % coding)
+    if limit and content_length and content_length.isdigit() and int(content_length) > limit:
+        raise _too_large(limit)
+
+    received = 0
+    body = bytearray()
+    async for chunk in chunks:
+        if not chunk:
+            continue
+        received += len(chunk)
+        if limit and received > limit:
+            raise _too_large(limit)
+        if decoder is None:
+            body += chunk
+            continue
+        try:
+            # max_length 0 means unbounded, hence limit + 1 to detect overflow
+            body += decoder.decompress(chunk, limit + 1 - len(body) if limit else 0)
+        except zlib.error as e:
+            raise UploadError(400, 'Invalid gzip body: %s' % e) from e
+        if limit and (len(body) > limit or decoder.unconsumed_tail):
+            raise _too_large(limit)
+    if decoder is not None:
+        try:
+            body += decoder.flush()
+        except zlib.error as e:
+            raise UploadError(400, 'Invalid gzip body: %s' % e) from e
+        if not decoder.eof:
+            raise UploadError(400, 'Invalid gzip body: truncated')
+        if limit and len(body) > limit:
+            raise _too_large(limit)
+    return bytes(body)
+
+
+def parse_body(body: bytes, parser: str) -> Any:
+    """Parse a body with the 'json', 'yaml' or 'auto' parser; UploadError(400) when it is malformed."""
+    try:
+        if parser == 'yaml':
+            return yaml_load(body)
+        if parser == 'auto':
+            try:
+                return loads_json(body)
+            except ValueError:
+                return yaml_load(body)
+        return loads_json(body)
+    except Exception as e:
+        kind = 'JSON or YAML' if parser == 'auto' else parser.upper()
+        logger.info('Rejected %s payload: %s', kind, e)
+        raise UploadError(400, 'Invalid %s payload' % kind) from e
@@ -14,17 +14,41 @@ repo_root_str = str(repo_root)
 if repo_root_str not in sys.path:
     sys.path.insert(0, repo_root_str)
 
-from fastapi import FastAPI, HTTPException, Request, Response
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import logging
 from pathlib import Path
-import yaml
+import asyncio
+import binascii
+import functools
+import json
 import os
-import pickle
+import threading
+import time
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime
-from server.lib.storage import FileStorageBackend
-from server.lib.db_validator import validate_database, ValidationError
+from typing import NamedTuple, Optional
+from server.lib.storage import AsyncStorageBackend, FileStorageBackend, SqliteStorageBackend
+from server.lib.db_validator import (iter_integrity_errors, iter_new_integrity_errors, validate_database, ValidationBaseline,
+                                     ValidationError, ValidationErrors)
+from server.lib.backups import BackupStore
+from server.lib.auth import SessionSigner, TokenIndex, check_token, hash_token, token_fingerprint
+from server.lib.broadcast import RevisionBroadcaster
+from server.lib.changelog import ChangeLog, delta_changes, diff_entities
+from server.lib.commitqueue import CommitQueue
+from server.lib.dbcache import CODINGS, DatabaseCache, Snapshot, etag_matches
+from server.lib.dbformat import (FORMATS, SUFFIXES, content_hash, decode_json, encode_json, format_of, read_content_hash,
+                                 yaml_dump, yaml_load)
+from server.lib.dbmodel import ENTITY_KINDS, EntityIndex, entity_revision
+from server.lib.dbpatch import apply_entity_delta_indexed, apply_json_patch, PatchConflict, PatchError
+from server.lib.filelock import ProcessLock
+from server.lib.journal import Journal, SNAPSHOT_HEADER, fsync_dir, read_snapshot_revision, replay
+from server.lib.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsMiddleware, Registry
+from server.lib.publish import SnapshotPublisher
+from server.lib.upload import UploadError, parse_body, read_body, upload_parser
 import sys
 
 
@@ -38,81 +62,49 @@ logging.basicConfig(level=DEFAULT_LOG_LEVEL, format='%(asctime)s %(levelname)s [
 logger = logging.getLogger(__name__)
 
 
-# Load server config (required). Expect `teamdb_config.yml` to be in the same directory as this file.
-CONFIG_PATH = Path(__file__).resolve().parent / 'teamdb_config.yaml'
+# Expect `teamdb_config.yml` to be in the same directory as this file, unless
+# TEAMDB_CONFIG names another file (used by the benchmarks to run against a scratch data_root).
+DEFAULT_CONFIG_PATH = Path(__file__).resolve().parent / 'teamdb_config.yaml'
 EXAMPLE_CONFIG_PATH = Path(__file__).resolve().parent / 'example-teamdb_config.yaml'
-server_config = {}
-if not CONFIG_PATH.exists():
-    if EXAMPLE_CONFIG_PATH.exists():
-        logger.error('Missing required config file: %s', CONFIG_PATH)
-        logger.error('A template exists at %s. Please edit it and save as %s, then restart the service.', EXAMPLE_CONFIG_PATH, CONFIG_PATH)
-        sys.exit(2)
-    else:
-        logger.error('Missing required config file: %s and no example template found at %s', CONFIG_PATH, EXAMPLE_CONFIG_PATH)
-        sys.exit(2)
-else:
-    try:
-        with CONFIG_PATH.open('r', encoding='utf-8') as cf:
-            server_config = yaml.safe_load(cf) or {}
-    except Exception:
-        logger.exception('Failed to load server config from %s', CONFIG_PATH)
-        sys.exit(2)
 
-# Default storage path (relative to repo root or as configured)
-DATA_ROOT = Path(server_config.get('data_root', str(Path(__file__).resolve().parent.parent / 'data')))
-ROOT_DATA_DIR = DATA_ROOT
-DEFAULT_DB_PATH = ROOT_DATA_DIR / 'config' / 'database.yaml'
-DEFAULT_DB_PATH.parent.mkdir(parents=True, exist_ok=True)
-
-# Storage backend for tokens
-stor = FileStorageBackend(ROOT_DATA_DIR)
-stor.configure(mode='json')
 TOKENS_NAMESPACE = 'tokens'
 TOKENS_KEY = 'tokens'
+SESSION_SECRET_KEY = 'session_secret'
+REVISION_NAMESPACE = 'teamdb'
+REVISION_KEY = 'revision'
+DB_NAMESPACE = 'teamdb'
+DB_KEY = 'database'
 
-# Backup settings
-MAX_BACKUPS = int(server_config.get('max_backups', 10))
-BACKUP_DIR = DEFAULT_DB_PATH.parent / 'backups'
-BACKUP_DIR.mkdir(parents=True, exist_ok=True)
+# At most this many problems are listed in a 400 response
+MAX_REPORTED_ERRORS = 50
 
+# Walking the backup store costs time proportional to its size, so scrapes
+# reuse the result for up to BACKUP_USAGE_TTL seconds
+BACKUP_USAGE_TTL = 60.0
 
-def load_database(path: Path = DEFAULT_DB_PATH):
-    if not path.exists():
-        logger.info('Database file not found at %s', path)
-        raise FileNotFoundError(str(path))
-    with path.open('r', encoding='utf-8') as f:
-        return yaml.safe_load(f)
 
+class ConfigError(Exception):
+    """The service configuration is missing or invalid."""
 
-def save_database(data, path: Path = DEFAULT_DB_PATH):
-    try:
-        # Rotate existing db into backups first
-        if path.exists():
-            ts = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
-            backup_path = BACKUP_DIR / f"database.{ts}.yaml"
-            with path.open('r', encoding='utf-8') as src, backup_path.open('w', encoding='utf-8') as dst:
-                dst.write(src.read())
-
-            # Prune old backups
-            backups = sorted(BACKUP_DIR.glob('database.*.yaml'), key=lambda p: p.name, reverse=True)
-            for old in backups[MAX_BACKUPS:]:
-                try:
-                    old.unlink()
-                except Exception:
-                    logger.debug('Failed to remove old backup %s', old)
 
-        with path.open('w', encoding='utf-8') as f:
-            yaml.safe_dump(data, f, sort_keys=False, allow_unicode=True)
+def load_config(path: Optional[Path] = None) -> dict:
+    """Read the server config from `path`, $TEAMDB_CONFIG or teamdb_config.yaml."""
+    path = Path(path or os.environ.get('TEAMDB_CONFIG') or DEFAULT_CONFIG_PATH)
+    if not path.exists():
+        if EXAMPLE_CONFIG_PATH.exists():
+            raise ConfigError(f'Missing required config file: {path}. A template exists at {EXAMPLE_CONFIG_PATH}. '
+                              f'Please edit it and save as {path}, then restart the service.')
+        raise ConfigError(f'Missing required config file: {path} and no example template found at {EXAMPLE_CONFIG_PATH}')
+    try:
+        with path.open('r', encoding='utf-8') as cf:
+            config = yaml_load(cf) or {}
     except Exception as e:
-        logger.exception('Failed to save database to %s: %s', path, e)
-        raise
+        raise ConfigError(f'Failed to load server config from {path}: {e}') from e
+    if not isinstance(config, dict):
+        raise ConfigError(f'Server config {path} must be a mapping')
+    return config
 
-# -- FastAPI app setup --
-app = FastAPI(title="Team DB Service")
 
-# Allow requests from extension and local dev hosts
-# Configure CORS from server_config. `allow_origins` may be a list or a comma-separated string.
-raw_allow = server_config.get('allow_origins', None)
 def _parse_allow_origins(raw):
     if raw is None:
         # Sensible default: only allow localhost for development
@@ -125,65 +117,1270 @@ def _parse_allow_origins(raw):
     # fallback
     return ['http://127.0.0.1', 'http://localhost']
 
-allow_origins = _parse_allow_origins(raw_allow)
 
-# If wildcard is present, do not allow credentials for security reasons
-allow_credentials = False
-if '*' in allow_origins and allow_origins != ['*']:
-    # If somebody included '*' along with other origins, keep '*' but disable credentials
-    allow_credentials = False
-elif allow_origins == ['*']:
-    allow_credentials = False
+def _file_size(path: Path) -> Optional[int]:
+    try:
+        return path.stat().st_size
+    except FileNotFoundError:
+        return None
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=allow_origins,
-    allow_credentials=allow_credentials,
-    allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-    allow_headers=["*"],
-)
 
+class Committed(NamedTuple):
+    revision: int
+    last_modified: Optional[str]
+    # Snapshot of the stored document, for its ETag; only set for the last
+    # write of a batch, since the versions before it were never stored on their own
+    snapshot: Optional[Snapshot]
 
-@app.get('/api/teamdb', response_class=JSONResponse)
-async def api_get_teamdb():
-    """Return the team database as JSON."""
-    try:
-        data = load_database()
-        # include last_modified timestamp based on file mtime
-        mtime = None
+
+class CommitState:
+    """The database a queued write applies to.
+
+    For the first write of a batch this is the stored snapshot; for later
+    ones it is the result of the writes before them, which are committed in
+    the same batch. Such a version was never readable by clients, so it has
+    no ETag and counts as modified now.
+    """
+
+    def __init__(self, data, revision: int, modified: Optional[datetime], snapshot=None, index=None) -> None:
+        self.data = data
+        self.revision = revision
+        self.modified = modified
+        self._snapshot = snapshot
+        self._index = index
+
+    @classmethod
+    def of(cls, snap, revision: int) -> 'CommitState':
+        if snap is None:
+            return cls(None, revision, None)
+        # The cache key also covers the journal or the SQLite row, depending on the storage mode
+        modified = datetime.utcfromtimestamp(max(snap.key[2::3]) / 1e9)
+        return cls(snap.data, revision, modified, snap, snap.index)
+
+    @property
+    def etags(self) -> list:
+        # Only If-Match writes need the ETags, which render the stored body
+        return self._snapshot.all_etags() if self._snapshot is not None else []
+
+    @property
+    def index(self) -> EntityIndex:
+        if self._index is None:
+            self._index = EntityIndex(self.data)
+        return self._index
+
+    def require(self) -> None:
+        if self.data is None:
+            raise HTTPException(status_code=404, detail='Database not found')
+
+    def after(self, data, index=None) -> 'CommitState':
+        return CommitState(data, self.revision + 1, datetime.utcnow(), index=index)
+
+
+class TeamDB:
+    """One service instance: settings, storage, caches and the revision counter.
+
+    Constructing it only reads the config; files, directories and stores are
+    touched by `open()` (run by the app's startup hook, or by the first
+    request if the app is used without one) and the database is parsed by
+    `warm_up()`. Instances share nothing, so several apps can run side by
+    side on different data roots.
+    """
+
+    def __init__(self, config: Optional[dict] = None) -> None:
+        self.config = dict(config or {})
+        cfg = self.config
+
+        # Default storage path (relative to repo root or as configured)
+        self.data_root = Path(cfg.get('data_root', str(repo_root / 'data')))
+
+        # Format of the database file: 'yaml' keeps database.yaml as the stored
+        # copy; 'json' stores database.json (compact JSON with a content hash,
+        # several times faster to load and save) and exports database.yaml from
+        # it `yaml_export_interval` seconds after a commit (0 disables).
+        self.database_format = str(cfg.get('database_format', 'yaml')).lower()
+        if self.database_format not in FORMATS:
+            raise ConfigError(f'Unknown database_format {self.database_format!r} (expected yaml or json)')
+        self.yaml_path = self.data_root / 'config' / 'database.yaml'
+        self.db_path = self.yaml_path.with_suffix(SUFFIXES[self.database_format])
+        self.yaml_export_interval = float(cfg.get('yaml_export_interval', 30))
+
+        # Storage backend for tokens and service state: 'file' (one JSON file per
+        # key under data_root) or 'sqlite' (a single WAL-mode SQLite database)
+        self.storage_backend = str(cfg.get('storage_backend', 'file')).lower()
+        if self.storage_backend not in ('file', 'sqlite'):
+            raise ConfigError(f'Unknown storage_backend {self.storage_backend!r} (expected file or sqlite)')
+        self.sqlite_path = Path(cfg.get('sqlite_path', str(self.data_root / 'teamdb.sqlite3')))
+        self.sqlite_synchronous = str(cfg.get('sqlite_synchronous', 'FULL'))
+        # Value encoding: json (default), json.gz, msgpack, zstd or pickle. Values
+        # written in another mode stay readable, so this can be changed at any time.
+        self.storage_value_mode = str(cfg.get('storage_value_mode', 'json'))
+        self.session_ttl = int(cfg.get('session_ttl', 3600))
+
+        # Storage mode: 'snapshot' rewrites the database file on every commit;
+        # 'journal' appends each mutation to a write-ahead journal and compacts it
+        # into the database file in the background; 'sqlite' keeps the document in
+        # the SQLite store (imported from the database file on first start).
+        self.storage_mode = str(cfg.get('storage_mode', 'snapshot')).lower()
+        if self.storage_mode not in ('snapshot', 'journal', 'sqlite'):
+            raise ConfigError(f'Unknown storage_mode {self.storage_mode!r} (expected snapshot, journal or sqlite)')
+        self.journal_path = self.db_path.parent / 'database.journal'
+        self.journal_compact_interval = float(cfg.get('journal_compact_interval', 60))
+        self.journal_compact_bytes = int(cfg.get('journal_compact_bytes', 4 * 1024 * 1024))
+
+        # Backup settings: every committed version goes into a deduplicated,
+        # compressed store; the newest `max_backups` versions are retained.
+        self.max_backups = int(cfg.get('max_backups', 200))
+        self.backup_dir = self.db_path.parent / 'backups'
+
+        # Revision counter / change feed settings
+        self.max_changes = int(cfg.get('max_changes', 1000))
+        self.events_keepalive = float(cfg.get('events_keepalive', 25))
+
+        # Reject writes that add dangling team/person references, duplicate names
+        # or team hierarchy cycles. Off by default: data exported from other
+        # systems commonly names managers who are not in `people`
+        self.validate_references = bool(cfg.get('validate_references', False))
+        # Largest accepted write body, after gzip decoding (0 = no limit)
+        self.max_body_bytes = int(cfg.get('max_body_bytes', 32 * 1024 * 1024))
+
+        # Parse the database in the startup hook instead of on the first GET
+        self.warm_up_enabled = bool(cfg.get('warm_up', True))
+
+        # Static publishing: every commit writes the GET /api/teamdb body (plus
+        # .gz/.br variants and an ETag sidecar) below publish_dir, so a web
+        # server can answer reads without calling the service
+        self.publish_dir = Path(cfg['publish_dir']) if cfg.get('publish_dir') else None
+        self.publisher = SnapshotPublisher(self.publish_dir) if self.publish_dir is not None else None
+        self._publish_lock = threading.Lock()
+
+        # Blocking work (file I/O, YAML, PBKDF2) runs on this bounded pool so the
+        # event loop keeps serving reads while a write is in progress. Threads
+        # are only started when work is submitted.
+        self.io_workers = int(cfg.get('io_workers', 4))
+        self.io_executor = ThreadPoolExecutor(max_workers=self.io_workers, thread_name_prefix='teamdb-io')
+
+        # Prometheus metrics for GET /api/metrics. Stage timings are taken inside the
+        # work itself (on the I/O pool), so they exclude time spent waiting for a thread.
+        self.metrics_enabled = bool(cfg.get('metrics_enabled', True))
+        self.metrics = Registry()
+        self.request_seconds = self.metrics.histogram(
+            'teamdb_request_duration_seconds', 'Request latency by method and route template.', ('method', 'route'))
+        self.responses = self.metrics.counter(
+            'teamdb_responses_total', 'Responses by method, route template and status code.',
+            ('method', 'route', 'status'))
+        self.conflicts = self.metrics.counter(
+            'teamdb_write_conflicts_total', 'Writes rejected with 412 because the client copy was stale.',
+            ('method', 'route'))
+        self.stage_seconds = self.metrics.histogram(
+            'teamdb_stage_duration_seconds',
+            'Time spent per stage: parse, validate, auth, lock (waiting for the commit lock), precondition, '
+            'patch, save (whole commit), dump (YAML write), journal, sqlite, backup, load, compact.', ('stage',))
+
+        # Request profiling (off by default). With profiling_enabled, a
+        # profile_sample_rate fraction of requests is profiled with cProfile and
+        # requests slower than profile_slow_ms keep their stack samples. Independently,
+        # with profile_header, requests from localhost (not relayed by a proxy) can
+        # ask for a profile with `X-TeamDB-Profile: 1`. Files rotate in profile_dir.
+        self.profiling_enabled = bool(cfg.get('profiling_enabled', False))
+        self.profile_header = bool(cfg.get('profile_header', False))
+        self.profile_dir = Path(cfg.get('profile_dir', str(self.data_root / 'profiles')))
+        self.profile_sample_rate = float(cfg.get('profile_sample_rate', 0.0)) if self.profiling_enabled else 0.0
+        self.profile_slow_ms = float(cfg.get('profile_slow_ms', 0.0)) if self.profiling_enabled else 0.0
+        self.profile_interval_ms = float(cfg.get('profile_interval_ms', 5.0))
+        self.profile_max_files = int(cfg.get('profile_max_files', 200))
+
+        # Serializes read-modify-write commits (precondition check through save)
+        # within this process; see commit_lock() for the one shared by all workers
+        self.write_lock = asyncio.Lock()
+        # Writes are applied in order by one worker task; writes queued while a
+        # batch is being saved form the next batch, which is written to disk
+        # and to the backups once
+        self.commit_batch_max = int(cfg.get('commit_batch_max', 64))
+        self.commit_seconds = self.metrics.histogram(
+            'teamdb_commit_duration_seconds', 'Time from queueing a write until it was committed or rejected.')
+        self.commit_batch_size = self.metrics.histogram(
+            'teamdb_commit_batch_size', 'Writes committed together with one database write.',
+            buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+        self.commit_queue = CommitQueue(self._apply_batch, max_batch=self.commit_batch_max,
+                                        latency=self.commit_seconds, batch_size=self.commit_batch_size)
+        # Held by the process that commits, so several workers (uvicorn --workers N)
+        # can share one data_root: check-then-write is atomic across processes
+        self.process_lock = ProcessLock(self.data_root / 'teamdb.lock')
+        # How often each worker looks for commits made by other workers while
+        # /api/teamdb/events streams are open (0 disables)
+        self.worker_sync_interval = float(cfg.get('worker_sync_interval', 1.0))
+        # Serializes read-modify-write of the token map
+        self._tokens_lock = asyncio.Lock()
+        # Held while appending to the journal or swapping in a compacted snapshot
+        self._journal_lock = threading.RLock()
+        # Guards the revision counter/committed key, updated from I/O threads and the loop
+        self._revision_lock = threading.RLock()
+        # Compaction is scheduled by commits: a timer folds the journal into the
+        # database file `journal_compact_interval` seconds after the first
+        # uncompacted write, or right away once it exceeds `journal_compact_bytes`.
+        self._compaction_timer: Optional[threading.Timer] = None
+        self._compaction_lock = threading.Lock()
+        # database.yaml export (database_format: json), scheduled the same way
+        self._export_timer: Optional[threading.Timer] = None
+        self._export_lock = threading.Lock()
+        self._exported_key = None
+        # Wakes /api/teamdb/events subscribers whenever the revision changes
+        self.broadcaster = RevisionBroadcaster()
+        # Entries of the last full upload that passed validation; unchanged entries
+        # of the next upload are compared against it instead of re-validated
+        self._validated_baseline: Optional[ValidationBaseline] = None
+        self._backup_usage = {'at': None, 'bytes': 0}
+
+        # Set up by open()
+        self.stor = None
+        self.astor: Optional[AsyncStorageBackend] = None
+        self.db_store = None
+        self.journal: Optional[Journal] = None
+        self.token_index: Optional[TokenIndex] = None
+        self.session_signer: Optional[SessionSigner] = None
+        self.backup_store: Optional[BackupStore] = None
+        self.db_cache: Optional[DatabaseCache] = None
+        self.changelog: Optional[ChangeLog] = None
+        self._committed_key = None
+        self._open_lock = threading.Lock()
+        self.opened = False
+        # Readiness: warm-up state reported by GET /api/ready
+        self.warming = False
+        self.warm_error: Optional[str] = None
+
+    # -- lifecycle --
+
+    def open(self) -> None:
+        """Create directories and stores, import old data and recover the journal.
+
+        Blocking and idempotent; safe to call from several threads.
+        """
+        with self._open_lock, self.process_lock:
+            if self.opened:
+                return
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            json_path = self.yaml_path.with_suffix(SUFFIXES['json'])
+            if self.database_format == 'yaml' and self.storage_mode != 'sqlite' and json_path.exists():
+                # database.yaml is only an export of it and may be behind
+                raise ConfigError(f'{json_path} exists: set database_format: json, or convert it back with '
+                                  f'`python3 teamdb.py migrate --to yaml`')
+            if self.storage_backend == 'sqlite':
+                self.stor = SqliteStorageBackend(self.sqlite_path, synchronous=self.sqlite_synchronous)
+            else:
+                self.stor = FileStorageBackend(self.data_root, cache_size=int(self.config.get('storage_cache_size', 64)))
+            try:
+                self.stor.configure(mode=self.storage_value_mode)
+            except ValueError as e:
+                raise ConfigError(f'Invalid storage_value_mode: {e}') from e
+            self._import_file_storage((TOKENS_NAMESPACE, TOKENS_KEY), (TOKENS_NAMESPACE, SESSION_SECRET_KEY),
+                                      (REVISION_NAMESPACE, REVISION_KEY))
+
+            # In-memory token map, reloaded only when tokens.json changes
+            self.token_index = TokenIndex(self.stor, TOKENS_NAMESPACE, TOKENS_KEY)
+            self.session_signer = SessionSigner(self._load_session_secret(), ttl=self.session_ttl)
+
+            self.backup_dir.mkdir(parents=True, exist_ok=True)
+            self.backup_store = BackupStore(self.backup_dir, max_versions=self.max_backups)
+
+            # Storage access from request handlers: per-key write serialization and
+            # coalescing, with the blocking calls on the I/O pool
+            self.astor = AsyncStorageBackend(self.stor, executor=self.io_executor)
+
+            if self.storage_mode == 'sqlite':
+                self.db_store = (self.stor if isinstance(self.stor, SqliteStorageBackend)
+                                 else SqliteStorageBackend(self.sqlite_path, synchronous=self.sqlite_synchronous))
+                self.db_store.configure(mode=self.storage_value_mode)
+            self.journal = Journal(self.journal_path)
+            self._import_yaml_database()
+
+            # Parsed database cache shared by all requests of this instance. In journal
+            # mode its key also covers the journal so every append is seen by readers;
+            # in sqlite mode it is the stored row's (version, size, mtime).
+            self.db_cache = DatabaseCache(
+                self.db_path,
+                self.load_current_database,
+                extra_paths=[self.journal_path] if self.storage_mode == 'journal' else (),
+                key_func=self._sqlite_db_key if self.db_store is not None else None,
+            )
+
+            # Revision counter and in-memory per-entity change log. The counter is
+            # persisted together with the identity of the file it describes so edits
+            # made to database.yaml behind the service's back still bump the revision.
+            state = self._load_revision_state()
+            self.changelog = ChangeLog(revision=int(state.get('revision', 0)), max_entries=self.max_changes)
+            self._committed_key = tuple(state['key']) if state.get('key') else None
+            if (self.database_format == 'json' and self.db_store is None
+                    and not self.db_path.exists() and self.yaml_path.exists()):
+                logger.info('Converting %s to %s', self.yaml_path, self.db_path)
+                self.convert_database(self.yaml_path, self.db_path)
+            self._recover_journal()
+            self._register_gauges()
+            self.opened = True
+
+    async def start(self) -> None:
+        """Run `open()` on the I/O pool unless it already ran."""
+        if not self.opened:
+            await self.run_blocking(self.open)
+
+    def warm_up(self) -> None:
+        """Parse the database and the token map so the first requests are served from memory."""
+        self.warming = True
+        try:
+            self.open()
+            self.token_index.tokens()
+            self.sync_revision(self.db_cache.get())
+            self.publish_current()
+            self.warm_error = None
+        except FileNotFoundError:
+            logger.info('No database at %s yet; nothing to warm up', self.db_path)
+        except Exception as e:
+            logger.exception('Failed to load the database during warm-up: %s', e)
+            self.warm_error = str(e)
+        finally:
+            self.warming = False
+
+    def readiness(self) -> dict:
+        """{'ready': bool, 'status': ...} for GET /api/ready."""
+        snap = self.db_cache.current() if self.db_cache is not None else None
+        if snap is not None:
+            return {'ready': True, 'status': 'ready', 'revision': self.changelog.revision,
+                    'last_modified': snap.last_modified}
+        if not self.opened or self.warming:
+            return {'ready': False, 'status': 'starting'}
+        if self.warm_error:
+            return {'ready': False, 'status': 'error', 'detail': self.warm_error}
+        stored = (self.db_store.exists(DB_NAMESPACE, DB_KEY) if self.db_store is not None
+                  else self.db_path.exists())
+        if not stored:
+            # Nothing to load; the first PUT creates the database
+            return {'ready': True, 'status': 'empty', 'revision': self.changelog.revision}
+        return {'ready': False, 'status': 'not loaded'}
+
+    def close(self) -> None:
+        """Stop background work and release files; pending journal records are replayed on the next start."""
+        with self._compaction_lock:
+            if self._compaction_timer is not None:
+                self._compaction_timer.cancel()
+                self._compaction_timer = None
+        with self._export_lock:
+            pending_export, self._export_timer = self._export_timer, None
+        if pending_export is not None:
+            # Leave an up-to-date database.yaml behind
+            pending_export.cancel()
+            self._run_export()
+        self.io_executor.shutdown(wait=True)
+        if self.journal is not None:
+            self.journal.close()
+        for store in {id(s): s for s in (self.stor, self.db_store) if s is not None}.values():
+            if hasattr(store, 'close'):
+                store.close()
+        self.process_lock.close()
+
+    @asynccontextmanager
+    async def commit_lock(self):
+        """Hold the commit lock of this process and of all workers sharing data_root."""
+        async with self.write_lock, self._process_locked():
+            yield
+
+    @asynccontextmanager
+    async def _process_locked(self):
+        # Waiting for another worker is blocking, so it happens on the I/O pool.
+        # If the request is cancelled meanwhile, the lock is released once acquired.
+        fut = asyncio.get_running_loop().run_in_executor(self.io_executor, self.process_lock.acquire)
+        try:
+            with self.stage_seconds.time('lock'):
+                await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            fut.add_done_callback(lambda f: f.cancelled() or f.exception() or self.process_lock.release())
+            raise
+        try:
+            yield
+        finally:
+            self.process_lock.release()
+
+    async def watch_commits(self) -> None:
+        """Wake event-stream subscribers for commits made by other workers (and publish outside edits)."""
+        while True:
+            await asyncio.sleep(self.worker_sync_interval)
+            if ((not self.broadcaster.subscribers and self.publisher is None)
+                    or self.db_cache.key() == self._committed_key):
+                continue
+            try:
+                snap = await self.run_blocking(self.db_cache.get)
+                await self.run_blocking(self.sync_revision, snap)
+            except FileNotFoundError:
+                pass
+            except Exception:
+                logger.exception('Failed to pick up commits made by other workers')
+
+    async def run_blocking(self, fn, *args, **kwargs):
+        """Run a blocking callable on the I/O pool and await its result."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.io_executor, functools.partial(fn, *args, **kwargs))
+
+    def timed(self, stage: str, fn, *args, **kwargs):
+        """Call `fn` and record its duration as `stage` in the stage histogram."""
+        with self.stage_seconds.time(stage):
+            return fn(*args, **kwargs)
+
+    # -- storage setup --
+
+    def _import_file_storage(self, *keys) -> None:
+        """Copy (namespace, key) entries written by the file backend into a new SQLite store."""
+        if not isinstance(self.stor, SqliteStorageBackend):
+            return
+        files = FileStorageBackend(self.data_root)
+        files.configure(mode='json')
+        for namespace, key in keys:
+            if not self.stor.exists(namespace, key) and files.exists(namespace, key):
+                self.stor.save(namespace, key, files.load(namespace, key))
+                logger.info('Imported %s/%s into %s', namespace, key, self.sqlite_path)
+
+    def _load_session_secret(self) -> bytes:
+        """Load the HMAC key for session tokens, creating it on first start."""
+        try:
+            return binascii.unhexlify(self.stor.load(TOKENS_NAMESPACE, SESSION_SECRET_KEY)['secret'])
+        except (KeyError, TypeError, ValueError, binascii.Error):
+            secret = secrets.token_bytes(32)
+            self.stor.save(TOKENS_NAMESPACE, SESSION_SECRET_KEY, {'secret': binascii.hexlify(secret).decode('ascii')})
+            return secret
+
+    def _sqlite_db_key(self):
         try:
-            stat = DEFAULT_DB_PATH.stat()
-            mtime = datetime.utcfromtimestamp(stat.st_mtime).strftime('%Y-%m-%dT%H:%M:%SZ')
+            return tuple(self.db_store.stat(DB_NAMESPACE, DB_KEY))
+        except KeyError:
+            return None
+
+    def _import_yaml_database(self) -> None:
+        """Seed the SQLite store from the database file (plus any journal) on first start."""
+        path = self.db_path if self.db_path.exists() else self.yaml_path
+        if self.db_store is None or self.db_store.exists(DB_NAMESPACE, DB_KEY) or not path.exists():
+            return
+        data, applied, _ = replay(self.load_database(path), self.journal, read_snapshot_revision(path))
+        self.db_store.save(DB_NAMESPACE, DB_KEY, data)
+        logger.info('Imported %s (%d journal records) into %s', path, applied, self.sqlite_path)
+        if path != self.yaml_path:
+            # Only database.yaml is kept current (as an export); move the
+            # imported database.json aside so nothing reads it stale
+            path.replace(path.with_name(path.name + '.imported'))
+
+    # -- loading and saving the database --
+
+    def load_database(self, path: Optional[Path] = None):
+        path = path or self.db_path
+        if not path.exists():
+            logger.info('Database file not found at %s', path)
+            raise FileNotFoundError(str(path))
+        if format_of(path) == 'json':
+            return decode_json(path.read_bytes(), path)
+        with path.open('r', encoding='utf-8') as f:
+            return yaml_load(f)
+
+    def load_current_database(self, path: Optional[Path] = None):
+        """Load the snapshot at `path` and replay the journal records it does not include yet."""
+        path = path or self.db_path
+        with self.stage_seconds.time('load'):
+            if self.db_store is not None and path == self.db_path:
+                try:
+                    return self.db_store.load(DB_NAMESPACE, DB_KEY)
+                except KeyError:
+                    raise FileNotFoundError(f'{self.sqlite_path}:{DB_NAMESPACE}/{DB_KEY}')
+            data = self.load_database(path)
+            if path == self.db_path:
+                data, applied, _ = replay(data, self.journal, read_snapshot_revision(path))
+                if applied:
+                    logger.info('Replayed %d journal records onto %s', applied, path)
+            return data
+
+    def _record_backup(self, prev, data, revision: int) -> None:
+        """Add the committed version (and the one it replaced, if not stored yet) to the backups."""
+        try:
+            with self.stage_seconds.time('backup'):
+                if prev is not None and not self.backup_store.is_latest(prev.data):
+                    # First write after a start or an outside edit: keep what it replaced
+                    self.backup_store.add(prev.data, revision - 1)
+                self.backup_store.add(data, revision)
         except Exception:
-            mtime = None
-        # If the on-disk YAML already contains a top-level 'database' key,
-        # return that document as-is (with last_modified) to avoid double-wrapping
-        if isinstance(data, dict) and 'database' in data:
-            content = dict(data)
-            content['last_modified'] = mtime
-            return JSONResponse(content=content)
-
-        return JSONResponse(content={'database': data, 'last_modified': mtime})
-    except FileNotFoundError:
-        raise HTTPException(status_code=404, detail='Database not found')
+            logger.exception('Failed to record backup version for revision %s', revision)
+
+    def _dump_database(self, data, path: Path, revision: Optional[int] = None, fmt: Optional[str] = None,
+                       tmp: Optional[Path] = None, header: str = '') -> Path:
+        """Durably write `data` next to `path` and return the temporary file.
+
+        Renaming it over `path` (`_replace`) then swaps the file atomically, so
+        concurrent readers never see a half-written database and a crash leaves
+        either the old or the new file. `revision` is recorded in a header
+        comment for journal replay. The format follows `path`'s suffix unless
+        `fmt` is given.
+        """
+        tmp = tmp or path.with_suffix(path.suffix + '.tmp')
+        try:
+            with self.stage_seconds.time('dump'), tmp.open('wb') as f:
+                if (fmt or format_of(path)) == 'json':
+                    f.write(encode_json(data, revision)[0])
+                else:
+                    if revision is not None:
+                        header = SNAPSHOT_HEADER % revision + header
+                    f.write(header.encode('utf-8'))
+                    yaml_dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        return tmp
+
+    @staticmethod
+    def _replace(tmp: Path, path: Path) -> None:
+        tmp.replace(path)
+        fsync_dir(path.parent)
+
+    def save_database(self, data, path: Optional[Path] = None, mutation: Optional[tuple] = None):
+        """Write `data` to `path` and record the new version in the backups.
+
+        For the primary database this also refreshes the in-memory snapshot and
+        commits a new revision to the change log; the new revision is returned.
+        In journal mode the commit only appends `mutation` (an `(op, value)`
+        pair, see `server.lib.journal`; defaults to a full replacement) to the
+        journal and the YAML file is rewritten later by `compact_journal()`.
+        Callers checking preconditions first should hold `commit_lock()`.
+        """
+        path = path or self.db_path
+        with self.process_lock:
+            if path != self.db_cache.path:
+                self._replace(self._dump_database(data, path), path)
+                return None
+            try:
+                prev = self.db_cache.get()
+                self.sync_revision(prev)
+            except FileNotFoundError:
+                prev = None
+            return self.commit_versions(prev, [(data, mutation or ('replace', data))])[-1]
+
+    def commit_versions(self, prev, versions, indexes: Optional[list] = None) -> list:
+        """Persist consecutive versions of the primary database with one write.
+
+        `versions` lists `(data, mutation)` pairs, each built on the one before
+        it (the first on `prev`, the current snapshot or None). Each version
+        gets its own revision and change-log entry, but the database is written
+        once (one YAML dump, one journal append or one SQLite transaction) and
+        only the last version goes into the backups. `indexes` optionally holds
+        the `EntityIndex` of each version (None where unknown) so it is not
+        rebuilt. Returns the revisions. The caller holds the process lock and
+        has synced `prev`.
+        """
+        data = versions[-1][0]
+        indexes = indexes or [None] * len(versions)
+        changes = self._diff_versions(prev, versions, indexes)
+        if self.db_store is not None:
+            revisions = self._sqlite_commit(data, changes, indexes[-1])
+        elif self.storage_mode == 'journal' and prev is not None:
+            revisions = self._journal_commit(versions, changes, indexes[-1])
+        else:
+            revisions = self._snapshot_commit(data, changes, indexes[-1])
+        self._record_backup(prev, data, revisions[-1])
+        self._publish(self.db_cache.current(), revisions[-1])
+        self._schedule_export()
+        return revisions
+
+    @staticmethod
+    def _diff_versions(prev, versions, indexes) -> list:
+        """Per-entity changes of every version against the one before it."""
+        changes = []
+        before, index = (prev.data, prev.index) if prev is not None else (None, None)
+        for (data, (op, value)), new_index in zip(versions, indexes):
+            if op == 'delta' and index is not None:
+                # The delta names what it changed; no need to compare every entry
+                changes.append(delta_changes(value, index))
+            else:
+                changes.append(diff_entities(before, data, index, new_index))
+            before, index = data, new_index
+        return changes
+
+    def _snapshot_commit(self, data, changes, index=None) -> list:
+        path = self.db_path
+        try:
+            with self._journal_lock:
+                # The new snapshot includes everything, so stamp it with the
+                # revision it commits and drop any journal records it covers.
+                revision = self.changelog.revision + len(changes)
+                tmp = self._dump_database(data, path, revision if self.storage_mode == 'journal' else None)
+                # Swap the file and commit the revision under the revision lock so
+                # readers never mistake the new file for an outside edit.
+                with self._revision_lock:
+                    self._replace(tmp, path)
+                    if self.journal.size():
+                        self.journal.truncate(revision)
+                    # Keep the parsed-document cache in step with what was just
+                    # written so the next GET does not have to re-parse the YAML.
+                    snap = self.db_cache.update(data, index)
+                    return self._commit_revisions(snap, changes)
+        except Exception as e:
+            logger.exception('Failed to save database to %s: %s', path, e)
+            self.db_cache.invalidate()
+            raise
+
+    def _sqlite_commit(self, data, changes, index=None) -> list:
+        try:
+            with self._revision_lock:
+                persist = self.db_store is not self.stor
+                with self.stage_seconds.time('sqlite'), self.db_store.transaction():
+                    self.db_store.save(DB_NAMESPACE, DB_KEY, data)
+                    if not persist:
+                        # Same store: the revision counter commits atomically with the document
+                        self.stor.save(REVISION_NAMESPACE, REVISION_KEY, {
+                            'revision': self.changelog.revision + len(changes),
+                            'key': list(self._sqlite_db_key()),
+                        })
+                snap = self.db_cache.update(data, index)
+                return self._commit_revisions(snap, changes, persist=persist)
+        except Exception as e:
+            logger.exception('Failed to save database to %s: %s', self.sqlite_path, e)
+            self.db_cache.invalidate()
+            raise
+
+    def _journal_commit(self, versions, changes, index=None) -> list:
+        with self._journal_lock, self._revision_lock:
+            revision = self.changelog.revision
+            records = [(revision + i, op, value) for i, (_, (op, value)) in enumerate(versions, 1)]
+            try:
+                with self.stage_seconds.time('journal'):
+                    self.journal.append_many(records)
+            except Exception as e:
+                logger.exception('Failed to append to journal %s: %s', self.journal_path, e)
+                raise
+            snap = self.db_cache.update(versions[-1][0], index)
+            revisions = self._commit_revisions(snap, changes)
+        self._schedule_compaction()
+        return revisions
+
+    def _schedule_compaction(self) -> None:
+        if self.journal.size() >= self.journal_compact_bytes:
+            self.io_executor.submit(self._run_compaction)
+            return
+        with self._compaction_lock:
+            if self._compaction_timer is None:
+                self._compaction_timer = threading.Timer(self.journal_compact_interval, self._run_compaction)
+                self._compaction_timer.daemon = True
+                self._compaction_timer.start()
+
+    def _run_compaction(self) -> None:
+        with self._compaction_lock:
+            if self._compaction_timer is not None:
+                self._compaction_timer.cancel()
+                self._compaction_timer = None
+        try:
+            self.timed('compact', self.compact_journal)
+        except Exception:
+            logger.exception('Journal compaction failed; will retry after the next write')
+
+    def compact_journal(self) -> bool:
+        """Fold the journal into a fresh database file snapshot and truncate it.
+
+        The dump runs without holding the journal lock, so commits keep
+        appending meanwhile; records newer than the dumped revision survive the
+        truncation. Returns False if there was nothing to compact.
+        """
+        with self.process_lock, self._journal_lock:
+            if not self.journal.size():
+                return False
+            snap = self.db_cache.get()
+            # Other workers may have appended: the snapshot must be stamped
+            # with the revision of the last record it includes
+            revision = self.sync_revision(snap)
+        tmp = self._dump_database(snap.data, self.db_path.with_suffix(self.db_path.suffix + '.compact'), revision,
+                                  fmt=self.database_format)
+        with self.process_lock, self._journal_lock, self._revision_lock:
+            if read_snapshot_revision(self.db_path) >= revision:
+                # Another worker compacted past this point meanwhile
+                tmp.unlink(missing_ok=True)
+                return False
+            # Pick up records other workers appended meanwhile, so the cached
+            # document matches the files it is re-keyed to below
+            self.sync_revision(self.db_cache.get())
+            self._replace(tmp, self.db_path)
+            self.journal.truncate(revision)
+            # Same document, new file identities
+            self._adopt_key(self.db_cache.rekey())
+        logger.info('Compacted journal into %s at revision %d', self.db_path, revision)
+        return True
+
+    # -- static publishing --
+
+    def publish_current(self) -> None:
+        """Publish the current database to publish_dir (on start; commits publish themselves)."""
+        if self.publisher is None:
+            return
+        with self.process_lock:
+            try:
+                snap = self.db_cache.get()
+            except FileNotFoundError:
+                return
+            self._publish(snap, self.sync_revision(snap))
+
+    def _publish(self, snap, revision: int) -> None:
+        """Publish `snap` as `revision` if it is still current; the caller holds the process lock.
+
+        Only the body goes out with the commit; the compressed copies are
+        added from the I/O pool (`_publish_encodings`).
+        """
+        if self.publisher is None or snap is None:
+            return
+        try:
+            with self._publish_lock, self.stage_seconds.time('publish'):
+                if snap.key != self.db_cache.key():
+                    return
+                self.publisher.publish(revision, snap.body, dict(snap.encodings), snap.etag,
+                                       mtime=max(snap.key[2::3]) / 1e9)
+        except Exception:
+            logger.exception('Failed to publish revision %s to %s', revision, self.publish_dir)
+            return
+        self.io_executor.submit(self._publish_encodings, snap, revision)
+
+    def _publish_encodings(self, snap, revision: int) -> None:
+        try:
+            encodings = {coding: self.timed('encode', snap.encode, coding) for coding in CODINGS}
+            with self._publish_lock:
+                self.publisher.add_encodings(revision, snap.etag, encodings, mtime=max(snap.key[2::3]) / 1e9)
+        except Exception:
+            logger.exception('Failed to publish compressed copies of revision %s to %s', revision, self.publish_dir)
+
+    # -- database file formats --
+
+    def convert_database(self, source: Path, target: Path) -> dict:
+        """Write the database file `source` as `target`, in the format of `target`'s suffix.
+
+        The copy keeps `source`'s revision stamp, so journal records not folded
+        in yet still apply to it, and the stored revision counter is moved
+        over to it: clients see the same revision instead of an outside edit.
+        Returns load/save timings, the new file's size and its content hash.
+        """
+        with self.process_lock:
+            extra = [self.journal_path] if self.storage_mode == 'journal' else ()
+            old_key = DatabaseCache(source, None, extra_paths=extra).key()
+            start = time.perf_counter()
+            data = self.load_database(source)
+            loaded = time.perf_counter()
+            self._replace(self._dump_database(data, target, read_snapshot_revision(source)), target)
+            saved = time.perf_counter()
+            with self._revision_lock:
+                if old_key is not None and old_key == self._committed_key:
+                    self._committed_key = DatabaseCache(target, None, extra_paths=extra).key()
+                    self._persist_revision()
+        digest = read_content_hash(target) if format_of(target) == 'json' else content_hash(target.read_bytes())
+        return {'load_seconds': loaded - start, 'save_seconds': saved - loaded,
+                'bytes': target.stat().st_size, 'sha256': digest}
+
+    def _schedule_export(self) -> None:
+        # database.yaml is an export whenever the service reads another copy:
+        # database.json, or the SQLite store
+        if (self.database_format != 'json' and self.db_store is None) or self.yaml_export_interval <= 0:
+            return
+        with self._export_lock:
+            if self._export_timer is None:
+                self._export_timer = threading.Timer(self.yaml_export_interval, self._run_export)
+                self._export_timer.daemon = True
+                self._export_timer.start()
+
+    def _run_export(self) -> None:
+        with self._export_lock:
+            self._export_timer = None
+        try:
+            self.timed('export', self.export_yaml)
+        except Exception:
+            logger.exception('Exporting %s failed; will retry after the next write', self.yaml_path)
+
+    def export_yaml(self, path: Optional[Path] = None) -> bool:
+        """Write the current database as YAML to `path` (default database.yaml).
+
+        Nothing is locked while dumping; if a commit lands meanwhile the result
+        is dropped and another export scheduled. Returns False if the file was
+        already current or the export was dropped.
+        """
+        path = path or self.yaml_path
+        snap = self.db_cache.get()
+        if path == self.yaml_path and snap.key == self._exported_key:
+            return False
+        # Several workers may export at once, so each writes its own temporary file
+        tmp = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        source = self.sqlite_path.name if self.db_store is not None else self.db_path.name
+        header = (f'# Exported from {source}, which the service reads;'
+                  f' changes to this file are not read back.\n') if path == self.yaml_path else ''
+        self._dump_database(snap.data, path, fmt='yaml', tmp=tmp, header=header)
+        with self.process_lock:
+            # Journal compaction re-keys the cache but keeps the same document
+            current = self.db_cache.current()
+            if current is None or current.data is not snap.data or current.key != self.db_cache.key():
+                tmp.unlink(missing_ok=True)
+                self._schedule_export()
+                return False
+            self._replace(tmp, path)
+        if path == self.yaml_path:
+            self._exported_key = current.key
+        return True
+
+    # -- revision counter --
+
+    def _load_revision_state(self):
+        try:
+            state = self.stor.load(REVISION_NAMESPACE, REVISION_KEY)
+        except KeyError:
+            state = {}
+        return state if isinstance(state, dict) else {}
+
+    def _persist_revision(self) -> None:
+        try:
+            self.stor.save(REVISION_NAMESPACE, REVISION_KEY, {
+                'revision': self.changelog.revision,
+                'key': list(self._committed_key) if self._committed_key else None,
+            })
+        except Exception:
+            logger.exception('Failed to persist database revision')
+
+    def _commit_revisions(self, snap, changes, persist: bool = True) -> list:
+        """Record one revision per change list and store the counter once."""
+        with self._revision_lock:
+            revisions = [self.changelog.record(c) for c in changes]
+            self._committed_key = snap.key if snap else None
+            if persist:
+                self._persist_revision()
+        self.broadcaster.notify()
+        return revisions
+
+    def _adopt_key(self, snap) -> None:
+        """Record new file identities for an unchanged document (no revision bump)."""
+        if snap is None:
+            return
+        with self._revision_lock:
+            self._committed_key = snap.key
+            self._persist_revision()
+
+    def sync_revision(self, snap) -> int:
+        """Catch up with commits of other workers and bump the revision for outside edits."""
+        if snap.key == self._committed_key:
+            return self.changelog.revision
+        # The committing worker holds the lock from swapping the file until its
+        # revision is stored. Do not wait for it here; the next read catches up.
+        if not self.process_lock.acquire(blocking=False):
+            return self.changelog.revision
+        try:
+            with self._revision_lock:
+                if snap.key == self._committed_key or snap.key != self.db_cache.key():
+                    # Already synced, or `snap` is outdated itself
+                    return self.changelog.revision
+                state = self._load_revision_state()
+                self.changelog.advance(int(state.get('revision', 0)))
+                if state.get('key') and tuple(state['key']) == snap.key:
+                    # Committed by another worker. Its per-entity changes are only
+                    # known there, so change-feed clients behind it reload.
+                    self._committed_key = snap.key
+                    self.broadcaster.notify()
+                    return self.changelog.revision
+                if self._committed_key is not None:
+                    logger.info('Database file changed outside the service; resetting change feed')
+                    self.changelog.reset()
+                    self.broadcaster.notify()
+                self._committed_key = snap.key
+                self._persist_revision()
+                self._publish(snap, self.changelog.revision)
+                return self.changelog.revision
+        finally:
+            self.process_lock.release()
+
+    def _recover_journal(self) -> None:
+        """Bring the revision counter past the journal and fold leftovers in snapshot mode."""
+        if not self.journal.size():
+            return
+        last = self.journal.last_revision()
+        with self._revision_lock:
+            if last > self.changelog.revision:
+                self.changelog.revision = self.changelog.floor = last
+                self._persist_revision()
+        if self.storage_mode == 'snapshot':
+            logger.info('Folding leftover journal %s into %s', self.journal_path, self.db_path)
+            try:
+                self.compact_journal()
+            except FileNotFoundError:
+                logger.warning('Journal %s has no snapshot to replay onto', self.journal_path)
+
+    # -- request helpers --
+
+    def validate_upload(self, doc) -> None:
+        """Validate a full document, skipping entries that equal the last validated upload.
+
+        References are checked against the stored document when the write is
+        committed (`check_references`).
+        """
+        with self.stage_seconds.time('validate'):
+            validate_database(doc, baseline=self._validated_baseline, references=False, collect=True)
+        self._validated_baseline = ValidationBaseline(doc)
+
+    def check_references(self, state: 'CommitState', doc) -> None:
+        """Reject a full document with 400 if it adds reference problems to the one in `state`."""
+        if not self.validate_references:
+            return
+        with self.stage_seconds.time('validate'):
+            if state.data is None:
+                errors = list(iter_integrity_errors(doc))
+            else:
+                errors = list(iter_new_integrity_errors(state.data, doc, state.index.positions))
+        if errors:
+            raise _validation_http_error(ValidationErrors(errors))
+
+    async def read_upload(self, request: Request, parser: str = 'json'):
+        """Read and parse a write body, bounded by `max_body_bytes` and gzip-decoded as it streams in.
+
+        Parsing runs on the I/O pool; errors become 400, 413 or 415.
+        """
+        try:
+            body = await read_body(request.stream(), self.max_body_bytes,
+                                   content_encoding=request.headers.get('Content-Encoding'),
+                                   content_length=request.headers.get('Content-Length'))
+            return await self.run_blocking(self.parse_upload, body, parser)
+        except UploadError as e:
+            raise HTTPException(status_code=e.status, detail=e.detail)
+
+    def parse_upload(self, body: bytes, parser: str = 'json'):
+        """Parse a write body with the 'json', 'yaml' or 'auto' parser."""
+        with self.stage_seconds.time('parse'):
+            return parse_body(body, parser)
+
+    def check_client_modified(self, request: Request, state: 'CommitState') -> None:
+        """Reject the write with 412 if the client's copy is older than `state`."""
+        # Check client-provided modification time for optimistic concurrency
+        client_ts = None
+        # Prefer explicit header, fall back to If-Unmodified-Since
+        hdr = request.headers.get('X-Client-Modified-At') or request.headers.get('If-Unmodified-Since')
+        if hdr:
+            try:
+                # Expect ISO8601 UTC like '2026-01-07T12:34:56Z'
+                client_ts = datetime.strptime(hdr, '%Y-%m-%dT%H:%M:%SZ')
+            except Exception:
+                client_ts = None
+
+        # If client timestamp provided and server mtime is newer, reject
+        server_mtime = state.modified
+        if client_ts and server_mtime and server_mtime > client_ts:
+            raise HTTPException(status_code=412, detail='Server has newer version')
+
+        # Revision-based check: exact, unlike the one-second timestamp resolution
+        base_rev = request.headers.get('X-TeamDB-Base-Revision')
+        if base_rev:
+            try:
+                base = int(base_rev)
+            except ValueError:
+                raise HTTPException(status_code=400, detail='X-TeamDB-Base-Revision must be an integer')
+            if base != state.revision:
+                raise HTTPException(status_code=412, detail='Server has newer version')
+
+    def verify_write_token(self, request: Request) -> None:
+        """Check the X-TeamDB-Email/X-TeamDB-Token pair against the stored token hashes."""
+        # Require token header for writes
+        token = request.headers.get('X-TeamDB-Token')
+        email = request.headers.get('X-TeamDB-Email')
+        if not token or not email:
+            raise HTTPException(status_code=401, detail='Missing authentication headers')
+
+        # Expect stored entry to be dict with salt/hash/iterations (PBKDF2, slow)
+        if not check_token(self.token_index.get(email), token):
+            raise HTTPException(status_code=403, detail='Invalid token')
+
+    def _verify_session(self, request: Request) -> bool:
+        """Return True if the request carries a valid X-TeamDB-Session (HMAC, fast)."""
+        session = request.headers.get('X-TeamDB-Session')
+        if not session:
+            return False
+        verified = self.session_signer.verify(session)
+        if verified is None:
+            return False
+        email, fingerprint = verified
+        # Re-issuing or removing the long-lived token invalidates its sessions
+        return bool(fingerprint) and token_fingerprint(self.token_index.get(email)) == fingerprint
+
+    async def authenticate_write(self, request: Request) -> None:
+        """Accept a valid session token, else fall back to the long-lived token."""
+        with self.stage_seconds.time('auth'):
+            if self._verify_session(request):
+                return
+            if request.headers.get('X-TeamDB-Session') and not request.headers.get('X-TeamDB-Token'):
+                raise HTTPException(status_code=401, detail='Invalid or expired session')
+            await self.run_blocking(self.verify_write_token, request)
+
+    async def current_snapshot(self):
+        """Return the current database snapshot, parsing the file on the I/O pool if needed."""
+        snap = self.db_cache.cached()
+        if snap is None:
+            try:
+                snap = await self.run_blocking(self.db_cache.get)
+            except FileNotFoundError:
+                raise HTTPException(status_code=404, detail='Database not found')
+        if not snap.rendered:
+            # Commits leave the body to the first reader
+            await self.run_blocking(snap.render)
+        if snap.key != self._committed_key:
+            # Another worker committed or the file was edited outside the
+            # service: catching up waits for locks and writes files
+            await self.run_blocking(self.sync_revision, snap)
+        return snap
+
+    def prepare_encoding(self, snap: Snapshot, accept_encoding: Optional[str]) -> None:
+        """Compress `snap` in the coding the client prefers, on the I/O pool, unless done already.
+
+        Until it is ready, negotiate() picks another prepared coding or the identity body.
+        """
+        coding = snap.preferred(accept_encoding)
+        if coding is not None and snap.claim(coding):
+            self.io_executor.submit(self._encode_snapshot, snap, coding)
+
+    def _encode_snapshot(self, snap: Snapshot, coding: str) -> None:
+        try:
+            self.timed('encode', snap.encode, coding)
+        except Exception:
+            logger.exception('Failed to encode the database body as %s', coding)
+
+    async def commit(self, build) -> 'Committed':
+        """Queue a write and wait until it is committed.
+
+        `build(state)` runs on the commit worker with the `CommitState` the
+        write applies to. It checks the preconditions against it (raising
+        HTTPException, e.g. 412 for a stale copy) and returns the new document
+        and its journal mutation as `(data, (op, value))`, optionally followed
+        by the `EntityIndex` of `data` when the build derived it.
+        """
+        return await self.commit_queue.submit(build)
+
+    async def _apply_batch(self, builds) -> list:
+        async with self.commit_lock():
+            return await self.run_blocking(self._apply_builds, builds)
+
+    def _apply_builds(self, builds) -> list:
+        """Apply queued writes in order and commit the accepted ones together."""
+        try:
+            snap = self.db_cache.get()
+            self.sync_revision(snap)
+        except FileNotFoundError:
+            snap = None
+        state = CommitState.of(snap, self.changelog.revision)
+        outcomes, versions, indexes = [], [], []
+        for build in builds:
+            try:
+                data, mutation, *index = build(state)
+            except HTTPException as e:
+                outcomes.append(e)
+                continue
+            except Exception as e:
+                logger.exception('Failed to apply write: %s', e)
+                outcomes.append(HTTPException(status_code=500, detail=str(e)))
+                continue
+            outcomes.append(len(versions))
+            versions.append((data, mutation))
+            indexes.append(index[0] if index else None)
+            state = state.after(data, indexes[-1])
+        if not versions:
+            return outcomes
+        try:
+            revisions = self.timed('save', self.commit_versions, snap, versions, indexes)
+        except Exception as e:
+            error = HTTPException(status_code=500, detail=str(e))
+            return [error if isinstance(o, int) else o for o in outcomes]
+        final = self.db_cache.current()
+        last_modified = final.last_modified if final is not None else None
+        return [
+            Committed(revisions[o], last_modified, final if o == len(versions) - 1 else None)
+            if isinstance(o, int) else o
+            for o in outcomes
+        ]
+
+    def entity_delta_version(self, state: 'CommitState', kind: str, delta: dict):
+        """Return `(data, mutation, index)` for an entity delta applied to `state`."""
+        try:
+            data, index = self.timed('patch', apply_entity_delta_indexed, state.data, {kind: delta},
+                                     index=state.index, references=self.validate_references)
+        except PatchError as pe:
+            raise HTTPException(status_code=400, detail=f'Invalid change: {pe}')
+        except ValidationError as ve:
+            raise _validation_http_error(ve)
+        return data, ('delta', {kind: delta}), index
+
+    async def store_token_entry(self, email: str, entry: dict) -> None:
+        async with self._tokens_lock, self._process_locked():
+            try:
+                # Copy: loaded values may be shared through the storage read cache
+                tokens = dict(await self.astor.load(TOKENS_NAMESPACE, TOKENS_KEY))
+            except KeyError:
+                tokens = {}
+            tokens[email] = entry
+            await self.astor.save(TOKENS_NAMESPACE, TOKENS_KEY, tokens)
+
+    # -- metrics --
+
+    def _database_bytes(self):
+        if self.db_store is not None:
+            try:
+                return {('sqlite',): self.db_store.stat(DB_NAMESPACE, DB_KEY).st_size}
+            except KeyError:
+                return None
+        sizes = {(self.db_path.name,): _file_size(self.db_path)}
+        if self.database_format == 'json':
+            sizes[(self.yaml_path.name,)] = _file_size(self.yaml_path)
+        if self.storage_mode == 'journal':
+            sizes[(self.journal_path.name,)] = self.journal.size()
+        return sizes
+
+    def _entity_counts(self):
+        # Last loaded snapshot: a scrape never triggers a parse
+        snap = self.db_cache.current()
+        inner = snap.data.get('database') if snap is not None and isinstance(snap.data, dict) else None
+        if not isinstance(inner, dict):
+            return None
+        return {(kind,): len(inner.get(kind) or ()) for kind in ENTITY_KINDS}
+
+    def _snapshot_body_bytes(self) -> Optional[int]:
+        snap = self.db_cache.current()
+        # Never render a body just for a scrape
+        return len(snap.body) if snap is not None and snap.rendered else None
+
+    def _backup_bytes(self) -> int:
+        now = time.monotonic()
+        usage = self._backup_usage
+        if usage['at'] is None or now - usage['at'] > BACKUP_USAGE_TTL:
+            usage['bytes'] = self.backup_store.disk_usage()
+            usage['at'] = now
+        return usage['bytes']
+
+    def _cache_lookups(self):
+        """{(cache, result): count} for the parsed-database cache and the storage read cache."""
+        counts = {('database', 'hit'): self.db_cache.hits, ('database', 'miss'): self.db_cache.misses}
+        if hasattr(self.stor, 'cache_hits'):
+            counts[('storage', 'hit')] = self.stor.cache_hits
+            counts[('storage', 'miss')] = self.stor.cache_misses
+        return counts
+
+    def _cache_hit_ratio(self):
+        lookups = self._cache_lookups()
+        ratios = {}
+        for cache in {cache for cache, _ in lookups}:
+            hits, misses = lookups[(cache, 'hit')], lookups[(cache, 'miss')]
+            ratios[(cache,)] = hits / (hits + misses) if hits + misses else None
+        return ratios
+
+    def _register_gauges(self) -> None:
+        metrics = self.metrics
+        metrics.gauge('teamdb_database_bytes', 'Size of the stored database by file.', self._database_bytes, ('file',))
+        metrics.gauge('teamdb_snapshot_body_bytes', 'Size of the JSON body served by GET /api/teamdb.',
+                      self._snapshot_body_bytes)
+        metrics.gauge('teamdb_entities', 'Entries per kind in the loaded database.', self._entity_counts, ('kind',))
+        metrics.gauge('teamdb_revision', 'Current database revision.', lambda: self.changelog.revision)
+        metrics.gauge('teamdb_backup_bytes', 'Disk usage of the backup store (refreshed at most once a minute).',
+                      self._backup_bytes)
+        metrics.gauge('teamdb_backup_versions', 'Retained backup versions.', lambda: len(self.backup_store.versions()))
+        metrics.gauge('teamdb_cache_lookups_total', 'Cache lookups by cache and result.', self._cache_lookups,
+                      ('cache', 'result'), kind='counter')
+        metrics.gauge('teamdb_cache_hit_ratio', 'Share of cache lookups served from memory since start.',
+                      self._cache_hit_ratio, ('cache',))
+        metrics.gauge('teamdb_event_subscribers', 'Open /api/teamdb/events streams.',
+                      lambda: self.broadcaster.subscribers)
+        metrics.gauge('teamdb_commit_lock_waits_total', 'Commits that had to wait for another worker.',
+                      lambda: self.process_lock.waits, kind='counter')
+        metrics.gauge('teamdb_commit_lock_wait_seconds_total', 'Time spent waiting for other workers to commit.',
+                      lambda: self.process_lock.wait_seconds, kind='counter')
+
+
+def _describe_error(ve: ValidationError) -> str:
+    path = '/'.join(ve.path) if getattr(ve, 'path', None) else ''
+    return f'{ve} at {path}' if path else str(ve)
+
+
+def _validation_http_error(ve: ValidationError) -> HTTPException:
+    """Return a clear client error with validation path info."""
+    if isinstance(ve, ValidationErrors) and len(ve.errors) > 1:
+        listed = '; '.join(_describe_error(e) for e in ve.errors[:MAX_REPORTED_ERRORS])
+        more = len(ve.errors) - MAX_REPORTED_ERRORS
+        if more > 0:
+            listed += f'; and {more} more'
+        return HTTPException(status_code=400, detail=f'Validation errors ({len(ve.errors)}): {listed}')
+    if isinstance(ve, ValidationErrors):
+        ve = ve.errors[0]
+    return HTTPException(status_code=400, detail=f'Validation error: {_describe_error(ve)}')
+
+
+def _entity_kind(kind: str) -> str:
+    if kind not in ENTITY_KINDS:
+        raise HTTPException(status_code=404, detail=f'Unknown entity kind: {kind}')
+    return kind
+
+
+def _check_entity_preconditions(request: Request, current) -> None:
+    """Compare If-Match/If-None-Match against the entity's own revision."""
+    rev = entity_revision(current) if current is not None else None
+    if_match = request.headers.get('If-Match')
+    if if_match and (rev is None or not etag_matches(if_match, [f'"{rev}"'], weak=False)):
+        raise HTTPException(status_code=412, detail='Entity has a newer revision')
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and rev is not None and etag_matches(if_none_match, [f'"{rev}"']):
+        raise HTTPException(status_code=412, detail='Entity already exists')
+
+
+def _sse(event: str, revision: int, payload: dict) -> bytes:
+    data = json.dumps(payload, ensure_ascii=False, separators=(',', ':'), default=str)
+    return f'id: {revision}\nevent: {event}\ndata: {data}\n\n'.encode('utf-8')
+
+
+async def get_teamdb(request: Request) -> TeamDB:
+    """Dependency returning the app's TeamDB, opened on first use if no startup hook ran."""
+    db: TeamDB = request.app.state.teamdb
+    if not db.opened:
+        await db.start()
+    return db
+
+
+# -- routes --
+router = APIRouter()
+
+
+@router.get('/api/teamdb', response_class=JSONResponse)
+async def api_get_teamdb(request: Request, db: TeamDB = Depends(get_teamdb)):
+    """Return the team database as JSON.
+
+    Supports conditional requests through `If-None-Match` and serves a
+    precompressed gzip/brotli body when the client accepts one.
+    """
+    try:
+        # Served from the in-memory snapshot; the file is only re-parsed (on
+        # the I/O pool) when its (inode, size, mtime) changed since the last read.
+        snap = await db.current_snapshot()
+        headers = {
+            # Let browsers keep the body but revalidate it on every use
+            'Cache-Control': 'no-cache',
+            'Vary': 'Accept-Encoding',
+            'X-TeamDB-Revision': str(db.changelog.revision),
+        }
+        accept_encoding = request.headers.get('Accept-Encoding')
+        db.prepare_encoding(snap, accept_encoding)
+        if etag_matches(request.headers.get('If-None-Match'), snap.all_etags()):
+            coding, _ = snap.negotiate(accept_encoding)
+            headers['ETag'] = snap.etag_for(coding)
+            return Response(status_code=304, headers=headers)
+        coding, body = snap.negotiate(accept_encoding)
+        headers['ETag'] = snap.etag_for(coding)
+        if coding:
+            headers['Content-Encoding'] = coding
+        return Response(content=body, media_type='application/json', headers=headers)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception('Error reading database: %s', e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.put('/api/teamdb', response_class=JSONResponse)
-async def api_put_teamdb(request: Request):
+@router.put('/api/teamdb', response_class=JSONResponse)
+async def api_put_teamdb(request: Request, db: TeamDB = Depends(get_teamdb)):
     """Replace the team database with provided JSON/YAML payload."""
     try:
-        payload = await request.json()
-    except Exception:
-        # Try form/body raw text (for clients that POST YAML)
-        body = await request.body()
-        try:
-            payload = yaml.safe_load(body.decode('utf-8'))
-        except Exception as e:
-            logger.exception('Failed to parse payload as JSON or YAML: %s', e)
-            raise HTTPException(status_code=400, detail='Invalid JSON/YAML payload')
+        parser = upload_parser(request.headers.get('Content-Type'))
+    except UploadError as e:
+        raise HTTPException(status_code=e.status, detail=e.detail)
+    payload = await db.read_upload(request, parser)
 
     # Basic validation: expect a dict with keys like 'people' and 'teams'
     if not isinstance(payload, dict):
@@ -191,73 +1388,274 @@ async def api_put_teamdb(request: Request):
 
     # Strict schema validation
     try:
-        validate_database(payload)
+        await db.run_blocking(db.validate_upload, payload)
     except ValidationError as ve:
-        # return a clear client error with validation path info
-        path = '/'.join(ve.path) if getattr(ve, 'path', None) else ''
-        detail = f'Validation error: {ve} at {path}' if path else f'Validation error: {ve}'
-        raise HTTPException(status_code=400, detail=detail)
+        raise _validation_http_error(ve)
 
-    # Require token header for writes
-    token = request.headers.get('X-TeamDB-Token')
-    email = request.headers.get('X-TeamDB-Email')
-    if not token or not email:
-        raise HTTPException(status_code=401, detail='Missing authentication headers')
-
-    # Check client-provided modification time for optimistic concurrency
-    client_ts = None
-    # Prefer explicit header, fall back to If-Unmodified-Since
-    hdr = request.headers.get('X-Client-Modified-At') or request.headers.get('If-Unmodified-Since')
-    if hdr:
+    await db.authenticate_write(request)
+
+    def build(state):
+        db.timed('precondition', db.check_client_modified, request, state)
+        db.check_references(state, payload)
+        return payload, ('replace', payload)
+
+    revision = (await db.commit(build)).revision
+    return JSONResponse(content={'ok': True, 'revision': revision}, headers={'X-TeamDB-Revision': str(revision)})
+
+
+@router.patch('/api/teamdb', response_class=JSONResponse)
+async def api_patch_teamdb(request: Request, db: TeamDB = Depends(get_teamdb)):
+    """Apply a partial update to the team database.
+
+    Accepts either an RFC 6902 JSON Patch (`application/json-patch+json`) or
+    an entity delta `{kind: {upsert: [...], delete: [names]}}`. Only the
+    touched entries are validated. Uses the same auth headers as PUT and
+    honours `If-Match` (ETag from GET) as well as `X-Client-Modified-At`.
+    """
+    payload = await db.read_upload(request)
+
+    await db.authenticate_write(request)
+    if_match = request.headers.get('If-Match')
+    json_patch = 'json-patch' in request.headers.get('content-type', '') or isinstance(payload, list)
+
+    def build(state):
+        db.timed('precondition', db.check_client_modified, request, state)
+        state.require()
+        if if_match and not etag_matches(if_match, state.etags, weak=False):
+            raise HTTPException(status_code=412, detail='Server has newer version')
         try:
-            # Expect ISO8601 UTC like '2026-01-07T12:34:56Z'
-            client_ts = datetime.strptime(hdr, '%Y-%m-%dT%H:%M:%SZ')
-        except Exception:
-            client_ts = None
+            if json_patch:
+                data = db.timed('patch', apply_json_patch, state.data, payload,
+                                index=state.index, references=db.validate_references)
+                return data, ('patch', payload)
+            data, index = db.timed('patch', apply_entity_delta_indexed, state.data, payload,
+                                   index=state.index, references=db.validate_references)
+            return data, ('delta', payload), index
+        except PatchConflict as pc:
+            raise HTTPException(status_code=409, detail=str(pc))
+        except PatchError as pe:
+            raise HTTPException(status_code=400, detail=f'Invalid patch: {pe}')
+        except ValidationError as ve:
+            raise _validation_http_error(ve)
 
-    # If server DB exists, compute its mtime
-    server_mtime = None
-    if DEFAULT_DB_PATH.exists():
-        server_mtime = datetime.utcfromtimestamp(DEFAULT_DB_PATH.stat().st_mtime)
-    # If client timestamp provided and server mtime is newer, reject
-    if client_ts and server_mtime and server_mtime > client_ts:
-        raise HTTPException(status_code=412, detail='Server has newer version')
+    committed = await db.commit(build)
+    headers = {'X-TeamDB-Revision': str(committed.revision)}
+    if committed.snapshot is not None:
+        await db.run_blocking(committed.snapshot.render)
+        headers['ETag'] = committed.snapshot.etag
+    return JSONResponse(
+        content={'ok': True, 'last_modified': committed.last_modified, 'revision': committed.revision},
+        headers=headers,
+    )
 
-    # Validate token map
-    try:
-        tokens = stor.load(TOKENS_NAMESPACE, TOKENS_KEY)
-    except KeyError:
-        tokens = {}
 
-    # Expect stored entry to be dict with salt/hash/iterations
-    import hashlib
-    import binascii
-    import secrets as _secrets
+@router.get('/api/teamdb/changes', response_class=JSONResponse)
+async def api_get_changes(since: int = 0, db: TeamDB = Depends(get_teamdb)):
+    """Return the per-entity changes committed after revision `since`.
+
+    Response: { revision, reset, changes: [{revision, kind, name, op, entry?}, ...] }.
+    If the requested changes are no longer retained (or `since` is unknown)
+    the response has `reset: true` and the client should reload /api/teamdb.
+    """
+    snap = await db.current_snapshot()
+    revision = db.changelog.revision
+    changes = db.changelog.changes_since(since)
+    if changes is None:
+        return JSONResponse(
+            content={'revision': revision, 'reset': True, 'changes': []},
+            headers={'X-TeamDB-Revision': str(revision), 'ETag': snap.etag},
+        )
+    return JSONResponse(
+        content={'revision': revision, 'reset': False, 'changes': changes},
+        headers={'X-TeamDB-Revision': str(revision), 'ETag': snap.etag},
+    )
+
+
+@router.get('/api/teamdb/events')
+async def api_get_events(request: Request, since: Optional[int] = None, db: TeamDB = Depends(get_teamdb)):
+    """Stream database changes as Server-Sent Events.
+
+    Emits a `changes` event ({revision, changes}) for every commit after
+    `since` (or the `Last-Event-ID` sent by a reconnecting EventSource), and
+    a `reset` event when the client must reload GET /api/teamdb. Without
+    `since` the stream starts at the current revision with a `hello` event.
+    """
+    last_event_id = request.headers.get('Last-Event-ID')
+    if since is None and last_event_id and last_event_id.isdigit():
+        since = int(last_event_id)
+    broadcaster, changelog = db.broadcaster, db.changelog
+
+    async def stream():
+        last = since
+        broadcaster.subscribers += 1
+        try:
+            if last is None:
+                last = changelog.revision
+                yield _sse('hello', last, {'revision': last})
+            while True:
+                # Grab the wake-up future before reading the log so no commit is missed
+                event = broadcaster.next_event()
+                changes = changelog.changes_since(last)
+                if changes is None:
+                    last = changelog.revision
+                    yield _sse('reset', last, {'revision': last})
+                elif changes:
+                    last = changes[-1]['revision']
+                    yield _sse('changes', last, {'revision': last, 'changes': changes})
+                if not await broadcaster.wait(event, db.events_keepalive):
+                    if await request.is_disconnected():
+                        break
+                    # SSE comment line keeps proxies from closing idle streams
+                    yield b': keepalive\n\n'
+        finally:
+            broadcaster.subscribers -= 1
+
+    return StreamingResponse(stream(), media_type='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # Disable response buffering when running behind nginx
+        'X-Accel-Buffering': 'no',
+    })
 
-    entry = tokens.get(email)
+
+# Backup routes are registered before the entity routes, which would
+# otherwise take `backups` for an entity kind.
+async def _backup_version_or_404(db: TeamDB, version: int):
+    # May re-read versions.jsonl after another process wrote it
+    info = await db.run_blocking(db.backup_store.get_version, version)
+    if info is None:
+        raise HTTPException(status_code=404, detail=f'Backup version not found: {version}')
+    return info
+
+
+@router.get('/api/teamdb/backups', response_class=JSONResponse)
+async def api_list_backups(db: TeamDB = Depends(get_teamdb)):
+    """List the retained database versions, newest first."""
+    versions = await db.run_blocking(db.backup_store.versions)
+    return JSONResponse(content={'versions': [v.to_json() for v in versions]})
+
+
+@router.get('/api/teamdb/backups/{version}', response_class=JSONResponse)
+async def api_get_backup(version: int, db: TeamDB = Depends(get_teamdb)):
+    """Return the full database document of a retained version."""
+    await _backup_version_or_404(db, version)
+    doc = await db.run_blocking(db.backup_store.load, version)
+    return JSONResponse(content=doc)
+
+
+@router.get('/api/teamdb/backups/{version}/diff', response_class=JSONResponse)
+async def api_diff_backup(version: int, to: str = 'current', db: TeamDB = Depends(get_teamdb)):
+    """Return the per-entity changes from backup `version` to `to` (a version or `current`)."""
+    await _backup_version_or_404(db, version)
+    if to == 'current':
+        snap = await db.current_snapshot()
+        target = await db.run_blocking(db.backup_store.manifest_for, snap.data)
+        resolve = snap.index.get
+    else:
+        try:
+            target_version = int(to)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="'to' must be a backup version or 'current'")
+        await _backup_version_or_404(db, target_version)
+        target = await db.run_blocking(db.backup_store.read_manifest, target_version)
+        resolve = None
+    source = await db.run_blocking(db.backup_store.read_manifest, version)
+    changes = await db.run_blocking(db.backup_store.diff, source, target, resolve)
+    return JSONResponse(content={'from': version, 'to': to, 'changes': changes})
+
+
+@router.post('/api/teamdb/backups/{version}/restore', response_class=JSONResponse)
+async def api_restore_backup(version: int, request: Request, db: TeamDB = Depends(get_teamdb)):
+    """Make a retained version the current database (a new revision; history is kept)."""
+    await _backup_version_or_404(db, version)
+    await db.authenticate_write(request)
+
+    def build(state):
+        db.timed('precondition', db.check_client_modified, request, state)
+        doc = db.backup_store.load(version)
+        try:
+            db.validate_upload(doc)
+        except ValidationError as ve:
+            raise _validation_http_error(ve)
+        return doc, ('replace', doc)
+
+    revision = (await db.commit(build)).revision
+    return JSONResponse(
+        content={'ok': True, 'restored': version, 'revision': revision},
+        headers={'X-TeamDB-Revision': str(revision)},
+    )
+
+
+@router.get('/api/teamdb/{kind}/{name:path}', response_class=JSONResponse)
+async def api_get_entity(kind: str, name: str, db: TeamDB = Depends(get_teamdb)):
+    """Return a single person, team or project; the ETag is the entity revision."""
+    snap = await db.current_snapshot()
+    entry = snap.index.get(_entity_kind(kind), name)
+    if entry is None:
+        raise HTTPException(status_code=404, detail=f'{kind} entry not found: {name}')
+    return JSONResponse(content=entry, headers={'ETag': f'"{entity_revision(entry)}"'})
+
+
+@router.put('/api/teamdb/{kind}/{name:path}', response_class=JSONResponse)
+async def api_put_entity(kind: str, name: str, request: Request, db: TeamDB = Depends(get_teamdb)):
+    """Create or replace a single person, team or project.
+
+    Send `If-Match: <ETag from GET>` to update only if nobody else changed this
+    entry, or `If-None-Match: *` to create only. Edits to other entries never
+    conflict. A different `name` in the body renames the entry.
+    """
+    kind = _entity_kind(kind)
+    entry = await db.read_upload(request)
     if not isinstance(entry, dict):
-        raise HTTPException(status_code=403, detail='Invalid token')
+        raise HTTPException(status_code=400, detail='Payload must be an object')
+    entry.setdefault('name', name)
 
-    try:
-        salt = binascii.unhexlify(entry['salt'])
-        expected_hash = binascii.unhexlify(entry['hash'])
-        iterations = int(entry.get('iterations', 100_000))
-    except Exception:
-        raise HTTPException(status_code=403, detail='Invalid token')
+    await db.authenticate_write(request)
+    new_name = entry['name']
+    existed = False
 
-    derived = hashlib.pbkdf2_hmac('sha256', token.encode('utf-8'), salt, iterations)
-    if not _secrets.compare_digest(derived, expected_hash):
-        raise HTTPException(status_code=403, detail='Invalid token')
+    def build(state):
+        nonlocal existed
+        state.require()
+        current = state.index.get(kind, name)
+        _check_entity_preconditions(request, current)
+        delta = {'upsert': [entry]}
+        if new_name != name:
+            if state.index.get(kind, new_name) is not None:
+                raise HTTPException(status_code=409, detail=f'{kind} entry already exists: {new_name}')
+            if current is not None:
+                delta['delete'] = [name]
+        existed = current is not None
+        return db.entity_delta_version(state, kind, delta)
 
-    try:
-        save_database(payload)
-        return JSONResponse(content={'ok': True})
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    revision = (await db.commit(build)).revision
+    rev = entity_revision(entry)
+    return JSONResponse(
+        status_code=200 if existed else 201,
+        content={'ok': True, 'name': new_name, 'rev': rev, 'revision': revision},
+        headers={'ETag': f'"{rev}"', 'X-TeamDB-Revision': str(revision)},
+    )
+
+
+@router.delete('/api/teamdb/{kind}/{name:path}', response_class=JSONResponse)
+async def api_delete_entity(kind: str, name: str, request: Request, db: TeamDB = Depends(get_teamdb)):
+    """Delete a single person, team or project (honours `If-Match`)."""
+    kind = _entity_kind(kind)
+    await db.authenticate_write(request)
 
+    def build(state):
+        state.require()
+        current = state.index.get(kind, name)
+        if current is None:
+            raise HTTPException(status_code=404, detail=f'{kind} entry not found: {name}')
+        _check_entity_preconditions(request, current)
+        return db.entity_delta_version(state, kind, {'delete': [name]})
 
-@app.post('/api/token')
-async def api_post_token(request: Request):
+    revision = (await db.commit(build)).revision
+    return JSONResponse(content={'ok': True, 'revision': revision}, headers={'X-TeamDB-Revision': str(revision)})
+
+
+@router.post('/api/token')
+async def api_post_token(request: Request, db: TeamDB = Depends(get_teamdb)):
     """Generate and store a token for a given email (callable from localhost).
 
     Payload: { email: 'user@example.com' }
@@ -273,40 +1671,51 @@ async def api_post_token(request: Request):
     if not email:
         raise HTTPException(status_code=400, detail='Missing email')
 
-    # Generate a token
-    import secrets
-    import hashlib
-    import binascii
-
     # Generate a random token (to return to the caller)
     token = secrets.token_urlsafe(24)
 
     # Derive a salted hash to store instead of the token itself
-    salt = secrets.token_bytes(16)
-    iterations = 100_000
-    dk = hashlib.pbkdf2_hmac('sha256', token.encode('utf-8'), salt, iterations)
-    salt_hex = binascii.hexlify(salt).decode('ascii')
-    hash_hex = binascii.hexlify(dk).decode('ascii')
+    entry = await db.run_blocking(hash_token, token)
 
     try:
-        try:
-            tokens = stor.load(TOKENS_NAMESPACE, TOKENS_KEY)
-        except KeyError:
-            tokens = {}
         # Store metadata for verification
-        tokens[email] = {
-            'salt': salt_hex,
-            'hash': hash_hex,
-            'iterations': iterations,
-        }
-        stor.save(TOKENS_NAMESPACE, TOKENS_KEY, tokens)
+        await db.store_token_entry(email, entry)
         return JSONResponse(content={'email': email, 'token': token})
     except Exception as e:
         logger.exception('Failed to save token: %s', e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get('/api/health')
+@router.post('/api/session')
+async def api_post_session(request: Request, db: TeamDB = Depends(get_teamdb)):
+    """Exchange the long-lived token for a short-lived session token.
+
+    Headers: X-TeamDB-Email, X-TeamDB-Token
+    Returns: { email: ..., session: ..., expires_at: ... }
+
+    Send the session as `X-TeamDB-Session` on writes; it is checked with an
+    HMAC instead of PBKDF2.
+    """
+    await db.run_blocking(db.verify_write_token, request)
+    email = request.headers.get('X-TeamDB-Email')
+    session, expires = db.session_signer.issue(email, token_fingerprint(db.token_index.get(email)))
+    return JSONResponse(content={
+        'email': email,
+        'session': session,
+        'expires_at': datetime.utcfromtimestamp(expires).strftime('%Y-%m-%dT%H:%M:%SZ'),
+    })
+
+
+@router.get('/api/metrics')
+async def api_metrics(db: TeamDB = Depends(get_teamdb)):
+    """Prometheus metrics in the text exposition format."""
+    if not db.metrics_enabled:
+        raise HTTPException(status_code=404, detail='Metrics are disabled')
+    body = await db.run_blocking(db.metrics.render)
+    return Response(content=body, media_type=METRICS_CONTENT_TYPE)
+
+
+@router.get('/api/health')
 async def api_health():
     """Return simple health information about the service."""
     try:
@@ -320,9 +1729,173 @@ async def api_health():
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.get('/api/ready')
+async def api_ready(request: Request):
+    """Readiness: 200 once the database snapshot is loaded (or there is none yet), else 503."""
+    state = request.app.state.teamdb.readiness()
+    return JSONResponse(status_code=200 if state['ready'] else 503, content=state)
+
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    db: TeamDB = app.state.teamdb
+    await db.start()
+    # Parse the database in the background: the server accepts connections
+    # right away and GET /api/ready turns 200 once the snapshot is loaded.
+    # Publishing needs it too: the web server reads the published copy.
+    warm_up = (asyncio.ensure_future(db.run_blocking(db.warm_up))
+               if db.warm_up_enabled or db.publisher is not None else None)
+    watcher = asyncio.ensure_future(db.watch_commits()) if db.worker_sync_interval > 0 else None
+    try:
+        yield
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+        await db.commit_queue.close()
+        if warm_up is not None and not warm_up.done():
+            await asyncio.wait({warm_up})
+        db.close()
+
+
+def create_app(config: Optional[dict] = None) -> FastAPI:
+    """Build the service for `config` (read from teamdb_config.yaml when None).
+
+    All state lives on `app.state.teamdb`; nothing touches the disk until the
+    app starts. Raises ConfigError for an invalid config.
+    """
+    if config is None:
+        config = load_config()
+    db = TeamDB(config)
+    app = FastAPI(title="Team DB Service", lifespan=_lifespan)
+    app.state.teamdb = db
+
+    # Allow requests from extension and local dev hosts
+    # Configure CORS from the config. `allow_origins` may be a list or a comma-separated string.
+    allow_origins = _parse_allow_origins(config.get('allow_origins', None))
+
+    # If wildcard is present, do not allow credentials for security reasons
+    allow_credentials = False
+    if '*' in allow_origins and allow_origins != ['*']:
+        # If somebody included '*' along with other origins, keep '*' but disable credentials
+        allow_credentials = False
+    elif allow_origins == ['*']:
+        allow_credentials = False
+
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=allow_origins,
+        allow_credentials=allow_credentials,
+        allow_methods=["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"],
+        allow_headers=["*"],
+        expose_headers=["ETag", "X-TeamDB-Revision"],
+    )
+    if db.metrics_enabled:
+        # The event stream stays open for minutes, which would swamp the latency histogram
+        app.add_middleware(MetricsMiddleware, latency=db.request_seconds, responses=db.responses,
+                           conflicts=db.conflicts, exclude=('/api/teamdb/events', '/api/metrics'))
+    if db.profiling_enabled or db.profile_header:
+        from server.lib.profiling import ProfilingMiddleware
+        app.add_middleware(ProfilingMiddleware, output_dir=db.profile_dir, sample_rate=db.profile_sample_rate,
+                           slow_ms=db.profile_slow_ms, interval_ms=db.profile_interval_ms,
+                           max_files=db.profile_max_files, allow_header=db.profile_header,
+                           exclude=('/api/teamdb/events', '/api/metrics'))
+    app.include_router(router)
+    return app
+
+
+def __getattr__(name: str):
+    # `uvicorn server.teamdb:app` still works: the app is built from
+    # teamdb_config.yaml on first access instead of at import time.
+    if name == 'app':
+        try:
+            app = create_app()
+        except ConfigError as e:
+            logger.error('%s', e)
+            sys.exit(2)
+        globals()['app'] = app
+        return app
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def migrate_database(config: dict, target: str) -> dict:
+    """Convert the database file to `target` format ('json' or 'yaml'); run with the service stopped.
+
+    Going to json leaves database.yaml in place (it becomes the export); going
+    back to yaml renames database.json to database.json.migrated.
+    """
+    db = TeamDB(dict(config, database_format='json' if target == 'yaml' else 'yaml'))
+    if db.storage_mode == 'sqlite':
+        raise ConfigError('storage_mode sqlite keeps the database in SQLite; there is no file to convert')
+    target_path = db.yaml_path.with_suffix(SUFFIXES[target])
+    if not db.db_path.exists():
+        raise ConfigError(f'No database at {db.db_path} to convert')
+    if target == 'json' and target_path.exists():
+        raise ConfigError(f'{target_path} already exists')
+    db.open()
+    try:
+        result = db.convert_database(db.db_path, target_path)
+        if target == 'yaml':
+            db.db_path.replace(db.db_path.with_name(db.db_path.name + '.migrated'))
+        result.update(source=str(db.db_path), target=str(target_path), revision=db.changelog.revision)
+    finally:
+        db.close()
+    return result
+
+
+def _main_migrate(config: dict, args) -> None:
+    result = migrate_database(config, args.to)
+    print('Converted %(source)s to %(target)s at revision %(revision)d: %(bytes)d bytes, sha256 %(sha256)s' % result)
+    print('Load %.3f s, save %.3f s' % (result['load_seconds'], result['save_seconds']))
+    print(f'Set `database_format: {args.to}` in the config before starting the service.')
+
+
+def _main_export(config: dict, args) -> None:
+    db = TeamDB(config)
+    path = Path(args.output) if args.output else db.yaml_path
+    if path == db.db_path:
+        raise ConfigError(f'{path} is the database itself (database_format: yaml); pass --output')
+    db.open()
+    try:
+        # A commit landing during the dump discards it; try again
+        for _ in range(5):
+            if db.export_yaml(path):
+                print(f'Wrote {path} at revision {db.changelog.revision}')
+                return
+        raise ConfigError(f'The database kept changing while exporting to {path}; try again')
+    finally:
+        db.close()
+
+
 if __name__ == '__main__':
-    import uvicorn
-    logger.info('Starting Team DB Service')
+    import argparse
+    parser = argparse.ArgumentParser(description='Team DB service. Without a command, runs the server.')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('serve', help='run the server (default)')
+    migrate_parser = commands.add_parser('migrate', help='convert the database file between yaml and json')
+    migrate_parser.add_argument('--to', choices=FORMATS, required=True, help='database_format to convert to')
+    export_parser = commands.add_parser('export-yaml', help='write the current database as YAML now')
+    export_parser.add_argument('--output', help='file to write (default: database.yaml next to database.json)')
+    cli_args = parser.parse_args()
+
+    try:
+        server_config = load_config()
+        if cli_args.command == 'migrate':
+            _main_migrate(server_config, cli_args)
+            sys.exit(0)
+        if cli_args.command == 'export-yaml':
+            _main_export(server_config, cli_args)
+            sys.exit(0)
+        import uvicorn
+        logger.info('Starting Team DB Service')
+        application = create_app(server_config)
+    except ConfigError as e:
+        logger.error('%s', e)
+        sys.exit(2)
     host = server_config.get('host', '127.0.0.1')
     port = int(server_config.get('port', 8765))
-    uvicorn.run('teamdb:app', host=host, port=port, reload=False)
+    workers = int(server_config.get('workers', 1))
+    if workers > 1:
+        # Each worker process builds its own app from the same config file
+        uvicorn.run('server.teamdb:create_app', factory=True, host=host, port=port, workers=workers, reload=False)
+    else:
+        uvicorn.run(application, host=host, port=port, reload=False)
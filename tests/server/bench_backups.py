@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+bench_backups.py
+
+Cost of BackupStore.add() versus database size, with manifests written as
+deltas against the previous version (the default) and with a full manifest
+for every version (`FULL_MANIFEST_EVERY = 1`, how the store worked before).
+Measures an add after a one-person entity write and after a full upload
+that changes one person, and the time to load a version from a cold store,
+which for deltas includes replaying the chain back to the last full
+manifest. Runs in a temporary directory on synthetic databases (see
+gen_database.py); no server needed.
+
+    python3 tests/server/bench_backups.py --people 1000 10000 20000 --rounds 5
+"""
+
+import argparse
+import copy
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from server.lib import backups  # noqa: E402
+from server.lib.dbpatch import apply_entity_delta  # noqa: E402
+from gen_database import make_database  # noqa: E402
+
+
+def timed(fn, rounds):
+    samples = []
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000.0)
+    return statistics.median(samples)
+
+
+def measure(root, people, rounds):
+    store = backups.BackupStore(root, max_versions=rounds * 3 + 1)
+    doc = make_database(people)
+    store.add(doc)
+    person = dict(doc['database']['people'][0])
+    state = {'doc': doc, 'step': 0}
+
+    def entity_add():
+        state['step'] += 1
+        person['title'] = 'Title %d' % state['step']
+        state['doc'] = apply_entity_delta(state['doc'], {'people': {'upsert': [dict(person)]}}, references=False)
+        store.add(state['doc'])
+
+    def full_add():
+        # A parsed upload shares nothing with the previous document
+        state['step'] += 1
+        doc = copy.deepcopy(state['doc'])
+        doc['database']['people'][1]['title'] = 'Title %d' % state['step']
+        state['doc'] = doc
+        store.add(doc)
+
+    entity_ms = timed(entity_add, rounds)
+    full_ms = timed(full_add, rounds)
+    newest = store.versions()[-1].version
+    load_ms = timed(lambda: backups.BackupStore(root).load(newest), rounds)
+    bytes_on_disk = sum(p.stat().st_size for p in (Path(root) / 'versions').glob('*.json.gz'))
+    return {'entity_ms': entity_ms, 'full_ms': full_ms, 'load_ms': load_ms, 'manifest_bytes': bytes_on_disk}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--people', type=int, nargs='+', default=[1000, 10000, 20000])
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    default = backups.FULL_MANIFEST_EVERY
+    print('median of %d rounds; manifest bytes after 1 + %d versions' % (args.rounds, 2 * args.rounds))
+    print('  %-8s %-6s %12s %12s %10s %15s' % ('people', 'mode', 'entity add', 'upload add', 'load', 'manifest bytes'))
+    for people in args.people:
+        for mode, every in (('full', 1), ('delta', default)):
+            backups.FULL_MANIFEST_EVERY = every
+            try:
+                with tempfile.TemporaryDirectory() as tmp:
+                    r = measure(tmp, people, args.rounds)
+            finally:
+                backups.FULL_MANIFEST_EVERY = default
+            print('  %-8d %-6s %9.1f ms %9.1f ms %7.1f ms %15d' % (
+                people, mode, r['entity_ms'], r['full_ms'], r['load_ms'], r['manifest_bytes']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+bench_database_format.py
+
+Load and save time of the database file versus database size, for each way
+the server can store it: `database.yaml` through PyYAML's pure-Python
+classes (what the server used before), through libyaml's C classes, and
+`database.json` (`database_format: json`) with the standard `json` module
+and with `orjson`. JSON times include computing and checking the content
+hash. Variants whose package is not installed are reported and skipped.
+Runs in a temporary directory on synthetic databases (see gen_database.py);
+no server needed.
+
+    python3 tests/server/bench_database_format.py --people 100 1000 10000 --rounds 5
+    python3 tests/server/bench_database_format.py --database data/config/database.yaml --output format.json
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import yaml
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from server.lib import dbformat  # noqa: E402
+from server.lib.lazy import optional  # noqa: E402
+from gen_database import make_database  # noqa: E402
+
+
+def yaml_variant(loader, dumper):
+    def save(data, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            yaml.dump(data, f, Dumper=dumper, sort_keys=False, allow_unicode=True)
+
+    def load(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return yaml.load(f, Loader=loader)
+    return save, load
+
+
+def json_variant(use_orjson):
+    # dbformat looks orjson up once; swap it for the duration of a call
+    module = optional('orjson') if use_orjson else None
+
+    def call(fn, *args):
+        saved, dbformat.orjson = dbformat.orjson, module
+        try:
+            return fn(*args)
+        finally:
+            dbformat.orjson = saved
+
+    def save(data, path):
+        Path(path).write_bytes(call(dbformat.encode_json, data, 1)[0])
+
+    def load(path):
+        return call(dbformat.decode_json, Path(path).read_bytes(), path)
+    return save, load
+
+
+def variants():
+    """(name, suffix, save, load) or (name, None, reason) for unavailable ones."""
+    out = [('yaml', '.yaml') + yaml_variant(yaml.SafeLoader, yaml.SafeDumper)]
+    if hasattr(yaml, 'CSafeLoader'):
+        out.append(('yaml-libyaml', '.yaml') + yaml_variant(yaml.CSafeLoader, yaml.CSafeDumper))
+    else:
+        out.append(('yaml-libyaml', None, 'PyYAML built without libyaml'))
+    out.append(('json', '.json') + json_variant(False))
+    if optional('orjson') is not None:
+        out.append(('json-orjson', '.json') + json_variant(True))
+    else:
+        out.append(('json-orjson', None, 'pip install orjson'))
+    return out
+
+
+def timed(fn, rounds):
+    samples = []
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000.0)
+    return statistics.median(samples)
+
+
+def run(tmp, label, data, rounds):
+    results = {}
+    for variant in variants():
+        if variant[1] is None:
+            print('  %-13s skipped (%s)' % (variant[0], variant[2]))
+            continue
+        name, suffix, save, load = variant
+        path = Path(tmp) / f'{name}{suffix}'
+        save_ms = timed(lambda: save(data, path), rounds)
+        load_ms = timed(lambda: load(path), rounds)
+        assert load(path) == data, f'{name} does not round-trip {label}'
+        results[name] = {'bytes': path.stat().st_size, 'save_ms': save_ms, 'load_ms': load_ms}
+    base = results['yaml']
+    print('%s, median of %d rounds' % (label, rounds))
+    print('  %-13s %12s %10s %10s %9s %9s' % ('variant', 'bytes', 'save ms', 'load ms', 'save x', 'load x'))
+    for name, r in results.items():
+        print('  %-13s %12d %10.2f %10.2f %8.1fx %8.1fx' % (
+            name, r['bytes'], r['save_ms'], r['load_ms'],
+            base['save_ms'] / max(r['save_ms'], 1e-9), base['load_ms'] / max(r['load_ms'], 1e-9)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--people', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--database', help='measure this YAML database instead of synthetic ones')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    args = parser.parse_args()
+
+    if args.database:
+        with open(args.database, 'r', encoding='utf-8') as f:
+            cases = [(args.database, dbformat.yaml_load(f))]
+    else:
+        cases = [('%d people' % people, make_database(people)) for people in args.people]
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, data in cases:
+            results[label] = run(tmp, label, data, args.rounds)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'rounds': args.rounds, 'results': results}, f, indent=2)
+        print('Results written to %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+bench_get_latency.py
+
+Check that GET /api/teamdb latency does not degrade while PUTs are running.
+
+Flow:
+ - Request a token for a test email (POST /api/token) — server allows this from localhost
+ - GET /api/teamdb to obtain the current document
+ - Phase 1: measure GET latency with no writers
+ - Phase 2: measure GET latency again while writer threads PUT the document in a loop
+ - Print p50/p95/p99 for both phases and fail if p99 under writes exceeds
+   `--max-ratio` times the idle p99 (with a small absolute allowance for noise)
+
+Requires: requests (pip install requests)
+
+Run while the server is running (use a large database to make the effect visible):
+    python3 bench_get_latency.py --base http://127.0.0.1:8765 --requests 500 --writers 2
+"""
+
+import argparse
+import statistics
+import sys
+import threading
+import time
+
+try:
+    import requests
+except Exception:
+    print('This script requires the requests library. Install with: pip install requests')
+    sys.exit(1)
+
+EMAIL = 'bench@example.local'
+
+
+def gen_token(base, email):
+    r = requests.post(base + '/api/token', json={'email': email})
+    r.raise_for_status()
+    return r.json()['token']
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    idx = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def measure_gets(base, count, readers):
+    """Return GET latencies in milliseconds using `readers` concurrent threads."""
+    latencies = []
+    lock = threading.Lock()
+    per_thread = max(1, count // readers)
+
+    def run():
+        s = requests.Session()
+        local = []
+        for _ in range(per_thread):
+            t0 = time.perf_counter()
+            r = s.get(base + '/api/teamdb')
+            r.raise_for_status()
+            local.append((time.perf_counter() - t0) * 1000.0)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=run) for _ in range(readers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies
+
+
+def writer_loop(base, token, doc, stop, counts):
+    s = requests.Session()
+    headers = {
+        'Content-Type': 'application/json',
+        'X-TeamDB-Email': EMAIL,
+        'X-TeamDB-Token': token,
+    }
+    while not stop.is_set():
+        r = s.put(base + '/api/teamdb', headers=headers, json=doc)
+        counts.append(r.status_code)
+
+
+def report(name, samples):
+    print('%-12s n=%-5d p50=%7.2fms p95=%7.2fms p99=%7.2fms mean=%7.2fms' % (
+        name, len(samples), percentile(samples, 50), percentile(samples, 95),
+        percentile(samples, 99), statistics.mean(samples)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--base', default='http://127.0.0.1:8765')
+    parser.add_argument('--requests', type=int, default=500, help='GETs per phase')
+    parser.add_argument('--readers', type=int, default=4, help='concurrent GET threads')
+    parser.add_argument('--writers', type=int, default=2, help='concurrent PUT threads in phase 2')
+    parser.add_argument('--max-ratio', type=float, default=3.0, help='allowed p99 ratio under writes')
+    parser.add_argument('--slack-ms', type=float, default=5.0, help='absolute p99 allowance for noise')
+    args = parser.parse_args()
+
+    token = gen_token(args.base, EMAIL)
+    r = requests.get(args.base + '/api/teamdb')
+    r.raise_for_status()
+    doc = r.json()
+    doc.pop('last_modified', None)
+    print('Database: %d bytes, %d people' % (len(r.content), len(doc.get('database', {}).get('people', []))))
+
+    # Warm up connection pools and the server cache
+    measure_gets(args.base, args.readers * 5, args.readers)
+
+    idle = measure_gets(args.base, args.requests, args.readers)
+
+    stop = threading.Event()
+    counts = []
+    writers = [threading.Thread(target=writer_loop, args=(args.base, token, doc, stop, counts)) for _ in range(args.writers)]
+    for w in writers:
+        w.start()
+    time.sleep(0.2)
+    busy = measure_gets(args.base, args.requests, args.readers)
+    stop.set()
+    for w in writers:
+        w.join()
+
+    report('idle', idle)
+    report('during PUT', busy)
+    print('PUTs completed during phase 2: %d (status codes: %s)' % (len(counts), sorted(set(counts))))
+
+    limit = percentile(idle, 99) * args.max_ratio + args.slack_ms
+    if percentile(busy, 99) > limit:
+        print('FAIL: p99 under writes %.2fms exceeds %.2fms' % (percentile(busy, 99), limit))
+        sys.exit(1)
+    print('OK: p99 under writes within %.2fms' % limit)
+
+
+if __name__ == '__main__':
+    main()
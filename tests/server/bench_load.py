@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+"""
+bench_load.py
+
+Load test for the TeamDB service: concurrent clients issue a weighted mix
+of `GET /api/teamdb`, read-modify-write `PUT /api/teamdb` and
+`POST /api/token` requests for `--duration` seconds, and the script reports
+throughput, latency percentiles per operation, 412 conflicts and lost
+updates.
+
+Every PUT increments `carry_over_holidays` of `Person 0` in the copy it
+read, so after the run the counter must have grown by the number of
+acknowledged PUTs; any shortfall is a lost update. PUTs send
+`X-TeamDB-Base-Revision` unless `--no-precondition` is given, which shows
+what the precondition protects against.
+
+Targets:
+ - `--server inprocess` (default): for each `--people` size, a child
+   process writes a synthetic database (see gen_database.py) to a scratch
+   data_root and drives the app through httpx's ASGI transport. No network
+   or uvicorn, but client and server share one CPU.
+ - `--server uvicorn`: same scratch setup, served by a local uvicorn.
+ - `--base URL`: an already running server. Its database is modified!
+
+Results are written as JSON (`--output`, default `load-<commit>.json`) and
+can be compared with an earlier run:
+
+    python3 tests/server/bench_load.py --people 100 1000 10000 --duration 10 --concurrency 8 --mix get=80,put=15,token=5
+    python3 tests/server/bench_load.py --people 1000 --set storage_mode=journal --compare load-abc1234.json
+
+Requires: httpx (installed with the server requirements' test client)
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+
+import yaml
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(REPO_ROOT))
+
+from gen_database import write_database  # noqa: E402
+
+try:
+    import httpx
+except ImportError:
+    print('This script requires httpx. Install with: pip install httpx')
+    sys.exit(1)
+
+try:
+    import orjson
+    loads, dumps = orjson.loads, orjson.dumps
+except ImportError:
+    loads = json.loads
+
+    def dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
+EMAIL = 'bench@example.local'
+COUNTER_PERSON = 'Person 0'
+COUNTER_FIELD = 'carry_over_holidays'
+OPS = ('get', 'put', 'token')
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    idx = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        op, _, weight = part.partition('=')
+        op = op.strip()
+        if op not in OPS:
+            raise argparse.ArgumentTypeError('unknown operation %r (expected %s)' % (op, ', '.join(OPS)))
+        mix[op] = float(weight or 1)
+    return mix
+
+
+def parse_setting(text):
+    key, sep, value = text.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError('expected KEY=VALUE, got %r' % text)
+    return key, yaml.safe_load(value)
+
+
+def git_commit():
+    try:
+        sha = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                             text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_ROOT,
+                                    capture_output=True, text=True).stdout.strip())
+        return sha, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', False
+
+
+def _counter_of(doc):
+    for person in doc['database']['people']:
+        if person.get('name') == COUNTER_PERSON:
+            return person
+    raise SystemExit('%s not found in the database; the lost-update check needs it' % COUNTER_PERSON)
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {op: [] for op in OPS}
+        self.statuses = {op: Counter() for op in OPS}
+        self.errors = Counter()
+        self.committed = 0
+
+    def record(self, op, started, status):
+        self.latencies[op].append((time.perf_counter() - started) * 1000.0)
+        self.statuses[op][status] += 1
+        if status >= 500 or (status >= 400 and status != 412):
+            self.errors[op] += 1
+
+
+async def setup_auth(client, auth):
+    r = await client.post('/api/token', json={'email': EMAIL})
+    r.raise_for_status()
+    token = r.json()['token']
+    headers = {'X-TeamDB-Email': EMAIL, 'X-TeamDB-Token': token}
+    if auth == 'session':
+        r = await client.post('/api/session', headers=headers)
+        r.raise_for_status()
+        headers = {'X-TeamDB-Session': r.json()['session']}
+    return headers
+
+
+async def read_counter(client):
+    r = await client.get('/api/teamdb')
+    r.raise_for_status()
+    return _counter_of(loads(r.content)).get(COUNTER_FIELD, 0)
+
+
+async def worker(client, args, rec, auth_headers, deadline, seed):
+    rng = random.Random(seed)
+    ops = list(args.mix)
+    weights = [args.mix[op] for op in ops]
+    n = 0
+    while time.perf_counter() < deadline:
+        op = rng.choices(ops, weights)[0]
+        n += 1
+        try:
+            if op == 'get':
+                t0 = time.perf_counter()
+                r = await client.get('/api/teamdb')
+                rec.record(op, t0, r.status_code)
+            elif op == 'token':
+                t0 = time.perf_counter()
+                r = await client.post('/api/token', json={'email': 'load-%d-%d@example.local' % (seed, n % 50)})
+                rec.record(op, t0, r.status_code)
+            else:
+                # Read-modify-write; only the PUT itself is timed
+                r = await client.get('/api/teamdb')
+                r.raise_for_status()
+                doc = loads(r.content)
+                doc.pop('last_modified', None)
+                person = _counter_of(doc)
+                person[COUNTER_FIELD] = person.get(COUNTER_FIELD, 0) + 1
+                headers = dict(auth_headers, **{'Content-Type': 'application/json'})
+                if args.precondition:
+                    headers['X-TeamDB-Base-Revision'] = r.headers['X-TeamDB-Revision']
+                t0 = time.perf_counter()
+                r = await client.put('/api/teamdb', content=dumps(doc), headers=headers)
+                rec.record(op, t0, r.status_code)
+                if r.status_code == 200:
+                    rec.committed += 1
+        except httpx.HTTPError as e:
+            rec.errors[op] += 1
+            rec.statuses[op][type(e).__name__] += 1
+
+
+async def drive(client, args):
+    """Warm up, run the workers for args.duration seconds and return the run summary."""
+    t0 = time.perf_counter()
+    r = await client.get('/api/teamdb')
+    r.raise_for_status()
+    first_get_ms = (time.perf_counter() - t0) * 1000.0
+    people = len(loads(r.content)['database']['people'])
+    auth_headers = await setup_auth(client, args.auth)
+    before = await read_counter(client)
+
+    rec = Recorder()
+    start = time.perf_counter()
+    deadline = start + args.duration
+    await asyncio.gather(*(worker(client, args, rec, auth_headers, deadline, i) for i in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+    after = await read_counter(client)
+
+    ops = {}
+    for op in OPS:
+        samples = rec.latencies[op]
+        if not samples and not rec.errors[op]:
+            continue
+        ops[op] = {
+            'count': len(samples),
+            'errors': rec.errors[op],
+            'statuses': {str(k): v for k, v in sorted(rec.statuses[op].items(), key=str)},
+            'rps': len(samples) / elapsed,
+        }
+        if samples:
+            ops[op].update({
+                'mean_ms': statistics.mean(samples),
+                'p50_ms': percentile(samples, 50),
+                'p90_ms': percentile(samples, 90),
+                'p99_ms': percentile(samples, 99),
+                'max_ms': max(samples),
+            })
+    return {
+        'people': people,
+        'database_bytes': len(r.content),
+        'first_get_ms': first_get_ms,
+        'elapsed_s': elapsed,
+        'throughput_rps': sum(len(s) for s in rec.latencies.values()) / elapsed,
+        'ops': ops,
+        'puts_committed': rec.committed,
+        'conflicts': rec.statuses['put'].get(412, 0),
+        'lost_updates': rec.committed - (after - before),
+    }
+
+
+def scratch_config(root, args):
+    data_root = root / 'data'
+    write_database(data_root / 'config' / 'database.yaml', args.size)
+    config = {'host': '127.0.0.1', 'port': 8765, 'data_root': str(data_root)}
+    config.update(args.settings)
+    path = root / 'teamdb_config.yaml'
+    with open(path, 'w', encoding='utf-8') as f:
+        yaml.safe_dump(config, f)
+    return path
+
+
+def run_inprocess(args):
+    """Child process: build the app from the scratch config and drive it.
+
+    The startup hook is not run, so the first GET still measures the cold parse.
+    """
+    from server.teamdb import create_app
+    app = create_app()
+
+    async def main():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://127.0.0.1', timeout=args.timeout) as client:
+            return await drive(client, args)
+    return asyncio.run(main())
+
+
+def run_http(base, args):
+    async def main():
+        limits = httpx.Limits(max_connections=args.concurrency + 1)
+        async with httpx.AsyncClient(base_url=base, limits=limits, timeout=args.timeout) as client:
+            return await drive(client, args)
+    return asyncio.run(main())
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def run_uvicorn(config_path, args):
+    port = _free_port()
+    env = dict(os.environ, TEAMDB_CONFIG=str(config_path))
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', '--factory', 'server.teamdb:create_app', '--host', '127.0.0.1',
+         '--port', str(port), '--workers', str(args.workers), '--log-level', 'warning'], cwd=REPO_ROOT, env=env)
+    base = 'http://127.0.0.1:%d' % port
+    try:
+        # /api/ready: every worker accepts connections before it has parsed the database
+        for _ in range(600):
+            if proc.poll() is not None:
+                raise SystemExit('uvicorn exited with status %d' % proc.returncode)
+            try:
+                if httpx.get(base + '/api/ready', timeout=1).status_code == 200:
+                    break
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.1)
+        else:
+            raise SystemExit('uvicorn did not start on port %d' % port)
+        return run_http(base, args)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+
+
+def run_size(size, args, argv):
+    """Run one database size in a fresh scratch directory."""
+    with tempfile.TemporaryDirectory(prefix='teamdb-load-') as tmp:
+        args.size = size
+        config_path = scratch_config(Path(tmp), args)
+        if args.server == 'uvicorn':
+            return run_uvicorn(config_path, args)
+        # The app reads its config at import time: one child process per size
+        env = dict(os.environ, TEAMDB_CONFIG=str(config_path))
+        out = subprocess.run([sys.executable, __file__, '--child'] + argv, env=env, cwd=REPO_ROOT,
+                             stdout=subprocess.PIPE, check=True).stdout
+        return json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+
+def print_run(run):
+    print('%d people (%d bytes): %.1f req/s, first GET %.0f ms, %d PUTs committed, %d conflicts, %d lost updates' % (
+        run['people'], run['database_bytes'], run['throughput_rps'], run['first_get_ms'],
+        run['puts_committed'], run['conflicts'], run['lost_updates']))
+    print('  %-6s %7s %6s %8s %9s %9s %9s %9s' % ('op', 'count', 'errors', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    for op, s in run['ops'].items():
+        print('  %-6s %7d %6d %8.1f %9.2f %9.2f %9.2f %9.2f' % (
+            op, s['count'], s['errors'], s['rps'], s.get('p50_ms', 0), s.get('p90_ms', 0),
+            s.get('p99_ms', 0), s.get('max_ms', 0)))
+
+
+def print_comparison(old, new):
+    print('\nCompared with %s (%s):' % (old.get('commit'), old.get('time')))
+    print('  %-8s %-6s %-8s %10s %10s %8s' % ('people', 'op', 'metric', 'before', 'after', 'change'))
+    previous = {run['people']: run for run in old.get('runs', [])}
+    for run in new['runs']:
+        base = previous.get(run['people'])
+        if base is None:
+            continue
+        rows = [('all', 'req/s', base['throughput_rps'], run['throughput_rps'])]
+        for op, s in run['ops'].items():
+            b = base['ops'].get(op)
+            if b and 'p50_ms' in b and 'p50_ms' in s:
+                rows += [(op, 'p50 ms', b['p50_ms'], s['p50_ms']), (op, 'p99 ms', b['p99_ms'], s['p99_ms'])]
+        for op, metric, before, after in rows:
+            print('  %-8d %-6s %-8s %10.2f %10.2f %+7.1f%%' % (
+                run['people'], op, metric, before, after, 100.0 * (after - before) / max(before, 1e-9)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--people', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='database sizes to generate (ignored with --base)')
+    parser.add_argument('--server', choices=('inprocess', 'uvicorn'), default='inprocess')
+    parser.add_argument('--workers', type=int, default=1, help='uvicorn worker processes (with --server uvicorn)')
+    parser.add_argument('--base', help='benchmark this running server instead (its database is modified)')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of load per size')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('get=80,put=15,token=5'),
+                        help='operation weights, e.g. get=80,put=15,token=5')
+    parser.add_argument('--auth', choices=('session', 'token'), default='session',
+                        help='authenticate PUTs with a session (HMAC) or the long-lived token (PBKDF2)')
+    parser.add_argument('--no-precondition', dest='precondition', action='store_false',
+                        help='send PUTs without X-TeamDB-Base-Revision')
+    parser.add_argument('--set', dest='settings', type=parse_setting, action='append', default=[],
+                        metavar='KEY=VALUE', help='extra teamdb_config.yaml setting for the scratch server')
+    parser.add_argument('--timeout', type=float, default=300.0, help='per-request timeout in seconds')
+    parser.add_argument('--output', help='results file (default load-<commit>.json)')
+    parser.add_argument('--compare', help='earlier results file to compare with')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    argv = sys.argv[1:]
+    args = parser.parse_args(argv)
+    args.settings = dict(args.settings)
+
+    if args.child:
+        print(json.dumps(run_inprocess(args)))
+        return 0
+
+    commit, dirty = git_commit()
+    results = {
+        'commit': commit + ('-dirty' if dirty else ''),
+        'time': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'python': sys.version.split()[0],
+        'settings': {
+            'server': args.base or args.server, 'workers': args.workers, 'duration_s': args.duration, 'concurrency': args.concurrency,
+            'mix': args.mix, 'auth': args.auth, 'precondition': args.precondition, 'config': args.settings,
+        },
+        'runs': [],
+    }
+    if args.base:
+        runs = [run_http(args.base.rstrip('/'), args)]
+    else:
+        runs = []
+        for size in args.people:
+            # The child handles exactly this size
+            runs.append(run_size(size, args, _without_option(argv, '--people') + ['--people', str(size)]))
+    for run in runs:
+        results['runs'].append(run)
+        print_run(run)
+
+    output = args.output or 'load-%s.json' % results['commit']
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print('\nResults written to %s' % output)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            print_comparison(json.load(f), results)
+    lost = sum(run['lost_updates'] for run in runs)
+    if lost and args.precondition:
+        print('FAIL: %d lost updates despite X-TeamDB-Base-Revision' % lost)
+        return 1
+    return 0
+
+
+def _without_option(argv, option):
+    """Drop `option` and its values (up to the next --flag) from argv."""
+    out, skipping = [], False
+    for arg in argv:
+        if arg == option or arg.startswith(option + '='):
+            skipping = arg == option
+            continue
+        if skipping and not arg.startswith('--'):
+            continue
+        skipping = False
+        out.append(arg)
+    return out
+
+
+if __name__ == '__main__':
+    sys.exit(main())
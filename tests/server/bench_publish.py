@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+bench_publish.py
+
+Shows that with `publish_dir` set, reads no longer depend on the FastAPI
+worker count. For each `--workers` count the service is started with
+uvicorn on a synthetic database (scratch data_root, see gen_database.py)
+and a static file server is started on its publish_dir. While `--writers`
+clients keep writing through the service, `--readers` clients GET the database
+for `--duration` seconds, first from the service, then from the static
+server. At the end the static copy must carry the service's revision.
+
+The static server is nginx when it is installed (`--nginx`, default: found
+on PATH), configured like server/install/nginx_server.md; otherwise a
+small threaded Python server stands in for it, which shows the same
+independence from the worker count but not nginx's throughput.
+
+    python3 tests/server/bench_publish.py --people 1000 --workers 1 2 4 --duration 10 --readers 16
+    python3 tests/server/bench_publish.py --nginx /usr/sbin/nginx --output publish.json
+
+Requires: httpx
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import yaml
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(REPO_ROOT))
+
+from gen_database import write_database  # noqa: E402
+
+try:
+    import httpx
+except ImportError:
+    print('This script requires httpx. Install with: pip install httpx')
+    sys.exit(1)
+
+EMAIL = 'bench@example.local'
+
+NGINX_CONF = '''
+worker_processes 1;
+error_log %(root)s/nginx-error.log;
+pid %(root)s/nginx.pid;
+events { worker_connections 1024; }
+http {
+    access_log off;
+    map $realpath_root $teamdb_revision {
+        "~/(?<rev>\\d+)-[0-9a-f]+$" $rev;
+        default "";
+    }
+    server {
+        listen 127.0.0.1:%(port)d;
+        location = /api/teamdb {
+            root %(publish)s/current;
+            try_files /snapshot.json =404;
+            default_type application/json;
+            types { }
+            gzip_static on;
+            gzip_vary on;
+            add_header Cache-Control no-cache;
+            add_header X-TeamDB-Revision $teamdb_revision;
+        }
+    }
+}
+'''
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_until(url, proc, what):
+    for _ in range(600):
+        if proc.poll() is not None:
+            raise SystemExit('%s exited with status %d' % (what, proc.returncode))
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    raise SystemExit('%s did not start' % what)
+
+
+class StaticHandler(BaseHTTPRequestHandler):
+    """Stand-in for nginx: snapshot.json(.gz) from publish_dir/current, revision from the link target."""
+    publish_dir = None
+
+    def do_GET(self):
+        if self.path != '/api/teamdb':
+            self.send_error(404)
+            return
+        real = os.path.realpath(os.path.join(self.publish_dir, 'current'))
+        name = os.path.join(real, 'snapshot.json')
+        headers = {'Content-Type': 'application/json', 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding',
+                   'X-TeamDB-Revision': os.path.basename(real).split('-')[0]}
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            name += '.gz'
+            headers['Content-Encoding'] = 'gzip'
+        with open(name, 'rb') as f:
+            body = f.read()
+        self.send_response(200)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_static(publish_dir, port):
+    StaticHandler.publish_dir = publish_dir
+    ThreadingHTTPServer.daemon_threads = True
+    ThreadingHTTPServer(('127.0.0.1', port), StaticHandler).serve_forever()
+
+
+def start_static(args, root, publish_dir):
+    port = free_port()
+    if args.nginx:
+        conf = root / 'nginx.conf'
+        conf.write_text(NGINX_CONF % {'root': root, 'port': port, 'publish': publish_dir})
+        proc = subprocess.Popen([args.nginx, '-p', str(root), '-c', str(conf), '-g', 'daemon off;'])
+    else:
+        proc = subprocess.Popen([sys.executable, __file__, '--static-server', str(publish_dir), str(port)])
+    return proc, 'http://127.0.0.1:%d' % port
+
+
+async def read_load(base, args, deadline):
+    latencies, errors = [], 0
+    limits = httpx.Limits(max_connections=args.readers)
+    async with httpx.AsyncClient(base_url=base, limits=limits, timeout=60) as client:
+        async def reader():
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                t0 = time.perf_counter()
+                try:
+                    r = await client.get('/api/teamdb', headers={'Accept-Encoding': 'gzip'})
+                    r.raise_for_status()
+                    latencies.append((time.perf_counter() - t0) * 1000.0)
+                except httpx.HTTPError:
+                    errors += 1
+        await asyncio.gather(*(reader() for _ in range(args.readers)))
+    return latencies, errors
+
+
+async def write_load(base, session, args, stop):
+    count = 0
+    async with httpx.AsyncClient(base_url=base, timeout=60) as client:
+        async def writer(n):
+            nonlocal count
+            i = 0
+            while not stop.is_set():
+                entry = {'name': 'Writer %d' % n, 'team_name': 'Team 0', 'site': 'LY', 'carry_over_holidays': i}
+                r = await client.put('/api/teamdb/people/Writer %d' % n, json=entry,
+                                     headers={'X-TeamDB-Session': session})
+                if r.status_code < 300:
+                    count += 1
+                i += 1
+        await asyncio.gather(*(writer(n) for n in range(args.writers)))
+    return count
+
+
+async def measure(service, target, session, args):
+    stop = asyncio.Event()
+    writes = asyncio.ensure_future(write_load(service, session, args, stop))
+    start = time.perf_counter()
+    latencies, errors = await read_load(target, args, start + args.duration)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    committed = await writes
+    result = {'rps': len(latencies) / elapsed, 'errors': errors, 'writes': committed}
+    if latencies:
+        result.update(p50_ms=percentile(latencies, 50), p99_ms=percentile(latencies, 99))
+    return result
+
+
+def run_workers(workers, args):
+    with tempfile.TemporaryDirectory(prefix='teamdb-publish-') as tmp:
+        root = Path(tmp)
+        data_root = root / 'data'
+        publish_dir = root / 'publish'
+        write_database(data_root / 'config' / 'database.yaml', args.people)
+        config = {'data_root': str(data_root), 'publish_dir': str(publish_dir)}
+        config.update(args.settings)
+        config_path = root / 'teamdb_config.yaml'
+        config_path.write_text(yaml.safe_dump(config))
+
+        port = free_port()
+        service = 'http://127.0.0.1:%d' % port
+        env = dict(os.environ, TEAMDB_CONFIG=str(config_path))
+        app = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', '--factory', 'server.teamdb:create_app', '--host', '127.0.0.1',
+             '--port', str(port), '--workers', str(workers), '--log-level', 'warning'], cwd=REPO_ROOT, env=env)
+        static, static_base = None, None
+        try:
+            wait_until(service + '/api/ready', app, 'uvicorn')
+            while not (publish_dir / 'current').exists():
+                time.sleep(0.1)
+            static, static_base = start_static(args, root, publish_dir)
+            wait_until(static_base + '/api/teamdb', static, 'static server')
+
+            token = httpx.post(service + '/api/token', json={'email': EMAIL}).json()['token']
+            session = httpx.post(service + '/api/session',
+                                 headers={'X-TeamDB-Email': EMAIL, 'X-TeamDB-Token': token}).json()['session']
+            result = {'workers': workers}
+            for label, base in (('service', service), ('static', static_base)):
+                result[label] = asyncio.run(measure(service, base, session, args))
+            # Every commit is published before it is acknowledged
+            revisions = [httpx.get(base + '/api/teamdb').headers.get('X-TeamDB-Revision')
+                         for base in (service, static_base)]
+            result['published_revision_current'] = revisions[0] == revisions[1]
+            return result
+        finally:
+            for proc in (static, app):
+                if proc is not None:
+                    proc.terminate()
+                    proc.wait(timeout=30)
+
+
+def parse_setting(text):
+    key, _, value = text.partition('=')
+    return key, yaml.safe_load(value)
+
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == '--static-server':
+        serve_static(sys.argv[2], int(sys.argv[3]))
+        return
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--people', type=int, default=1000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--readers', type=int, default=16)
+    parser.add_argument('--writers', type=int, default=1)
+    parser.add_argument('--nginx', default=shutil.which('nginx'), help='nginx binary (default: from PATH)')
+    parser.add_argument('--set', dest='settings', action='append', type=parse_setting, default=[],
+                        metavar='KEY=VALUE', help='extra config setting, e.g. storage_mode=sqlite')
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    args = parser.parse_args()
+    args.settings = dict(args.settings)
+
+    server = 'nginx' if args.nginx else 'Python stand-in (nginx not found)'
+    print('%d people, %d readers, %d writers, %.0f s per run; static server: %s' % (
+        args.people, args.readers, args.writers, args.duration, server))
+    print('%8s | %-30s | %-30s | %s' % ('workers', 'service GET  req/s  p50  p99', 'static GET  req/s  p50  p99',
+                                        'published'))
+    results = []
+    for workers in args.workers:
+        r = run_workers(workers, args)
+        results.append(r)
+        print('%8d | %16.1f %6.1f %6.1f | %15.1f %6.1f %6.1f | %s' % (
+            workers, r['service']['rps'], r['service'].get('p50_ms', 0), r['service'].get('p99_ms', 0),
+            r['static']['rps'], r['static'].get('p50_ms', 0), r['static'].get('p99_ms', 0),
+            'current' if r['published_revision_current'] else 'BEHIND'))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'people': args.people, 'readers': args.readers, 'writers': args.writers,
+                       'duration': args.duration, 'static_server': server, 'results': results}, f, indent=2)
+        print('Results written to %s' % args.output)
+    if not all(r['published_revision_current'] for r in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+bench_storage.py
+
+Micro-benchmark for `server.lib.storage.FileStorageBackend`.
+
+Compares the previous behaviour (namespace `mkdir` on every access, every
+load re-reads and re-parses the file, one fsync per saved key) against the
+current backend with its read cache, `save_many`/`load_many` batch calls and
+`os.scandir`-based `list_keys`. Runs in a temporary directory; no server
+needed.
+
+    python3 tests/server/bench_storage.py --keys 200 --entries 50 --rounds 20
+"""
+
+import argparse
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+from server.lib.storage import FileStorageBackend  # noqa: E402
+
+
+class LegacyFileStorageBackend(FileStorageBackend):
+    """The backend as it behaved before the cache and batch APIs."""
+
+    def __init__(self, data_dir):
+        super().__init__(data_dir, cache_size=0)
+
+    def _ns_dir(self, namespace, create=False):
+        ns = self.data_dir / namespace
+        ns.mkdir(parents=True, exist_ok=True)
+        return ns
+
+    def list_keys(self, namespace):
+        # Path.iterdir + suffix check as before (on .json so both list the same keys)
+        for p in self._ns_dir(namespace).iterdir():
+            if p.is_file() and p.suffix == '.json':
+                yield p.stem
+
+
+def make_value(entries):
+    return {
+        f'user{i}@example.com': {'salt': '00' * 16, 'hash': 'ab' * 32, 'iterations': 100000}
+        for i in range(entries)
+    }
+
+
+def timed(fn, rounds):
+    samples = []
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000.0)
+    return statistics.median(samples)
+
+
+def run(backend, keys, value, rounds, batch):
+    backend.configure(mode='json')
+    names = [f'key{i}' for i in range(len(keys))]
+    items = dict(zip(names, [value] * len(names)))
+
+    def save():
+        if batch:
+            backend.save_many('bench', items)
+        else:
+            for name, v in items.items():
+                backend.save('bench', name, v)
+
+    def load():
+        if batch:
+            backend.load_many('bench', names)
+        else:
+            for name in names:
+                backend.load('bench', name)
+
+    def listing():
+        list(backend.list_keys('bench'))
+
+    save_ms = timed(save, max(1, rounds // 5))
+    load()  # warm the read cache, if any
+    return {
+        'save': save_ms,
+        'load': timed(load, rounds),
+        'list_keys': timed(listing, rounds),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--keys', type=int, default=200, help='keys per namespace')
+    parser.add_argument('--entries', type=int, default=50, help='entries in each stored value')
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    value = make_value(args.entries)
+    keys = range(args.keys)
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy = run(LegacyFileStorageBackend(Path(tmp) / 'legacy'), keys, value, args.rounds, batch=False)
+        current = run(FileStorageBackend(Path(tmp) / 'current', cache_size=args.keys), keys, value, args.rounds, batch=True)
+
+    print('%d keys x %d entries, median of %d rounds (ms for all keys)' % (args.keys, args.entries, args.rounds))
+    print('%-10s %12s %12s %9s' % ('op', 'legacy', 'current', 'speedup'))
+    for op in ('save', 'load', 'list_keys'):
+        print('%-10s %12.2f %12.2f %8.1fx' % (op, legacy[op], current[op], legacy[op] / max(current[op], 1e-6)))
+
+
+if __name__ == '__main__':
+    main()
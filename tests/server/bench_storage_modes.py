@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+bench_storage_modes.py
+
+Compares the value modes of `server.lib.storage.FileStorageBackend`: bytes
+on disk and median save/load time for the same values in each mode. Modes
+whose optional package (msgpack, zstandard) is not installed are reported
+and skipped. By default the values are token-map style dicts; pass
+`--database` to store a YAML team database instead. Runs in a temporary
+directory; no server needed.
+
+    python3 tests/server/bench_storage_modes.py --keys 50 --entries 500 --rounds 10
+    python3 tests/server/bench_storage_modes.py --database data/config/database.yaml
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+from server.lib import storage  # noqa: E402
+from server.lib.storage import FileStorageBackend  # noqa: E402
+
+MODES = ('json', 'json.gz', 'msgpack', 'zstd', 'pickle')
+
+
+def make_value(entries):
+    return {
+        f'user{i}@example.com': {'salt': '00' * 16, 'hash': 'ab' * 32, 'iterations': 100000}
+        for i in range(entries)
+    }
+
+
+def timed(fn, rounds):
+    samples = []
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000.0)
+    return statistics.median(samples)
+
+
+def disk_bytes(directory):
+    total = 0
+    for entry in os.scandir(directory):
+        if entry.is_file():
+            total += entry.stat().st_size
+    return total
+
+
+def run(root, mode, items, rounds):
+    backend = FileStorageBackend(root / mode.replace('.', '_'))
+    backend.configure(mode=mode)
+    names = list(items)
+
+    def save():
+        for name, value in items.items():
+            backend.save('bench', name, value)
+
+    def load():
+        for name in names:
+            backend.load('bench', name)
+
+    save_ms = timed(save, max(1, rounds // 2))
+    return {
+        'bytes': disk_bytes(backend.data_dir / 'bench'),
+        'save': save_ms,
+        'load': timed(load, rounds),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--keys', type=int, default=50, help='number of stored values')
+    parser.add_argument('--entries', type=int, default=500, help='entries in each stored value')
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--database', help='store this YAML database (once per key) instead of token maps')
+    args = parser.parse_args()
+
+    if args.database:
+        import yaml
+        with open(args.database, 'r', encoding='utf-8') as f:
+            value = yaml.safe_load(f)
+        label = '%s' % args.database
+    else:
+        value = make_value(args.entries)
+        label = '%d entries' % args.entries
+    items = {f'key{i}': value for i in range(args.keys)}
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in MODES:
+            missing = storage._CODECS[mode].missing
+            if missing:
+                print('%-8s skipped (pip install %s)' % (mode, missing))
+                continue
+            results[mode] = run(Path(tmp), mode, items, args.rounds)
+
+    base = results['json']
+    print('%d values of %s, median of %d rounds (ms for all values)' % (args.keys, label, args.rounds))
+    print('%-8s %12s %7s %10s %10s' % ('mode', 'bytes', 'ratio', 'save', 'load'))
+    for mode, r in results.items():
+        print('%-8s %12d %6.2fx %10.2f %10.2f' % (mode, r['bytes'], r['bytes'] / max(base['bytes'], 1), r['save'], r['load']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+bench_validator.py
+
+Benchmark for `server.lib.db_validator` on a synthetic database.
+
+Compares the previous validator (`datetime.strptime` per birthday, one
+function call per field) with the schema compiled at import time, and the
+incremental paths: a full upload checked against a `ValidationBaseline`
+with one changed person, and a `changed={kind: names}` validation. These
+rows skip the referential integrity pass, which is timed on its own. No
+server needed.
+
+    python3 tests/server/bench_validator.py --people 20000 --rounds 10
+"""
+
+import argparse
+import copy
+import statistics
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+from gen_database import make_database  # noqa: E402
+from server.lib.db_validator import ValidationBaseline, ValidationError, iter_integrity_errors, validate_database  # noqa: E402
+
+
+# -- the validator before the compiled schema --
+
+def _legacy_str(val, path):
+    if not isinstance(val, str):
+        raise ValidationError('must be a string', path=path)
+
+
+def _legacy_person(person, ppath):
+    if not isinstance(person, dict):
+        raise ValidationError('person entry must be a mapping', path=ppath)
+    if 'name' not in person:
+        raise ValidationError('person.name is required', path=ppath + ('name',))
+    _legacy_str(person.get('name'), ppath + ('name',))
+    val = person.get('birthday', '')
+    if val not in ('', None):
+        try:
+            datetime.strptime(val, '%Y-%m-%d')
+        except Exception:
+            raise ValidationError('birthday must be ISO date yyyy-mm-dd or empty', path=ppath + ('birthday',))
+    for field in ('title', 'team_name', 'legal_manager', 'functional_manager', 'site'):
+        if field in person:
+            _legacy_str(person.get(field), ppath + (field,))
+    if 'external' in person and not isinstance(person['external'], bool):
+        raise ValidationError('must be a boolean', path=ppath + ('external',))
+    if 'virtual_team' in person:
+        for i, item in enumerate(person['virtual_team']):
+            _legacy_str(item, ppath + ('virtual_team', str(i)))
+    if 'carry_over_holidays' in person and not isinstance(person['carry_over_holidays'], int):
+        raise ValidationError('must be an integer', path=ppath + ('carry_over_holidays',))
+
+
+def _legacy_named(entry, path, fields):
+    if not isinstance(entry, dict) or 'name' not in entry:
+        raise ValidationError('entry must be a mapping with a name', path=path)
+    for field in fields:
+        if field in entry:
+            _legacy_str(entry[field], path + (field,))
+
+
+def legacy_validate(db):
+    inner = db['database']
+    for idx, person in enumerate(inner['people']):
+        _legacy_person(person, ('database', 'people', str(idx)))
+    for idx, team in enumerate(inner['teams']):
+        _legacy_named(team, ('database', 'teams', str(idx)), ('name', 'short_name', 'product_owner', 'functional_manager', 'parent_team'))
+    for idx, proj in enumerate(inner.get('projects', [])):
+        _legacy_named(proj, ('database', 'projects', str(idx)), ('name', 'project_lead'))
+
+
+def timed(fn, rounds):
+    samples = []
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000.0)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--people', type=int, default=20000)
+    parser.add_argument('--rounds', type=int, default=10)
+    args = parser.parse_args()
+
+    db = make_database(args.people)
+    baseline = ValidationBaseline(db)
+    # A fresh upload (no shared objects) with one edited person, as a PUT body parses
+    upload = copy.deepcopy(db)
+    edited = upload['database']['people'][args.people // 2]
+    edited['title'] = 'Staff Engineer'
+
+    results = [
+        ('legacy full', timed(lambda: legacy_validate(upload), args.rounds)),
+        ('compiled full', timed(lambda: validate_database(upload, references=False), args.rounds)),
+        ('baseline', timed(lambda: validate_database(upload, baseline=baseline, references=False), args.rounds)),
+        ('changed set', timed(lambda: validate_database(upload, changed={'people': [edited['name']]}, references=False),
+                              args.rounds)),
+        ('build baseline', timed(lambda: ValidationBaseline(upload), args.rounds)),
+        ('integrity', timed(lambda: list(iter_integrity_errors(upload)), args.rounds)),
+    ]
+    base = results[0][1]
+    print('%d people, %d teams, median of %d rounds' % (
+        args.people, len(db['database']['teams']), args.rounds))
+    print('%-16s %10s %9s' % ('validation', 'ms', 'speedup'))
+    for name, ms in results:
+        print('%-16s %10.2f %8.1fx' % (name, ms, base / max(ms, 1e-6)))
+
+
+if __name__ == '__main__':
+    main()
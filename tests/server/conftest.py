@@ -0,0 +1,8 @@
+"""pytest setup for the server tests: import `server.*` from the repository root.
+
+    python3 -m pytest tests/server
+"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
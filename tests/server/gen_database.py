@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+gen_database.py
+
+Write synthetic team databases for benchmarks. Every reference resolves
+(people name their team and managers, teams form a tree of four children
+per parent), so the files pass the server's validation with
+`validate_references` on. The output is deterministic for a given size.
+
+    python3 tests/server/gen_database.py --people 100 1000 10000 50000 --out /tmp/teamdb-bench
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+import yaml
+
+try:
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
+
+
+def make_database(people, teams=None):
+    teams = teams or max(1, people // 10)
+    return {
+        'version': '20260107',
+        'database': {
+            'people': [
+                {
+                    'name': f'Person {i}',
+                    'birthday': '19%02d-%02d-%02d' % (50 + i % 50, 1 + i % 12, 1 + i % 28),
+                    'title': 'Engineer',
+                    'external': i % 7 == 0,
+                    'team_name': f'Team {i % teams}',
+                    'virtual_team': [f'Team {(i + 1) % teams}'] if i % 5 == 0 else [],
+                    'legal_manager': f'Person {i // 10 * 10}',
+                    'functional_manager': f'Person {i // 10 * 10}',
+                    'carry_over_holidays': i % 10,
+                    'site': 'LY',
+                }
+                for i in range(people)
+            ],
+            'teams': [
+                dict({'name': f'Team {i}', 'short_name': f'T{i}', 'product_owner': f'Person {i}',
+                      'functional_manager': f'Person {i}'},
+                     **({'parent_team': f'Team {(i - 1) // 4}'} if i else {}))
+                for i in range(teams)
+            ],
+            'projects': [{'name': f'Project {i}', 'project_lead': f'Person {i}'} for i in range(teams // 2)],
+        },
+    }
+
+
+def write_database(path, people, teams=None):
+    """Write a synthetic database.yaml with `people` people; return its size in bytes."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        yaml.dump(make_database(people, teams), f, Dumper=SafeDumper, sort_keys=False, allow_unicode=True)
+    return path.stat().st_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--people', type=int, nargs='+', default=[100, 1000, 10000, 50000])
+    parser.add_argument('--teams', type=int, help='number of teams (default: people / 10)')
+    parser.add_argument('--out', default='.', help='directory for database-<people>.yaml files')
+    args = parser.parse_args()
+
+    for people in args.people:
+        path = Path(args.out) / f'database-{people}.yaml'
+        size = write_database(path, people, args.teams)
+        print('%s: %d people, %d bytes' % (path, people, size))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
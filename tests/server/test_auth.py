@@ -0,0 +1,137 @@
+"""Session tokens and the token index, and how writes authenticate with them."""
+import base64
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from gen_database import write_database
+from server.lib.auth import SessionSigner, TokenIndex, hash_token, token_fingerprint
+from server.lib.storage import FileStorageBackend
+from server.teamdb import create_app
+
+NOW = 1_800_000_000
+
+
+def signer():
+    return SessionSigner(b'k' * 32, ttl=600)
+
+
+def b64(text):
+    return base64.urlsafe_b64encode(text.encode('utf-8')).rstrip(b'=').decode('ascii')
+
+
+# -- SessionSigner --
+
+def test_session_round_trip():
+    session, expires = signer().issue('ann@example.com', 'fp', now=NOW)
+    assert expires == NOW + 600
+    assert signer().verify(session, now=NOW) == ('ann@example.com', 'fp')
+
+
+def test_tampered_signature_is_rejected():
+    session, _ = signer().issue('ann@example.com', 'fp', now=NOW)
+    message, signature = session.rsplit('.', 1)
+    flipped = ('A' if signature[0] != 'A' else 'B') + signature[1:]
+    assert signer().verify('%s.%s' % (message, flipped), now=NOW) is None
+    # Signed with another secret
+    other, _ = SessionSigner(b'x' * 32, ttl=600).issue('ann@example.com', 'fp', now=NOW)
+    assert signer().verify(other, now=NOW) is None
+
+
+@pytest.mark.parametrize('part, value', [
+    (0, b64('bob@example.com')),  # someone else's email
+    (1, str(NOW + 10 ** 6)),      # a later expiry
+    (2, 'other'),                 # another token's fingerprint
+])
+def test_tampered_payload_with_the_old_signature_is_rejected(part, value):
+    session, _ = signer().issue('ann@example.com', 'fp', now=NOW)
+    parts = session.split('.')
+    parts[part] = value
+    assert signer().verify('.'.join(parts), now=NOW) is None
+
+
+def test_session_expires_after_ttl():
+    session, expires = signer().issue('ann@example.com', 'fp', now=NOW)
+    assert signer().verify(session, now=expires) is not None
+    assert signer().verify(session, now=expires + 1) is None
+
+
+@pytest.mark.parametrize('session', ['', 'garbage', 'a.b.c.d', 'a.b.c.d.e', '!!!.1.fp.sig'])
+def test_malformed_sessions_are_rejected(session):
+    assert signer().verify(session, now=NOW) is None
+
+
+# -- TokenIndex --
+
+def test_token_index_reloads_when_the_file_changes(tmp_path):
+    stor = FileStorageBackend(tmp_path)
+    index = TokenIndex(stor, 'tokens', 'tokens')
+    assert index.get('ann@example.com') is None
+    first = hash_token('one', iterations=1)
+    stor.save('tokens', 'tokens', {'ann@example.com': first})
+    assert index.get('ann@example.com') == first
+    second = hash_token('two', iterations=1)
+    stor.save('tokens', 'tokens', {'ann@example.com': second})
+    assert token_fingerprint(index.get('ann@example.com')) == token_fingerprint(second)
+
+
+# -- Writes --
+
+@pytest.fixture
+def client(tmp_path):
+    write_database(tmp_path / 'data/config/database.yaml', 5)
+    # /api/token only answers local clients
+    with TestClient(create_app({'data_root': str(tmp_path / 'data')}), client=('127.0.0.1', 5000)) as c:
+        yield c
+
+
+def new_token(client, email='dev@example.com'):
+    return client.post('/api/token', json={'email': email}).json()['token']
+
+
+def new_session(client, token, email='dev@example.com'):
+    r = client.post('/api/session', headers={'X-TeamDB-Email': email, 'X-TeamDB-Token': token})
+    assert r.status_code == 200, r.text
+    return r.json()['session']
+
+
+def put_person(client, **headers):
+    return client.put('/api/teamdb/people/Zed', json={'name': 'Zed'}, headers=headers)
+
+
+def test_session_authenticates_writes(client):
+    session = new_session(client, new_token(client))
+    assert put_person(client, **{'X-TeamDB-Session': session}).status_code in (200, 201)
+
+
+def test_reissuing_the_token_invalidates_its_sessions(client):
+    session = new_session(client, new_token(client))
+    token = new_token(client)
+    r = put_person(client, **{'X-TeamDB-Session': session})
+    assert r.status_code == 401
+    assert r.json()['detail'] == 'Invalid or expired session'
+    assert put_person(client, **{'X-TeamDB-Session': new_session(client, token)}).status_code in (200, 201)
+
+
+def test_bad_session_falls_back_to_the_token(client):
+    token = new_token(client)
+    bad = new_session(client, token)[:-2] + 'xx'
+    assert put_person(client, **{'X-TeamDB-Session': bad}).status_code == 401
+    headers = {'X-TeamDB-Session': bad, 'X-TeamDB-Email': 'dev@example.com', 'X-TeamDB-Token': token}
+    assert put_person(client, **headers).status_code in (200, 201)
+    headers['X-TeamDB-Token'] = 'wrong'
+    assert put_person(client, **headers).status_code == 403
+
+
+def test_session_ttl_is_configurable(tmp_path):
+    write_database(tmp_path / 'data/config/database.yaml', 5)
+    app = create_app({'data_root': str(tmp_path / 'data'), 'session_ttl': 30})
+    with TestClient(app, client=('127.0.0.1', 5000)) as c:
+        before = time.time()
+        session = new_session(c, new_token(c))
+        expires = int(session.split('.')[1])
+        assert before + 29 <= expires <= time.time() + 30
+        signer = c.app.state.teamdb.session_signer
+        assert signer.verify(session, now=expires) is not None
+        assert signer.verify(session, now=expires + 1) is None
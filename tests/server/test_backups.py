@@ -0,0 +1,153 @@
+"""Backup versions: only entries with new content are hashed and stored."""
+import copy
+import random
+
+import pytest
+
+from server.lib import backups
+from server.lib.backups import BackupStore
+from server.lib.dbpatch import apply_entity_delta
+from gen_database import make_database
+
+
+@pytest.fixture
+def hashed(monkeypatch):
+    """Names of the entries hashed by the backup store."""
+    names = []
+    revision = backups.entity_revision
+
+    def counting(entry):
+        names.append(entry.get('name') if isinstance(entry, dict) else entry)
+        return revision(entry)
+
+    monkeypatch.setattr(backups, 'entity_revision', counting)
+    return names
+
+
+def test_full_upload_hashes_only_changed_entries(tmp_path, hashed):
+    store = BackupStore(tmp_path)
+    doc = make_database(100)
+    store.add(doc, 1)
+    assert len(hashed) == 100 + 10 + 5
+
+    # A parsed upload shares no objects with the stored document
+    upload = copy.deepcopy(doc)
+    upload['database']['people'][3]['title'] = 'Manager'
+    hashed.clear()
+    assert store.add(upload, 2).version == 2
+    assert hashed == ['Person 3']
+
+    # Entries that moved are matched by name
+    moved = copy.deepcopy(upload)
+    del moved['database']['people'][:20]
+    moved['database']['people'].append({'name': 'New'})
+    hashed.clear()
+    store.add(moved, 3)
+    assert hashed[-1] == 'New' and len(hashed) <= backups.NAME_LOOKUP_MISSES + 1
+    assert store.load(3) == moved
+
+
+def test_delta_hashes_only_upserted_entries(tmp_path, hashed):
+    store = BackupStore(tmp_path)
+    doc = make_database(100)
+    store.add(doc, 1)
+    doc = apply_entity_delta(doc, {'people': {'upsert': [{'name': 'Person 7', 'title': 'Lead'}]}}, references=False)
+    hashed.clear()
+    store.add(doc, 2)
+    assert hashed == ['Person 7']
+    assert store.load(2) == doc
+    assert [v.version for v in store.versions()] == [2, 1]
+    # Storing the same content again adds no version
+    assert store.add(copy.deepcopy(doc), 3) is None
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_splices_turn_one_list_into_the_other(seed):
+    rng = random.Random(seed)
+    old = [['e%d' % i, 'h%d' % i] for i in range(rng.randrange(0, 60))]
+    new = list(old)
+    for _ in range(rng.randrange(0, 6)):
+        op = rng.choice(('edit', 'insert', 'delete', 'move'))
+        i = rng.randrange(0, len(new) + 1)
+        if op == 'insert' or not new:
+            new.insert(i, ['n%d' % rng.random(), 'x%d' % rng.random()])
+        elif op == 'edit':
+            new[i % len(new)] = [new[i % len(new)][0], 'x%d' % rng.random()]
+        elif op == 'delete':
+            del new[i % len(new):i % len(new) + rng.randrange(1, 30)]
+        else:
+            new.insert(rng.randrange(0, len(new)), new.pop(i % len(new)))
+    assert backups._apply_splices(old, backups._splices(old, new)) == new
+
+
+def edit(doc, rng, step):
+    people = doc['database']['people']
+    name = people[rng.randrange(len(people))]['name']
+    op = step % 5
+    if op == 0:
+        delta = {'people': {'upsert': [{'name': name, 'title': 'T%d' % step}]}}
+    elif op == 1:
+        delta = {'people': {'upsert': [{'name': 'New %d' % step}]}}
+    elif op == 2:
+        delta = {'people': {'delete': [name]}}
+    elif op == 3:
+        delta = {'projects': {'upsert': [{'name': 'P%d' % step}]}, 'people': {'delete': [name]}}
+    else:
+        # A full upload: nothing shared with the stored document
+        doc = copy.deepcopy(doc)
+        doc['database']['people'].reverse()
+        doc['version'] = '2026%04d' % step
+        return doc
+    return apply_entity_delta(doc, delta, references=False)
+
+
+def stored_objects(root):
+    return {p.name.split('.')[0] for p in (root / 'objects').glob('*/*.json.gz')}
+
+
+def test_delta_manifests_round_trip_through_pruning(tmp_path, monkeypatch):
+    monkeypatch.setattr(backups, 'FULL_MANIFEST_EVERY', 4)
+    store = BackupStore(tmp_path, max_versions=6)
+    rng = random.Random(7)
+    doc = make_database(40)
+    docs = {}
+    for step in range(30):
+        info = store.add(doc, step)
+        docs[info.version] = doc
+        doc = edit(doc, rng, step)
+    manifests = [p.name for p in (tmp_path / 'versions').iterdir()]
+    assert any(name.endswith('.delta.json.gz') for name in manifests)
+    retained = [v.version for v in store.versions()]
+    assert len(retained) == 6
+
+    for reopened in (store, BackupStore(tmp_path, max_versions=6)):
+        for version in retained:
+            assert reopened.load(version) == docs[version]
+    # Only what the retained versions use is kept, and no manifest before their full base
+    used = {digest for v in retained for items in store.read_manifest(v)['entities'].values() for _, digest in items}
+    assert stored_objects(tmp_path) == used
+    assert len(manifests) < 6 + backups.FULL_MANIFEST_EVERY
+
+    # A restarted store writes a full manifest and goes on with deltas
+    store = BackupStore(tmp_path, max_versions=6)
+    for step in range(30, 40):
+        info = store.add(doc, step)
+        docs[info.version] = doc
+        doc = edit(doc, rng, step)
+    for v in store.versions():
+        assert store.load(v.version) == docs[v.version]
+    used = {digest for v in store.versions() for items in store.read_manifest(v.version)['entities'].values()
+            for _, digest in items}
+    assert stored_objects(tmp_path) == used
+
+
+def test_one_entry_change_writes_a_small_delta(tmp_path):
+    store = BackupStore(tmp_path)
+    doc = make_database(2000)
+    store.add(doc, 1)
+    doc = apply_entity_delta(doc, {'people': {'upsert': [{'name': 'Person 7', 'title': 'Lead'}]}}, references=False)
+    store.add(doc, 2)
+    full = (tmp_path / 'versions/00000001.json.gz').stat().st_size
+    delta = (tmp_path / 'versions/00000002.delta.json.gz').stat().st_size
+    assert delta < 1000 < full
+    assert store.load(2) == doc
@@ -0,0 +1,143 @@
+"""Queued writes: arrival order, batching and per-write outcomes."""
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+from gen_database import write_database
+from server.lib.commitqueue import CommitQueue
+from server.teamdb import create_app
+
+
+# -- CommitQueue --
+
+def test_items_are_applied_in_arrival_order_and_batched():
+    batches = []
+
+    async def apply_batch(items):
+        batches.append(list(items))
+        await asyncio.sleep(0.01)
+        return [item * 10 for item in items]
+
+    async def main():
+        queue = CommitQueue(apply_batch, max_batch=3)
+        first = asyncio.ensure_future(queue.submit(0))
+        await asyncio.sleep(0)
+        # Queued while the first batch is applied
+        rest = [asyncio.ensure_future(queue.submit(i)) for i in range(1, 6)]
+        results = await asyncio.gather(first, *rest)
+        await queue.close()
+        return results
+
+    assert asyncio.run(main()) == [0, 10, 20, 30, 40, 50]
+    assert batches == [[0], [1, 2, 3], [4, 5]]
+
+
+def test_an_exception_outcome_fails_only_its_own_write():
+    async def apply_batch(items):
+        return [ValueError(item) if item == 'bad' else item.upper() for item in items]
+
+    async def main():
+        queue = CommitQueue(apply_batch)
+        results = await asyncio.gather(*(queue.submit(item) for item in ('a', 'bad', 'c')), return_exceptions=True)
+        await queue.close()
+        return results
+
+    a, bad, c = asyncio.run(main())
+    assert (a, c) == ('A', 'C')
+    assert isinstance(bad, ValueError)
+
+
+def test_a_failing_batch_fails_its_writes_and_the_queue_goes_on():
+    calls = []
+
+    async def apply_batch(items):
+        calls.append(list(items))
+        if len(calls) == 1:
+            raise RuntimeError('disk full')
+        return list(items)
+
+    async def main():
+        queue = CommitQueue(apply_batch)
+        failed = await asyncio.gather(queue.submit(1), queue.submit(2), return_exceptions=True)
+        later = await queue.submit(3)
+        await queue.close()
+        return failed, later
+
+    failed, later = asyncio.run(main())
+    assert [type(e) for e in failed] == [RuntimeError, RuntimeError]
+    assert later == 3
+
+
+# -- TeamDB batches --
+
+@pytest.fixture(params=['snapshot', 'journal', 'sqlite'])
+def client(request, tmp_path):
+    write_database(tmp_path / 'data/config/database.yaml', 5)
+    config = {'data_root': str(tmp_path / 'data'), 'storage_mode': request.param}
+    with TestClient(create_app(config), client=('127.0.0.1', 5000)) as c:
+        yield c
+
+
+def add_person(db, name, seen):
+    def build(state):
+        seen.append((name, [p['name'] for p in state.data['database']['people']][-1]))
+        return db.entity_delta_version(state, 'people', {'upsert': [{'name': name}]})
+    return build
+
+
+def stale(seen):
+    def build(state):
+        seen.append(('stale', None))
+        raise HTTPException(status_code=412, detail='Server has newer version')
+    return build
+
+
+def broken(seen):
+    def build(state):
+        seen.append(('broken', None))
+        raise RuntimeError('bug in a handler')
+    return build
+
+
+def commit_together(client, builds):
+    db = client.app.state.teamdb
+
+    async def main():
+        return await asyncio.gather(*(db.commit(build) for build in builds), return_exceptions=True)
+    return client.portal.call(main)
+
+
+def test_batch_outcomes_are_per_write(client, monkeypatch):
+    db = client.app.state.teamdb
+    client.get('/api/teamdb')
+    start = db.changelog.revision
+    saves = []
+    commit_versions = db.commit_versions
+    monkeypatch.setattr(db, 'commit_versions', lambda *args: saves.append(args) or commit_versions(*args))
+
+    seen = []
+    outcomes = commit_together(client, [
+        add_person(db, 'Xia', seen), stale(seen), add_person(db, 'Yan', seen),
+        broken(seen), add_person(db, 'Zed', seen),
+    ])
+
+    # Built in arrival order, each on the writes accepted before it
+    assert [name for name, _ in seen] == ['Xia', 'stale', 'Yan', 'broken', 'Zed']
+    assert [last for _, last in seen if last is not None][1:] == ['Xia', 'Yan']
+    # Rejected writes fail on their own
+    assert outcomes[1].status_code == 412
+    assert outcomes[3].status_code == 500
+    revisions = [outcomes[i].revision for i in (0, 2, 4)]
+    assert revisions == [start + 1, start + 2, start + 3]
+    # One save for the batch, one change-log entry per accepted write
+    assert len(saves) == 1
+    changes = db.changelog.changes_since(start)
+    assert [(c['revision'], c['name']) for c in changes] == list(zip(revisions, ['Xia', 'Yan', 'Zed']))
+    # Only the last write's outcome carries the stored snapshot
+    assert [outcomes[i].snapshot is not None for i in (0, 2, 4)] == [False, False, True]
+
+    r = client.get('/api/teamdb')
+    assert [p['name'] for p in r.json()['database']['people']][-3:] == ['Xia', 'Yan', 'Zed']
+    assert int(r.headers['X-TeamDB-Revision']) == revisions[-1]
@@ -0,0 +1,119 @@
+"""Reference checks: only problems a write introduces are reported."""
+import copy
+
+import pytest
+
+from server.lib.db_validator import (ValidationErrors, iter_integrity_errors, iter_new_integrity_errors,
+                                     validate_database)
+from server.lib.dbmodel import EntityIndex
+
+
+def stored():
+    # What the extension exports: managers from another system, a team that was dropped
+    return {'version': '20260107', 'database': {
+        'people': [
+            {'name': 'Ann', 'team_name': 'N/A', 'legal_manager': 'Boss Outside'},
+            {'name': 'Bob', 'team_name': 'Core', 'functional_manager': 'Ann', 'virtual_team': ['Sub']},
+        ],
+        'teams': [{'name': 'Core'}, {'name': 'Sub', 'parent_team': 'Core'}],
+        'projects': [],
+    }}
+
+
+def new_errors(before, after):
+    return [(str(e), '/'.join(e.path)) for e in iter_new_integrity_errors(before, after, EntityIndex(before).positions)]
+
+
+def test_stored_problems_do_not_block_an_unchanged_upload():
+    before = stored()
+    assert len(list(iter_integrity_errors(before))) == 2
+    assert new_errors(before, copy.deepcopy(before)) == []
+
+
+def test_editing_an_entry_keeps_its_old_dangling_references():
+    before = stored()
+    after = copy.deepcopy(before)
+    after['database']['people'][0]['title'] = 'Engineer'
+    assert new_errors(before, after) == []
+
+
+def test_new_dangling_reference_is_reported():
+    before = stored()
+    after = copy.deepcopy(before)
+    after['database']['people'].append({'name': 'Carl', 'team_name': 'Ghost', 'virtual_team': ['Core', 'Gone']})
+    assert new_errors(before, after) == [
+        ("unknown team 'Ghost'", 'database/people/2/team_name'),
+        ("unknown team 'Gone'", 'database/people/2/virtual_team/1'),
+    ]
+
+
+def test_changing_a_dangling_reference_to_another_one_is_reported():
+    before = stored()
+    after = copy.deepcopy(before)
+    after['database']['people'][0]['legal_manager'] = 'Someone Else'
+    assert new_errors(before, after) == [("unknown person 'Someone Else'", 'database/people/0/legal_manager')]
+
+
+def test_deleting_a_referenced_entity_reports_its_referrers():
+    before = stored()
+    after = copy.deepcopy(before)
+    del after['database']['teams'][0]
+    del after['database']['people'][0]
+    assert new_errors(before, after) == [
+        ("unknown team 'Core'", 'database/people/0/team_name'),
+        ("unknown person 'Ann'", 'database/people/0/functional_manager'),
+        ("unknown team 'Core'", 'database/teams/0/parent_team'),
+    ]
+
+
+def test_new_duplicate_is_reported_but_an_old_one_is_not():
+    before = stored()
+    before['database']['projects'] = [{'name': 'P'}, {'name': 'P'}]
+    after = copy.deepcopy(before)
+    assert new_errors(before, after) == []
+    after['database']['teams'].append({'name': 'Core'})
+    assert new_errors(before, after) == [
+        ("duplicate team name 'Core' (first at teams/0)", 'database/teams/2/name'),
+    ]
+
+
+def test_new_cycle_is_reported_once():
+    before = stored()
+    after = copy.deepcopy(before)
+    after['database']['teams'][0]['parent_team'] = 'Sub'
+    assert new_errors(before, after) == [
+        ('team hierarchy cycle: Core -> Sub -> Core', 'database/teams/0/parent_team'),
+    ]
+
+
+def test_cycle_above_a_changed_chain_is_reported_once():
+    before = stored()
+    # T0 -> T1 -> ... -> T1999, with a cycle between the last two teams
+    chain = [{'name': 'T%d' % i, 'parent_team': 'T%d' % (i + 1)} for i in range(2000)]
+    chain[-1]['parent_team'] = 'T1998'
+    before['database']['teams'] = chain[:-2]
+    after = copy.deepcopy(before)
+    after['database']['teams'] = [dict(team, description='x') for team in chain]
+    assert new_errors(before, after) == [
+        ('team hierarchy cycle: T1998 -> T1999 -> T1998', 'database/teams/1998/parent_team'),
+    ]
+
+
+def test_shared_lists_are_not_rechecked():
+    before = stored()
+    # Only the projects list is new, as after a copy-on-write patch
+    after = dict(before, database=dict(before['database'], projects=[{'name': 'P', 'project_lead': 'Nobody'}]))
+    assert new_errors(before, after) == []
+
+
+def test_validate_database_with_previous_collects_only_new_problems():
+    before = stored()
+    after = copy.deepcopy(before)
+    validate_database(after, previous=before, collect=True)
+    after['database']['people'][1]['team_name'] = 'Ops'
+    with pytest.raises(ValidationErrors) as info:
+        validate_database(after, previous=before, collect=True)
+    assert [str(e) for e in info.value.errors] == ["unknown team 'Ops'"]
+    with pytest.raises(ValidationErrors) as info:
+        validate_database(after, collect=True)
+    assert len(info.value.errors) == 3
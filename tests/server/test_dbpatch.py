@@ -0,0 +1,231 @@
+"""JSON Patch and entity delta semantics of PATCH /api/teamdb."""
+import copy
+
+import pytest
+
+from server.lib.changelog import delta_changes, diff_entities
+from server.lib.db_validator import ValidationError
+from server.lib.dbmodel import EntityIndex
+from server.lib.dbpatch import (PatchConflict, PatchError, apply_entity_delta, apply_entity_delta_indexed,
+                                apply_json_patch, parse_pointer)
+from server.lib.journal import apply_record
+
+
+def stored():
+    return {'version': '20260107', 'database': {
+        'people': [
+            {'name': 'Ann', 'team_name': 'Core', 'title': 'Lead'},
+            {'name': 'Bob', 'team_name': 'Core', 'functional_manager': 'Ann'},
+        ],
+        'teams': [{'name': 'Core'}, {'name': 'Sub', 'parent_team': 'Core'}],
+        'projects': [{'name': 'P'}],
+    }}
+
+
+def people(doc):
+    return [p['name'] for p in doc['database']['people']]
+
+
+# -- JSON Patch --
+
+def test_pointer_unescapes_tokens():
+    assert parse_pointer('') == []
+    assert parse_pointer('/a~1b/c~0d/~01') == ['a/b', 'c~d', '~1']
+    with pytest.raises(PatchError):
+        parse_pointer('people/0')
+    with pytest.raises(PatchError):
+        parse_pointer(3)
+
+
+def test_add_replace_remove():
+    doc = stored()
+    before = copy.deepcopy(doc)
+    result = apply_json_patch(doc, [
+        {'op': 'add', 'path': '/database/people/-', 'value': {'name': 'Carl'}},
+        {'op': 'add', 'path': '/database/people/0', 'value': {'name': 'Zoe'}},
+        {'op': 'replace', 'path': '/database/people/1/title', 'value': 'Boss'},
+        {'op': 'remove', 'path': '/database/people/2/functional_manager'},
+        {'op': 'add', 'path': '/database/projects/0/description', 'value': 'x'},
+    ])
+    assert people(result) == ['Zoe', 'Ann', 'Bob', 'Carl']
+    assert result['database']['people'][1]['title'] == 'Boss'
+    assert 'functional_manager' not in result['database']['people'][2]
+    assert result['database']['projects'][0]['description'] == 'x'
+    # The stored document is never modified
+    assert doc == before
+
+
+def test_untouched_entries_stay_shared():
+    doc = stored()
+    result = apply_json_patch(doc, [{'op': 'replace', 'path': '/database/people/0/title', 'value': 'CTO'}])
+    assert result['database']['people'][1] is doc['database']['people'][1]
+    assert result['database']['teams'] is doc['database']['teams']
+    assert result['database']['people'][0] is not doc['database']['people'][0]
+
+
+def test_move_and_copy():
+    result = apply_json_patch(stored(), [
+        {'op': 'copy', 'from': '/database/people/0/title', 'path': '/database/people/1/title'},
+        {'op': 'move', 'from': '/database/people/0', 'path': '/database/people/-'},
+    ])
+    assert people(result) == ['Bob', 'Ann']
+    assert result['database']['people'][0]['title'] == 'Lead'
+    with pytest.raises(PatchError, match='into itself'):
+        apply_json_patch(stored(), [{'op': 'move', 'from': '/database/people', 'path': '/database/people/0'}])
+
+
+def test_test_op():
+    doc = stored()
+    ok = [{'op': 'test', 'path': '/database/people/0/title', 'value': 'Lead'},
+          {'op': 'replace', 'path': '/database/people/0/title', 'value': 'CTO'}]
+    assert apply_json_patch(doc, ok)['database']['people'][0]['title'] == 'CTO'
+    with pytest.raises(PatchConflict):
+        apply_json_patch(doc, [{'op': 'test', 'path': '/database/people/0/title', 'value': 'Intern'}])
+
+
+@pytest.mark.parametrize('ops, message', [
+    ({'op': 'add'}, 'must be a list'),
+    ([['add']], 'must be an object'),
+    ([{'op': 'frobnicate', 'path': '/version'}], 'unsupported op'),
+    ([{'op': 'add', 'path': '/database/people/-'}], 'requires "value"'),
+    ([{'op': 'remove', 'path': '/database/people/7'}], 'out of range'),
+    ([{'op': 'remove', 'path': '/database/people/01'}], 'invalid list index'),
+    ([{'op': 'replace', 'path': '/database/people/0/nickname', 'value': 'x'}], 'path not found'),
+    ([{'op': 'remove', 'path': '/database/people/0/title/x'}], 'scalar'),
+    ([{'op': 'remove', 'path': ''}], 'document root'),
+])
+def test_invalid_patches(ops, message):
+    with pytest.raises(PatchError, match=message):
+        apply_json_patch(stored(), ops)
+
+
+def test_patched_entries_are_validated():
+    with pytest.raises(ValidationError) as info:
+        apply_json_patch(stored(), [{'op': 'replace', 'path': '/database/people/0/title', 'value': 3}])
+    assert info.value.path == ('database', 'people', '0', 'title')
+    with pytest.raises(ValidationError):
+        apply_json_patch(stored(), [{'op': 'replace', 'path': '/database/people', 'value': {}}])
+
+
+def test_patch_reference_check_is_optional():
+    ops = [{'op': 'add', 'path': '/database/people/-', 'value': {'name': 'Carl', 'team_name': 'Ghost'}}]
+    with pytest.raises(ValidationError, match="unknown team 'Ghost'"):
+        apply_json_patch(stored(), ops)
+    assert people(apply_json_patch(stored(), ops, references=False))[-1] == 'Carl'
+
+
+# -- Entity deltas --
+
+def test_delta_upsert_replaces_in_place_and_appends():
+    doc = stored()
+    before = copy.deepcopy(doc)
+    result = apply_entity_delta(doc, {'people': {'upsert': [
+        {'name': 'Bob', 'team_name': 'Sub'}, {'name': 'Carl', 'team_name': 'Core'}]}})
+    assert people(result) == ['Ann', 'Bob', 'Carl']
+    assert result['database']['people'][1] == {'name': 'Bob', 'team_name': 'Sub'}
+    assert result['database']['people'][0] is doc['database']['people'][0]
+    assert doc == before
+
+
+def test_delta_delete_and_rename():
+    result = apply_entity_delta(stored(), {
+        'projects': {'delete': ['P']},
+        'teams': {'delete': ['Sub'], 'upsert': [{'name': 'Platform', 'parent_team': 'Core'}]},
+    })
+    assert result['database']['projects'] == []
+    assert [t['name'] for t in result['database']['teams']] == ['Core', 'Platform']
+
+
+@pytest.mark.parametrize('delta, message', [
+    ([], 'non-empty object'),
+    ({}, 'non-empty object'),
+    ({'robots': {'upsert': []}}, 'unknown entity kind'),
+    ({'people': ['Ann']}, 'must be an object'),
+    ({'people': {'delete': 'Ann'}}, 'must be lists'),
+    ({'people': {'delete': ['Nobody']}}, 'entry not found: Nobody'),
+    ({'people': {'delete': ['Ann', 'Ann']}}, 'entry not found: Ann'),
+    ({'people': {'delete': [['Ann']]}}, r'delete\[0\] must be a string'),
+    ({'people': {'delete': ['Ann', {'name': 'Bob'}]}}, r'delete\[1\] must be a string'),
+    ({'people': {'upsert': [{'title': 'Nameless'}]}}, r'upsert\[0\] must be an object with a string name'),
+    ({'people': {'upsert': [{'name': 7}]}}, r'upsert\[0\] must be an object'),
+    ({'people': {'upsert': ['Ann']}}, r'upsert\[0\] must be an object'),
+])
+def test_invalid_deltas(delta, message):
+    with pytest.raises(PatchError, match=message):
+        apply_entity_delta(stored(), delta)
+
+
+def test_delta_validates_only_upserted_entries():
+    doc = stored()
+    # Stored problems elsewhere do not block the delta
+    doc['database']['people'][0]['title'] = 3
+    result = apply_entity_delta(doc, {'people': {'upsert': [{'name': 'Bob', 'title': 'Dev'}]}})
+    assert result['database']['people'][1]['title'] == 'Dev'
+    with pytest.raises(ValidationError) as info:
+        apply_entity_delta(doc, {'people': {'upsert': [{'name': 'Carl', 'title': 4}]}})
+    assert info.value.path == ('database', 'people', '2', 'title')
+
+
+def test_delta_reference_checks():
+    doc = stored()
+    index = EntityIndex(doc)
+    with pytest.raises(ValidationError, match="unknown team 'Ghost'"):
+        apply_entity_delta(doc, {'people': {'upsert': [{'name': 'Carl', 'team_name': 'Ghost'}]}}, index)
+    with pytest.raises(ValidationError, match="unknown person 'Ann'"):
+        apply_entity_delta(doc, {'people': {'delete': ['Ann']}}, index)
+    with pytest.raises(ValidationError, match='cycle'):
+        apply_entity_delta(doc, {'teams': {'upsert': [{'name': 'Core', 'parent_team': 'Sub'}]}}, index)
+    # Deleting Ann and re-adding her in the same delta keeps Bob's manager
+    result = apply_entity_delta(doc, {'people': {'delete': ['Ann'], 'upsert': [{'name': 'Ann'}]}}, index)
+    assert people(result) == ['Bob', 'Ann']
+    assert apply_entity_delta(doc, {'people': {'upsert': [{'name': 'Carl', 'team_name': 'Ghost'}]}},
+                              index, references=False)
+
+
+def test_delta_index_matches_a_rebuilt_one():
+    doc = stored()
+    index = EntityIndex(doc)
+    for delta in ({'people': {'upsert': [{'name': 'Bob', 'team_name': 'Sub'}]}},
+                  {'people': {'upsert': [{'name': 'Carl'}, {'name': 'Dora'}]}},
+                  {'people': {'delete': ['Ann'], 'upsert': [{'name': 'Eve'}]}, 'projects': {'delete': ['P']}}):
+        result, new_index = apply_entity_delta_indexed(doc, delta, index, references=False)
+        assert new_index.positions == EntityIndex(result).positions
+        assert new_index.positions['teams'] is index.positions['teams']
+    # An in-place edit keeps sharing the positions of the edited kind too
+    _, new_index = apply_entity_delta_indexed(doc, {'people': {'upsert': [{'name': 'Ann'}]}}, index)
+    assert new_index.positions['people'] is index.positions['people']
+
+
+# -- Mixed sequences, as replayed from the journal --
+
+def test_journal_replay_of_mixed_records():
+    doc = stored()
+    for record in (
+        {'op': 'delta', 'value': {'people': {'upsert': [{'name': 'Carl', 'team_name': 'Sub'}]}}},
+        {'op': 'patch', 'value': [{'op': 'add', 'path': '/database/people/2/title', 'value': 'Dev'}]},
+        {'op': 'delta', 'value': {'people': {'delete': ['Ann']}}},
+        {'op': 'patch', 'value': [{'op': 'remove', 'path': '/database/people/0'}]},
+    ):
+        doc = apply_record(doc, record)
+    assert doc['database']['people'] == [{'name': 'Carl', 'team_name': 'Sub', 'title': 'Dev'}]
+    with pytest.raises(ValueError):
+        apply_record(doc, {'op': 'truncate'})
+
+
+# -- Change-log records --
+
+def test_delta_changes_match_a_full_diff():
+    doc = stored()
+    index = EntityIndex(doc)
+    delta = {
+        'people': {'upsert': [{'name': 'Ann', 'team_name': 'Core', 'title': 'Lead'}, {'name': 'Bob'},
+                              {'name': 'Carl'}]},
+        'teams': {'delete': ['Sub']},
+        'projects': {'delete': ['P'], 'upsert': [{'name': 'P'}]},
+    }
+    result = apply_entity_delta(doc, delta, index, references=False)
+    key = lambda change: (change['kind'], change['name'])
+    expected = sorted(diff_entities(doc, result, index), key=key)
+    assert sorted(delta_changes(delta, index), key=key) == expected
+    # Ann and P were upserted unchanged
+    assert [key(c) for c in expected] == [('people', 'Bob'), ('people', 'Carl'), ('teams', 'Sub')]
@@ -0,0 +1,68 @@
+"""database.yaml as an export of database.json or of the SQLite store."""
+import pytest
+from fastapi.testclient import TestClient
+
+from gen_database import write_database
+from server.lib.dbformat import yaml_load
+from server.teamdb import create_app
+
+
+def start(data_root, **config):
+    # Export only when the service stops, unless a test asks otherwise
+    config = dict({'data_root': str(data_root), 'yaml_export_interval': 3600}, **config)
+    # /api/token only answers local clients
+    return TestClient(create_app(config), client=('127.0.0.1', 5000))
+
+
+def add_person(client, name):
+    token = client.post('/api/token', json={'email': 'dev@example.com'}).json()['token']
+    headers = {'X-TeamDB-Email': 'dev@example.com', 'X-TeamDB-Token': token}
+    r = client.put('/api/teamdb/people/' + name, json={'name': name}, headers=headers)
+    assert r.status_code == 201, r.text
+
+
+def exported(yaml_path):
+    text = yaml_path.read_text(encoding='utf-8')
+    return text.splitlines()[0], [p['name'] for p in yaml_load(text)['database']['people']]
+
+
+@pytest.mark.parametrize('config, source', [
+    ({'database_format': 'json'}, 'database.json'),
+    ({'storage_mode': 'sqlite'}, 'teamdb.sqlite3'),
+    ({'storage_mode': 'sqlite', 'database_format': 'json'}, 'teamdb.sqlite3'),
+])
+def test_yaml_is_exported_after_commits(tmp_path, config, source):
+    yaml_path = tmp_path / 'data/config/database.yaml'
+    write_database(yaml_path, 5)
+    with start(tmp_path / 'data', **config) as c:
+        add_person(c, 'Zed')
+    header, people = exported(yaml_path)
+    assert source in header
+    assert people[-1] == 'Zed'
+
+
+def test_sqlite_mode_exports_on_schedule(tmp_path):
+    yaml_path = tmp_path / 'data/config/database.yaml'
+    write_database(yaml_path, 5)
+    with start(tmp_path / 'data', storage_mode='sqlite', yaml_export_interval=0.05) as c:
+        add_person(c, 'Zed')
+        db = c.app.state.teamdb
+        export = db._export_timer
+        assert export is not None
+        export.join(10)
+        assert exported(yaml_path)[1][-1] == 'Zed'
+
+
+def test_sqlite_import_moves_database_json_aside(tmp_path):
+    yaml_path = tmp_path / 'data/config/database.yaml'
+    write_database(yaml_path, 5)
+    json_path = yaml_path.with_suffix('.json')
+    with start(tmp_path / 'data', database_format='json') as c:
+        add_person(c, 'Yan')
+    assert json_path.exists()
+    with start(tmp_path / 'data', storage_mode='sqlite', database_format='json') as c:
+        assert not json_path.exists()
+        assert json_path.with_name('database.json.imported').exists()
+        assert c.get('/api/teamdb').json()['database']['people'][-1]['name'] == 'Yan'
+        add_person(c, 'Zed')
+    assert exported(yaml_path)[1][-2:] == ['Yan', 'Zed']
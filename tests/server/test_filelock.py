@@ -0,0 +1,70 @@
+"""ProcessLock keeps other processes out while any thread of this one holds it."""
+import multiprocessing
+
+import pytest
+
+from server.lib import filelock
+from server.lib.filelock import ProcessLock
+
+pytestmark = pytest.mark.skipif(filelock.fcntl is None, reason='process-local without fcntl')
+
+# A fresh interpreter per child, so nothing (locks, threads) is inherited
+SPAWN = multiprocessing.get_context('spawn')
+
+
+def try_lock(path, results):
+    lock = ProcessLock(path)
+    ok = lock.acquire(blocking=False)
+    results.put(ok)
+    if ok:
+        lock.release()
+    lock.close()
+
+
+def hold_lock(path, held, done):
+    with ProcessLock(path):
+        held.set()
+        done.wait(30)
+
+
+def attempt(path):
+    results = SPAWN.Queue()
+    child = SPAWN.Process(target=try_lock, args=(str(path), results))
+    child.start()
+    try:
+        return results.get(timeout=30)
+    finally:
+        child.join(30)
+
+
+def test_other_process_cannot_acquire_while_held(tmp_path):
+    path = tmp_path / 'teamdb.lock'
+    lock = ProcessLock(path)
+    assert lock.acquire(blocking=False)
+    # Held twice by this process, still one flock
+    assert lock.acquire(blocking=False)
+    lock.release()
+    assert attempt(path) is False
+    lock.release()
+    assert not lock.held
+    assert attempt(path) is True
+    lock.close()
+
+
+def test_waits_for_the_other_process_to_release(tmp_path):
+    path = tmp_path / 'teamdb.lock'
+    held, done = SPAWN.Event(), SPAWN.Event()
+    child = SPAWN.Process(target=hold_lock, args=(str(path), held, done))
+    child.start()
+    lock = ProcessLock(path)
+    try:
+        assert held.wait(30)
+        assert lock.acquire(blocking=False) is False
+        done.set()
+        assert lock.acquire()
+        lock.release()
+    finally:
+        done.set()
+        child.join(30)
+        lock.close()
+    assert child.exitcode == 0
@@ -0,0 +1,150 @@
+"""GET /api/teamdb: conditional requests, content negotiation and serving from memory."""
+import threading
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from gen_database import write_database
+from server.lib.dbcache import CODINGS
+from server.teamdb import create_app
+
+
+@pytest.fixture
+def client(tmp_path):
+    write_database(tmp_path / 'data/config/database.yaml', 50)
+    # /api/token only answers local clients
+    with TestClient(create_app({'data_root': str(tmp_path / 'data')}), client=('127.0.0.1', 5000)) as c:
+        yield c
+
+
+def teamdb(client):
+    return client.app.state.teamdb
+
+
+def get(client, coding='identity', **headers):
+    return client.get('/api/teamdb', headers=dict(headers, **{'Accept-Encoding': coding}))
+
+
+def wait_for_encoding(client, coding):
+    deadline = time.monotonic() + 10
+    while coding not in teamdb(client).db_cache.current().encodings:
+        assert time.monotonic() < deadline, '%s body was never prepared' % coding
+        time.sleep(0.01)
+
+
+def wait_for_sync(client):
+    # The startup warm-up may still hold the locks the first GET skipped
+    db = teamdb(client)
+    deadline = time.monotonic() + 10
+    while get(client).status_code == 200 and db.db_cache.current().key != db._committed_key:
+        assert time.monotonic() < deadline, 'revision was never synced'
+        time.sleep(0.01)
+
+
+def auth_headers(client):
+    token = client.post('/api/token', json={'email': 'dev@example.com'}).json()['token']
+    return {'X-TeamDB-Email': 'dev@example.com', 'X-TeamDB-Token': token}
+
+
+def test_etag_and_not_modified(client):
+    r = get(client)
+    assert r.status_code == 200
+    assert 'Accept-Encoding' in r.headers['Vary']
+    etag = r.headers['ETag']
+    assert etag.startswith('"')
+
+    r = get(client, **{'If-None-Match': etag})
+    assert r.status_code == 304
+    assert r.headers['ETag'] == etag
+    assert r.content == b''
+    assert get(client, **{'If-None-Match': '"stale"'}).status_code == 200
+
+
+@pytest.mark.parametrize('coding', CODINGS)
+def test_encoding_is_served_once_prepared(client, coding):
+    identity = get(client)
+    # The first request only schedules the compression and gets the identity body
+    r = get(client, coding)
+    assert r.status_code == 200
+    assert 'Content-Encoding' not in r.headers
+    assert r.headers['ETag'] == identity.headers['ETag']
+
+    wait_for_encoding(client, coding)
+    r = get(client, coding)
+    assert r.headers['Content-Encoding'] == coding
+    assert r.headers['ETag'] == '"%s-%s"' % (identity.headers['ETag'].strip('"'), coding)
+    assert r.json() == identity.json()
+    # A client holding either representation revalidates against both
+    assert get(client, coding, **{'If-None-Match': identity.headers['ETag']}).status_code == 304
+    assert get(client, **{'If-None-Match': r.headers['ETag']}).status_code == 304
+
+
+def test_get_is_served_from_memory(client, monkeypatch):
+    etag = get(client).headers['ETag']
+    wait_for_sync(client)
+    db = teamdb(client)
+
+    def fail(*args, **kwargs):
+        raise AssertionError('GET of an unchanged database left the event loop or read storage')
+
+    monkeypatch.setattr(db.db_cache, '_loader', fail)
+    monkeypatch.setattr(db, 'run_blocking', fail)
+    monkeypatch.setattr(db.stor, 'load', fail)
+    for _ in range(3):
+        r = get(client)
+        assert r.status_code == 200
+        assert r.headers['ETag'] == etag
+
+
+def test_get_is_not_blocked_by_a_write(client, monkeypatch):
+    before = get(client)
+    doc = before.json()
+    doc['database']['people'][0]['title'] = 'Manager'
+    headers = auth_headers(client)
+    db = teamdb(client)
+    writing, release = threading.Event(), threading.Event()
+    dump = db._dump_database
+
+    def slow_dump(*args, **kwargs):
+        writing.set()
+        assert release.wait(10)
+        return dump(*args, **kwargs)
+
+    monkeypatch.setattr(db, '_dump_database', slow_dump)
+    put = {}
+    writer = threading.Thread(target=lambda: put.update(r=client.put('/api/teamdb', json=doc, headers=headers)))
+    writer.start()
+    try:
+        assert writing.wait(10)
+        # The write is stuck in the middle of saving; readers still get the stored version
+        r = get(client)
+        assert r.status_code == 200
+        assert r.headers['ETag'] == before.headers['ETag']
+    finally:
+        release.set()
+        writer.join(10)
+    assert put['r'].status_code == 200, put['r'].text
+    assert get(client).json()['database']['people'][0]['title'] == 'Manager'
+
+
+def test_outside_edit_is_synced_off_the_event_loop(client):
+    wait_for_sync(client)
+    db = teamdb(client)
+    revision = int(get(client).headers['X-TeamDB-Revision'])
+    write_database(db.db_path, 60)
+    got = {}
+    reader = threading.Thread(target=lambda: got.update(r=get(client)))
+    # A commit thread holds the revision lock across its fsyncs
+    with db._revision_lock:
+        reader.start()
+        # The GET waits for it on the I/O pool; other requests are still served
+        deadline = time.monotonic() + 1
+        while time.monotonic() < deadline:
+            assert client.get('/api/ready').status_code == 200
+            time.sleep(0.05)
+        assert reader.is_alive()
+    reader.join(10)
+    assert got['r'].status_code == 200
+    assert len(got['r'].json()['database']['people']) == 60
+    assert int(got['r'].headers['X-TeamDB-Revision']) == revision + 1
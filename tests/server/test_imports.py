@@ -0,0 +1,15 @@
+"""Importing the server does not load optional or backend-specific libraries."""
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[2]
+
+
+def test_import_leaves_optional_libraries_unloaded():
+    # A fresh interpreter: other tests may already have imported them here.
+    # orjson is not checked, FastAPI imports it itself.
+    code = ('import sys, server.teamdb; '
+            'print(" ".join(m for m in ("yaml", "sqlite3", "brotli") if m in sys.modules))')
+    out = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+    assert out.stdout.split() == []
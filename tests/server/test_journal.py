@@ -0,0 +1,136 @@
+"""Journaled storage mode across restarts: replay, torn tails and compaction."""
+from contextlib import contextmanager
+
+import pytest
+from fastapi.testclient import TestClient
+
+from gen_database import write_database
+from server.lib.dbformat import yaml_load
+from server.lib.journal import Journal, read_snapshot_revision, replay
+from server.teamdb import create_app
+
+
+@pytest.fixture
+def data_root(tmp_path):
+    write_database(tmp_path / 'data/config/database.yaml', 5)
+    return tmp_path / 'data'
+
+
+@contextmanager
+def started(data_root, storage_mode='journal'):
+    # Compaction only when a test asks for it
+    config = {'data_root': str(data_root), 'storage_mode': storage_mode, 'journal_compact_interval': 3600}
+    # /api/token only answers local clients
+    with TestClient(create_app(config), client=('127.0.0.1', 5000)) as c:
+        yield c
+
+
+def teamdb(client):
+    return client.app.state.teamdb
+
+
+def write(client, ops):
+    token = client.post('/api/token', json={'email': 'dev@example.com'}).json()['token']
+    headers = {'X-TeamDB-Email': 'dev@example.com', 'X-TeamDB-Token': token,
+               'Content-Type': 'application/json-patch+json'}
+    r = client.patch('/api/teamdb', json=ops, headers=headers)
+    assert r.status_code == 200, r.text
+    return int(r.headers['X-TeamDB-Revision'])
+
+
+def append_person(name):
+    # Not idempotent: replaying it twice would add the person twice
+    return [{'op': 'add', 'path': '/database/people/-', 'value': {'name': name}}]
+
+
+def read(client):
+    r = client.get('/api/teamdb')
+    assert r.status_code == 200
+    return [p['name'] for p in r.json()['database']['people']], int(r.headers['X-TeamDB-Revision'])
+
+
+def stored_people(client):
+    with open(teamdb(client).db_path, encoding='utf-8') as f:
+        return [p['name'] for p in yaml_load(f)['database']['people']]
+
+
+def test_records_are_replayed_after_a_restart(data_root):
+    with started(data_root) as c:
+        write(c, append_person('Yan'))
+        revision = write(c, append_person('Zed'))
+        # Only the journal has them
+        assert 'Zed' not in stored_people(c)
+        assert teamdb(c).journal.size() > 0
+    with started(data_root) as c:
+        people, rev = read(c)
+        assert people[-2:] == ['Yan', 'Zed']
+        assert rev == revision
+
+
+def test_torn_last_record_is_dropped(data_root):
+    with started(data_root) as c:
+        revision = write(c, append_person('Yan'))
+        path = teamdb(c).journal_path
+    with open(path, 'ab') as f:
+        f.write(b'{"revision":%d,"op":"patch","value":[{"op":"add","pa' % (revision + 1))
+    with started(data_root) as c:
+        people, rev = read(c)
+        assert people[-1] == 'Yan'
+        # The journal changed since the last commit, so clients are told to
+        # reload (a new revision); the record never counts as committed
+        assert rev >= revision
+        # The next append goes after the last complete record
+        revision = write(c, append_person('Zed'))
+    assert path.read_bytes().endswith(b'\n')
+    assert [r['op'] for r in Journal(path).records()] == ['patch', 'patch']
+    with started(data_root) as c:
+        assert read(c) == (stored_people(c)[:5] + ['Yan', 'Zed'], revision)
+
+
+def test_crash_between_snapshot_and_truncation_replays_nothing_twice(data_root, monkeypatch):
+    with started(data_root) as c:
+        write(c, append_person('Yan'))
+        revision = write(c, append_person('Zed'))
+        db = teamdb(c)
+        # The process dies after the snapshot replaced the file, before the journal is cut
+        monkeypatch.setattr(db.journal, 'truncate', lambda through: None)
+        assert db.compact_journal()
+        assert read_snapshot_revision(db.db_path) == revision
+        assert [r['revision'] for r in db.journal.records()] == [revision - 1, revision]
+    with started(data_root) as c:
+        people, rev = read(c)
+        assert people.count('Yan') == 1 and people.count('Zed') == 1
+        assert rev == revision
+    # The header is what skips them
+    doc, applied, _ = replay({}, Journal(data_root / 'config/database.journal'), after=revision)
+    assert applied == 0
+
+
+def test_compaction_folds_the_journal_into_the_snapshot(data_root):
+    with started(data_root) as c:
+        revision = write(c, append_person('Yan'))
+        db = teamdb(c)
+        assert db.compact_journal()
+        assert db.journal.size() == 0
+        assert stored_people(c)[-1] == 'Yan'
+        assert read_snapshot_revision(db.db_path) == revision
+        assert write(c, append_person('Zed')) == revision + 1
+    with started(data_root) as c:
+        assert read(c)[0][-2:] == ['Yan', 'Zed']
+
+
+def test_switching_back_to_snapshot_mode_folds_in_the_journal(data_root):
+    with started(data_root) as c:
+        revision = write(c, append_person('Yan'))
+        journal_path = teamdb(c).journal_path
+    with started(data_root, storage_mode='snapshot') as c:
+        assert journal_path.stat().st_size == 0
+        assert stored_people(c)[-1] == 'Yan'
+        people, rev = read(c)
+        assert people[-1] == 'Yan'
+        # Never sent back; the new file identity may count as a new revision
+        assert rev >= revision
+        # Snapshot-mode writes go to the file again
+        write(c, append_person('Zed'))
+        assert stored_people(c)[-1] == 'Zed'
+        assert journal_path.stat().st_size == 0
@@ -0,0 +1,37 @@
+"""Profiling is opt-in and the header trigger only trusts direct local clients."""
+import pytest
+
+from server.lib.profiling import ProfilingMiddleware
+from server.teamdb import create_app
+
+
+def scope(host='127.0.0.1', **headers):
+    return {'type': 'http', 'client': (host, 50000),
+            'headers': [(k.replace('_', '-').lower().encode(), v.encode()) for k, v in headers.items()]}
+
+
+def installed(app):
+    return any(m.cls is ProfilingMiddleware for m in app.user_middleware)
+
+
+@pytest.mark.parametrize('config, expected', [
+    ({}, False),
+    ({'profile_header': True}, True),
+    ({'profiling_enabled': True, 'profile_slow_ms': 500}, True),
+])
+def test_middleware_is_only_installed_when_asked_for(tmp_path, config, expected):
+    assert installed(create_app(dict(config, data_root=str(tmp_path)))) is expected
+
+
+def test_header_trigger():
+    middleware = ProfilingMiddleware(None, 'profiles', allow_header=True)
+    assert middleware._requested(scope(X_TeamDB_Profile='1'))
+    assert not middleware._requested(scope(X_TeamDB_Profile='0'))
+    assert not middleware._requested(scope('10.1.2.3', X_TeamDB_Profile='1'))
+    # Relayed by nginx: the peer is the proxy's loopback address, not the client
+    for header in ('X_Real_IP', 'X_Forwarded_For', 'Forwarded'):
+        assert not middleware._requested(scope(X_TeamDB_Profile='1', **{header: '203.0.113.7'}))
+
+
+def test_header_trigger_is_off_by_default():
+    assert not ProfilingMiddleware(None, 'profiles')._requested(scope(X_TeamDB_Profile='1'))
@@ -0,0 +1,138 @@
+"""Storage backends: value modes and the asyncio wrapper."""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from server.lib.storage import AsyncStorageBackend, FileStorageBackend, SqliteStorageBackend
+
+
+@pytest.fixture(params=['file', 'sqlite'])
+def backend(request, tmp_path):
+    if request.param == 'file':
+        return FileStorageBackend(tmp_path / 'data', cache_size=8)
+    return SqliteStorageBackend(tmp_path / 'storage.sqlite3')
+
+
+def test_save_after_a_mode_switch_drops_the_old_copy(backend):
+    backend.configure(mode='json.gz')
+    backend.save('tokens', 'tokens', {'a': 'old'})
+    backend.configure(mode='json')
+    # Read through the json.gz copy, then replaced in the new mode
+    assert backend.load('tokens', 'tokens') == {'a': 'old'}
+    backend.save('tokens', 'tokens', {'a': 'new'})
+    backend.configure(mode='json.gz')
+    assert backend.load('tokens', 'tokens') == {'a': 'new'}
+    assert list(backend.list_keys('tokens')) == ['tokens']
+    backend.delete('tokens', 'tokens')
+    assert not backend.exists('tokens', 'tokens')
+
+
+def test_save_many_after_a_mode_switch_drops_the_old_copies(backend):
+    backend.configure(mode='pickle')
+    backend.save_many('sessions', {'a': 1, 'b': 2})
+    backend.configure(mode='json')
+    backend.save_many('sessions', {'a': 10, 'b': 20})
+    backend.configure(mode='pickle')
+    assert backend.load_many('sessions', ['a', 'b']) == {'a': 10, 'b': 20}
+
+
+def test_sqlite_save_replaces_the_old_row_atomically(tmp_path):
+    backend = SqliteStorageBackend(tmp_path / 'storage.sqlite3')
+    backend.configure(mode='json')
+    backend.save('ns', 'k', 1)
+    backend.configure(mode='pickle')
+    with pytest.raises(RuntimeError):
+        with backend.transaction():
+            backend.save('ns', 'k', 2)
+            raise RuntimeError
+    # The rollback also kept the json row
+    backend.configure(mode='json')
+    assert backend.load('ns', 'k') == 1
+
+
+class SlowBackend:
+    """Records saves; each one blocks until `release` is set."""
+
+    def __init__(self):
+        self.saved = []
+        self.release = threading.Event()
+        self.started = threading.Event()
+
+    def save(self, namespace, key, value):
+        self.started.set()
+        assert self.release.wait(10)
+        self.saved.append(value)
+
+    def delete(self, namespace, key):
+        self.saved.append(None)
+
+
+async def until(predicate):
+    for _ in range(1000):
+        if predicate():
+            return
+        await asyncio.sleep(0.005)
+    raise AssertionError('condition never became true')
+
+
+def test_save_cancelled_while_waiting_hands_over_to_the_saves_that_joined_it():
+    async def scenario():
+        backend = SlowBackend()
+        store = AsyncStorageBackend(backend, ThreadPoolExecutor(2))
+        first = asyncio.create_task(store.save('ns', 'k', 1))
+        await until(backend.started.is_set)
+        owner = asyncio.create_task(store.save('ns', 'k', 2))
+        await asyncio.sleep(0)
+        joined = asyncio.create_task(store.save('ns', 'k', 3))
+        await asyncio.sleep(0)
+        owner.cancel()
+        await asyncio.sleep(0)
+        backend.release.set()
+        await asyncio.wait_for(asyncio.gather(first, joined), 5)
+        assert owner.cancelled()
+        assert backend.saved == [1, 3]
+        # Nothing is left queued under the key
+        await asyncio.wait_for(store.save('ns', 'k', 4), 5)
+        assert backend.saved == [1, 3, 4]
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_owner_without_waiters_leaves_nothing_queued():
+    async def scenario():
+        backend = SlowBackend()
+        store = AsyncStorageBackend(backend, ThreadPoolExecutor(2))
+        first = asyncio.create_task(store.save('ns', 'k', 1))
+        await until(backend.started.is_set)
+        owner = asyncio.create_task(store.save('ns', 'k', 2))
+        await asyncio.sleep(0)
+        owner.cancel()
+        backend.release.set()
+        await asyncio.wait_for(first, 5)
+        await asyncio.wait_for(store.save('ns', 'k', 3), 5)
+        assert backend.saved == [1, 3]
+
+    asyncio.run(scenario())
+
+
+def test_write_in_progress_finishes_before_a_cancellation_is_raised():
+    async def scenario():
+        backend = SlowBackend()
+        store = AsyncStorageBackend(backend, ThreadPoolExecutor(2))
+        first = asyncio.create_task(store.save('ns', 'k', 1))
+        await until(backend.started.is_set)
+        joined = asyncio.create_task(store.save('ns', 'k', 2))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0.05)
+        # Still writing, so the task has not given up yet
+        assert not first.done()
+        backend.release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        await asyncio.wait_for(joined, 5)
+        assert backend.saved == [1, 2]
+
+    asyncio.run(scenario())
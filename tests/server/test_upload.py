@@ -0,0 +1,145 @@
+"""Write bodies: size limits, gzip decoding and choosing the parser."""
+import asyncio
+import gzip
+import json
+
+import pytest
+import yaml
+from fastapi.testclient import TestClient
+
+from gen_database import make_database, write_database
+from server.lib.upload import UploadError, parse_body, read_body, upload_parser
+from server.teamdb import create_app
+
+
+def read(chunks, limit, **headers):
+    async def stream():
+        for chunk in chunks:
+            yield chunk
+
+    return asyncio.run(read_body(stream(), limit, **headers))
+
+
+def status(fn, *args, **kwargs):
+    with pytest.raises(UploadError) as info:
+        fn(*args, **kwargs)
+    return info.value.status
+
+
+# -- read_body --
+
+def test_plain_and_gzip_bodies():
+    body = b'{"a": 1}' * 100
+    assert read([body[:50], body[50:]], 1000) == body
+    packed = gzip.compress(body)
+    assert read([packed[:10], packed[10:]], 1000, content_encoding='gzip') == body
+    assert read([packed], 1000, content_encoding='X-GZIP') == body
+    assert read([body], 0, content_encoding='identity') == body
+
+
+def test_body_over_the_limit():
+    assert status(read, [b'x' * 600, b'x' * 600], 1000) == 413
+    # Rejected from Content-Length before anything is read
+    assert status(read, [], 1000, content_length='1001') == 413
+
+
+def test_decompression_bomb():
+    bomb = gzip.compress(b'\0' * (10 * 1024 * 1024))
+    assert len(bomb) < 20_000
+    assert status(read, [bomb], 64 * 1024, content_encoding='gzip') == 413
+    # Also when it arrives in small pieces
+    pieces = [bomb[i:i + 512] for i in range(0, len(bomb), 512)]
+    assert status(read, pieces, 64 * 1024, content_encoding='gzip') == 413
+
+
+def test_corrupt_or_truncated_gzip():
+    packed = gzip.compress(b'{"a": 1}' * 100)
+    assert status(read, [packed[:len(packed) // 2]], 1000, content_encoding='gzip') == 400
+    assert status(read, [b'not gzip at all'], 1000, content_encoding='gzip') == 400
+    assert status(read, [packed[:-8] + b'\0' * 8], 1000, content_encoding='gzip') == 400
+
+
+@pytest.mark.parametrize('coding', ['br', 'deflate', 'gzip, br'])
+def test_unsupported_content_encoding(coding):
+    assert status(read, [b'{}'], 1000, content_encoding=coding) == 415
+
+
+# -- parser choice --
+
+@pytest.mark.parametrize('content_type, parser', [
+    ('application/json', 'json'),
+    ('Application/JSON; charset=utf-8', 'json'),
+    ('application/vnd.teamdb+json', 'json'),
+    ('application/yaml', 'yaml'),
+    ('text/yaml', 'yaml'),
+    ('text/plain; charset=utf-8', 'yaml'),
+    (None, 'auto'),
+    ('', 'auto'),
+])
+def test_upload_parser(content_type, parser):
+    assert upload_parser(content_type) == parser
+
+
+@pytest.mark.parametrize('content_type', ['application/x-www-form-urlencoded', 'multipart/form-data; boundary=x',
+                                          'text/html'])
+def test_unsupported_content_type(content_type):
+    assert status(upload_parser, content_type) == 415
+
+
+def test_untyped_body_falls_back_to_yaml():
+    assert parse_body(b'{"a": [1, 2]}', 'auto') == {'a': [1, 2]}
+    assert parse_body(b'a:\n  - 1\n  - 2\n', 'auto') == {'a': [1, 2]}
+    assert status(parse_body, b'a: [1', 'auto') == 400
+    # Typed bodies are parsed one way only
+    assert status(parse_body, b'a: 1\n', 'json') == 400
+
+
+# -- PUT /api/teamdb --
+
+@pytest.fixture
+def client(tmp_path):
+    write_database(tmp_path / 'data/config/database.yaml', 5)
+    config = {'data_root': str(tmp_path / 'data'), 'max_body_bytes': 256 * 1024}
+    # /api/token only answers local clients
+    with TestClient(create_app(config), client=('127.0.0.1', 5000)) as c:
+        token = c.post('/api/token', json={'email': 'dev@example.com'}).json()['token']
+        c.headers.update({'X-TeamDB-Email': 'dev@example.com', 'X-TeamDB-Token': token})
+        yield c
+
+
+def put(client, body, **headers):
+    return client.put('/api/teamdb', content=body, headers=headers)
+
+
+def people(client):
+    return len(client.get('/api/teamdb').json()['database']['people'])
+
+
+@pytest.mark.parametrize('content_type', ['application/yaml', 'text/plain', None])
+def test_yaml_upload(client, content_type):
+    body = yaml.safe_dump(make_database(7)).encode('utf-8')
+    headers = {'Content-Type': content_type} if content_type else {}
+    r = put(client, body, **headers)
+    assert r.status_code == 200, r.text
+    assert people(client) == 7
+
+
+def test_gzip_upload(client):
+    body = gzip.compress(json.dumps(make_database(8)).encode('utf-8'))
+    r = put(client, body, **{'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})
+    assert r.status_code == 200, r.text
+    assert people(client) == 8
+
+
+@pytest.mark.parametrize('body, headers, code', [
+    (b'x' * (300 * 1024), {'Content-Type': 'application/json'}, 413),
+    (gzip.compress(b' ' * (1024 * 1024)), {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}, 413),
+    (gzip.compress(b'{}')[:-4], {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}, 400),
+    (b'{}', {'Content-Type': 'application/json', 'Content-Encoding': 'br'}, 415),
+    (b'a=1', {'Content-Type': 'application/x-www-form-urlencoded'}, 415),
+    (b'{"database": ', {'Content-Type': 'application/json'}, 400),
+])
+def test_rejected_uploads(client, body, headers, code):
+    before = people(client)
+    assert put(client, body, **headers).status_code == code
+    assert people(client) == before